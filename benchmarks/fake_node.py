@@ -0,0 +1,314 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# fake_node.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+import imp
+import inspect
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+import types
+
+"""
+Just enough of ovirt.node and ovirt_hosted_engine_ha for the plugin to be
+imported and driven outside of a node, so the benchmarks time our code and
+not the TUI
+"""
+
+PACKAGE = "hostedengine"
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, "src")
+
+
+class Anything(object):
+    """Accepts any arguments, and any attribute or call gives another
+    Anything back
+    """
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return Anything()
+
+    def __call__(self, *args, **kwargs):
+        return Anything()
+
+    def __or__(self, other):
+        return self
+
+    def __iter__(self):
+        return iter([Anything(), Anything()])
+
+
+class Widgets(dict):
+    def add(self, widget):
+        self[getattr(widget, "name", id(widget))] = widget
+
+    def __missing__(self, key):
+        return Anything()
+
+
+class Widget(Anything):
+    def __init__(self, name=None, *args, **kwargs):
+        super(Widget, self).__init__(name, *args, **kwargs)
+        self.name = name
+        self.buttons = []
+
+
+class Changeset(dict):
+    def contains_any(self, keys):
+        return any(k in self for k in keys)
+
+    def values_for(self, keys):
+        return [self[k] for k in keys]
+
+
+class NodePlugin(object):
+    def __init__(self, application):
+        self.application = application
+        self.widgets = Widgets()
+        self.logger = logging.getLogger("plugin")
+
+    def pending_changes(self, only_valid=True):
+        return {}
+
+    def stash_change(self, prefix):
+        pass
+
+
+class NodeConfigFileSection(object):
+    """Keeps the values in memory instead of /etc/default/ovirt
+    """
+    _values = {}
+
+    @staticmethod
+    def map_and_update_defaults_decorator(func):
+        def wrapper(self, *args, **kwargs):
+            self._values.update(func(self, *args, **kwargs))
+        wrapper.func = func
+        return wrapper
+
+    def retrieve(self):
+        names = inspect.getargspec(self.update.func)[0][1:]
+        return dict((name, self._values.get(key))
+                    for name, key in zip(names, self.keys))
+
+
+class HAClient(object):
+    """Answers like the HA broker of a cluster of HAClient.hosts hosts, after
+    HAClient.latency seconds
+    """
+    class StatModes(object):
+        ALL = "all"
+        HOST = "host"
+        GLOBAL = "global"
+
+    hosts = 3
+    latency = 0
+    calls = 0
+
+    def get_all_stats(self, mode=None):
+        HAClient.calls += 1
+        time.sleep(self.latency)
+
+        stats = {0: {"maintenance": False}}
+        for host_id in range(1, self.hosts + 1):
+            health = "good" if host_id == 1 else "bad"
+            stats[host_id] = {
+                "live-data": True,
+                "hostname": "host%d.example.com" % host_id,
+                "host-id": host_id,
+                "engine-status": json.dumps({"health": health,
+                                             "vm": "up" if host_id == 1
+                                             else "down",
+                                             "detail": "up"}),
+                "score": 3400,
+                "stopped": False,
+                "maintenance": False,
+                "crc32": "%08x" % host_id,
+                "host-ts": int(time.time())}
+        return stats
+
+    def get_local_host_id(self):
+        return 1
+
+
+class NodeNetwork(object):
+    def is_configured(self):
+        return True
+
+
+class UIThread(object):
+    """Runs what the download thread hands to the UI right away, and counts
+    how often that happens
+    """
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def call(self, func):
+        self.plugin.ticks += 1
+        func()
+
+
+class RecordingLogger(object):
+    def __init__(self):
+        self.errors = []
+
+    def debug(self, msg, *args, **kwargs):
+        pass
+
+    info = debug
+
+    def error(self, msg, *args, **kwargs):
+        self.errors.append(msg)
+
+    exception = error
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """Put the fake modules in place of the real ones
+    """
+    ui = _module("ovirt.node.ui")
+    for name in ("Header", "KeywordLabel", "Notice", "Divider", "Button",
+                 "ProgressBar", "Page", "TextViewDialog", "InfoDialog",
+                 "ConfirmationDialog", "Dialog", "Entry", "Checkbox",
+                 "SaveButton", "CloseButton", "Options", "Label",
+                 "CloseAction", "TransactionProgressDialog"):
+        setattr(ui, name, type(name, (Widget,), {}))
+
+    plugins = _module("ovirt.node.plugins", NodePlugin=NodePlugin,
+                      Changeset=Changeset, UIElements=Widgets)
+    utils = _module("ovirt.node.utils", Transaction=Anything,
+                    process=Anything(), console=Anything())
+    utils.Transaction.Element = Anything
+    _module("ovirt.node.utils.console", wait_for_keypress=Anything())
+    utils.fs = _module("ovirt.node.utils.fs", Config=Anything,
+                       File=Anything)
+    utils.network = _module("ovirt.node.utils.network",
+                            NodeNetwork=NodeNetwork)
+    valid = _module("ovirt.node.valid")
+    for name in ("Empty", "Text", "URL", "FileURL", "Boolean"):
+        setattr(valid, name, Anything)
+
+    config = _module("ovirt.node.config")
+    config.defaults = _module("ovirt.node.config.defaults",
+                              NodeConfigFileSection=NodeConfigFileSection)
+
+    node = _module("ovirt.node", plugins=plugins, ui=ui, utils=utils,
+                   valid=valid, config=config)
+    _module("ovirt", node=node)
+
+    client = _module("ovirt_hosted_engine_ha.client.client",
+                     HAClient=HAClient)
+    _module("ovirt_hosted_engine_ha.client", client=client)
+    _module("ovirt_hosted_engine_ha")
+
+
+def stage(workdir):
+    """Build an importable copy of the plugin in workdir, with config.py
+    pointing every path into it
+
+    Returns
+    The plugin package
+    """
+    install()
+
+    package_dir = os.path.join(workdir, PACKAGE)
+    if os.path.exists(package_dir):
+        shutil.rmtree(package_dir)
+    os.makedirs(package_dir)
+
+    for name in os.listdir(SRC_DIR):
+        if name.endswith(".py") and name != "config.py":
+            shutil.copy(os.path.join(SRC_DIR, name), package_dir)
+
+    paths = {"HOSTED_ENGINE_TEMPDIR": os.path.join(workdir, "tmp-setup"),
+             "VM_CONF_PATH": os.path.join(workdir, "hosted-engine.conf"),
+             "HOSTED_ENGINE_SETUP_DIR": os.path.join(workdir, "setup"),
+             "METRICS_TEXTFILE": os.path.join(workdir, "metrics.prom")}
+    with open(os.path.join(SRC_DIR, "config.py.in")) as f:
+        conf = f.read()
+    for key, value in paths.items():
+        conf = re.sub(r"(?m)^%s = (.*\\\n)*.*$" % key,
+                      "%s = %r" % (key, value), conf)
+    with open(os.path.join(package_dir, "config.py"), "w") as f:
+        f.write(conf)
+
+    with open(paths["VM_CONF_PATH"], "w") as f:
+        f.write("fqdn=engine.example.com\nvm_disk_id=benchmark\n")
+
+    sys.modules.pop(PACKAGE, None)
+    return imp.load_module(PACKAGE, None, package_dir,
+                           ("", "", imp.PKG_DIRECTORY))
+
+
+class Application(object):
+    def __init__(self, plugin=None):
+        self.plugin = plugin
+        self.ui = self
+        self.shown = []
+
+    def thread_connection(self):
+        return UIThread(self.plugin)
+
+    def show(self, what):
+        self.shown.append(what)
+
+    def current_plugin(self):
+        return None
+
+
+class DownloadPlugin(object):
+    """What DownloadThread needs of the page, recording how the download
+    ended instead of showing it
+    """
+    _downloaded = None
+    _install_ready = False
+    _prefetcher = None
+
+    def __init__(self):
+        self.application = Application(self)
+        self.logger = RecordingLogger()
+        self.widgets = Widgets()
+        self._model = {"display_message": ""}
+        self.completed = False
+        self.ticks = 0
+
+    def on_merge(self, changes):
+        self.completed = True
+
+    def show_dialog(self):
+        self.logger.error(self._model["display_message"].strip())
+
+    def error(self):
+        return "; ".join(self.logger.errors) or None
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# image_server.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import gzip
+import io
+import json
+import random
+import re
+import socket
+import sys
+import tarfile
+import threading
+import time
+
+"""
+A local stand-in for the servers appliance images are downloaded from.
+It serves synthetic images of any size, and can be told to be slow, to
+leave out range support, to send chunked responses and to fail
+"""
+
+BLOCK_SIZE = 1024 * 1024
+SEND_SIZE = 64 * 1024
+
+OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<ovf:Envelope xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1/"
+    xmlns:rasd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/\
+CIM_ResourceAllocationSettingData">
+  <References>
+    <File ovf:href="images/disk1" ovf:id="disk1" ovf:size="%(size)d"/>
+  </References>
+  <Section xsi:type="ovf:DiskSection_Type"
+      xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+    <Disk ovf:diskId="disk1" ovf:fileRef="disk1" ovf:format="qcow2"
+        ovf:capacity="%(size)d"/>
+  </Section>
+  <Content>
+    <Section>
+      <Item>
+        <rasd:ResourceType>3</rasd:ResourceType>
+        <rasd:VirtualQuantity>4</rasd:VirtualQuantity>
+      </Item>
+      <Item>
+        <rasd:ResourceType>4</rasd:ResourceType>
+        <rasd:VirtualQuantity>4096</rasd:VirtualQuantity>
+      </Item>
+    </Section>
+  </Content>
+</ovf:Envelope>
+"""
+
+
+class ImageSpec(object):
+    """What is served and how
+
+    size -- Bytes of image, or of the disk inside an OVA
+    kind -- "iso" for raw bytes, "ova" for a gzip compressed OVA
+    bandwidth -- Bytes per second per connection, 0 for as fast as possible
+    latency -- Seconds before a response starts
+    chunked -- Send without a Content-Length
+    ranges -- Answer range requests
+    fail_first -- Answer this many requests with a 503
+    reset_after -- Cut this many responses off after that many bytes
+    resets -- How many responses reset_after applies to
+    """
+    def __init__(self, size=64 * 1024 * 1024, kind="iso", bandwidth=0,
+                 latency=0, chunked=False, ranges=True, fail_first=0,
+                 reset_after=None, resets=1):
+        self.size = size
+        self.kind = kind
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.chunked = chunked
+        self.ranges = ranges
+        self.fail_first = fail_first
+        self.reset_after = reset_after
+        self.resets = resets
+
+    def name(self):
+        return "appliance.%s" % self.kind
+
+
+class Image(object):
+    """The bytes of a synthetic image, generated from one pseudo-random
+    block so a large image doesn't have to be kept in memory
+    """
+    def __init__(self, spec, seed=0):
+        rnd = random.Random(seed)
+        block = "".join(chr(rnd.getrandbits(8)) for _ in xrange(BLOCK_SIZE))
+
+        if spec.kind == "ova":
+            self._data = self.__ova(spec.size, block)
+            self.size = len(self._data)
+        else:
+            self._block = block
+            self._data = None
+            self.size = spec.size
+
+        self.etag = '"%x-%x"' % (self.size, seed)
+
+    def read(self, offset, length):
+        if self._data is not None:
+            return self._data[offset:offset + length]
+
+        pieces = []
+        while length > 0:
+            start = offset % BLOCK_SIZE
+            piece = self._block[start:start + length]
+            pieces.append(piece)
+            offset += len(piece)
+            length -= len(piece)
+        return "".join(pieces)
+
+    def __ova(self, size, block):
+        # Half random, half zeroes, which compresses about like a real
+        # appliance disk
+        disk = io.BytesIO()
+        while disk.tell() < size:
+            piece = block if (disk.tell() // BLOCK_SIZE) % 2 else \
+                "\0" * BLOCK_SIZE
+            disk.write(piece[:size - disk.tell()])
+
+        raw = io.BytesIO()
+        archive = tarfile.open(fileobj=raw, mode="w",
+                               format=tarfile.GNU_FORMAT)
+        for name, content in (("vm.ovf", OVF % {"size": size}),
+                              ("images/disk1", disk.getvalue())):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+        archive.close()
+
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode="wb",
+                           compresslevel=1) as f:
+            f.write(raw.getvalue())
+        return compressed.getvalue()
+
+
+class ImageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # Clients drop a response once they have the block they wanted
+            self.close_connection = 1
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def do_GET(self):
+        server = self.server
+        spec, image = server.spec, server.image
+
+        with server.lock:
+            server.requests += 1
+            failing = server.requests <= spec.fail_first
+            reset = spec.reset_after is not None and \
+                server.resets < spec.resets
+            if reset:
+                server.resets += 1
+
+        if spec.latency:
+            time.sleep(spec.latency)
+
+        if failing:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if self.headers.get("If-None-Match") == image.etag:
+            self.send_response(304)
+            self.send_header("ETag", image.etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = 0, image.size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range", image.etag)
+        if spec.ranges and match and if_range == image.etag:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                             (start, end, image.size))
+        else:
+            self.send_response(200)
+
+        if spec.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", image.etag)
+        self.send_header("Content-Type", "application/octet-stream")
+        if spec.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        try:
+            self.__send(image, start, end,
+                        spec.reset_after if reset else None)
+        except socket.error:
+            # The client went away, which it does when it is aborted
+            self.close_connection = 1
+
+    def __send(self, image, start, end, reset_after):
+        began = time.time()
+        sent = 0
+        offset = start
+
+        while offset <= end:
+            length = min(SEND_SIZE, end - offset + 1)
+            if reset_after is not None and sent + length > reset_after:
+                self.wfile.write(image.read(offset, reset_after - sent))
+                self.wfile.flush()
+                self.connection.shutdown(socket.SHUT_RDWR)
+                self.close_connection = 1
+                return
+
+            data = image.read(offset, length)
+            if self.server.spec.chunked:
+                self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+            offset += length
+            sent += length
+
+            bandwidth = self.server.spec.bandwidth
+            if bandwidth:
+                ahead = float(sent) / bandwidth - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        if self.server.spec.chunked:
+            self.wfile.write("0\r\n\r\n")
+
+
+class ImageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, spec, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                                           ImageHandler)
+        self.spec = spec
+        self.image = Image(spec)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.resets = 0
+
+    def url(self):
+        return "http://127.0.0.1:%d/%s" % (self.server_port,
+                                           self.spec.name())
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name="image-server")
+        t.daemon = True
+        t.start()
+        return self
+
+
+def spec_from_args(args):
+    return ImageSpec(**dict((k, v) for k, v in vars(args).items()
+                            if k != "port"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a synthetic "
+                                     "appliance image")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--size", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--kind", choices=("iso", "ova"), default="iso")
+    parser.add_argument("--bandwidth", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--chunked", action="store_true")
+    parser.add_argument("--no-ranges", dest="ranges", action="store_false")
+    parser.add_argument("--fail-first", type=int, default=0)
+    parser.add_argument("--reset-after", type=int, default=None)
+    parser.add_argument("--resets", type=int, default=1)
+    args = parser.parse_args()
+
+    server = ImageServer(spec_from_args(args), args.port)
+    # The first line tells whoever started us where to connect
+    print json.dumps({"url": server.url(), "size": server.image.size})
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# run_benchmarks.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+import argparse
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_node
+
+"""
+Benchmarks for the image download and the HA status of the plugin
+
+Every case runs in a process of its own, so CPU time and peak RSS belong to
+that case alone. The image server runs in yet another process, so its work
+isn't counted. A case whose image doesn't come out whole and with the
+right digest fails the run. Results are written as JSON, and can be
+compared with the results of an earlier run to catch regressions:
+
+    run_benchmarks.py --output new.json --compare old.json
+"""
+
+MiB = 1024 * 1024
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Download cases take ImageSpec arguments, status cases the size of the
+# fake cluster and how long its broker takes to answer, stream cases the
+# size of the image and how many connections take its blocks
+CASES = (("download-ranged", "download", {"size": 256 * MiB}),
+         ("download-single", "download", {"size": 256 * MiB,
+                                          "ranges": False}),
+         ("download-chunked", "download", {"size": 128 * MiB,
+                                           "ranges": False,
+                                           "chunked": True}),
+         ("download-throttled", "download", {"size": 32 * MiB,
+                                             "bandwidth": 4 * MiB}),
+         ("download-latency", "download", {"size": 64 * MiB,
+                                           "latency": .2}),
+         ("download-ova", "download", {"size": 128 * MiB, "kind": "ova"}),
+         ("download-faults", "download", {"size": 64 * MiB,
+                                          "fail_first": 1,
+                                          "reset_after": 8 * MiB,
+                                          "resets": 2}),
+         ("stream-reordered", "stream", {"size": 64 * MiB,
+                                         "connections": 4}),
+         ("status-3-hosts", "status", {"hosts": 3}),
+         ("status-64-hosts", "status", {"hosts": 64}),
+         ("status-1024-hosts", "status", {"hosts": 1024}),
+         ("status-slow-broker", "status", {"hosts": 3, "latency": .5}))
+
+# A download is retried this often when faults are injected
+MAX_ATTEMPTS = 5
+
+# How long each status function is called over
+MEASURE_TIME = .5
+
+# The metrics compared between runs, and whether higher is better
+COMPARED = {"throughput_mib_s": True,
+            "cpu_s": False,
+            "cpu_per_chunk_us": False,
+            "peak_rss_mib": False,
+            "model_us": False,
+            "ui_content_us": False,
+            "fetch_us": False,
+            "render_text_us": False,
+            "render_table_us": False,
+            "table_update_us": False}
+
+
+class NoDelay(object):
+    """time for the page, without the pause DownloadThread takes for its
+    widgets to be built, which would only be measured as lost throughput
+    """
+    def sleep(self, seconds):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def start_server(params):
+    argv = [sys.executable, os.path.join(HERE, "image_server.py")]
+    for key, value in params.items():
+        option = "--%s" % key.replace("_", "-")
+        if value is True:
+            argv.append(option)
+        elif value is False:
+            argv.append("--no-%s" % key)
+        else:
+            argv.extend([option, str(value)])
+
+    server = subprocess.Popen(argv, stdout=subprocess.PIPE)
+    return server, json.loads(server.stdout.readline())
+
+
+def measure(func):
+    """
+    Call func for about MEASURE_TIME seconds
+
+    Returns
+    The mean, median and 95th percentile of a call in microseconds
+    """
+    times = []
+    began = time.time()
+    while time.time() - began < MEASURE_TIME or len(times) < 10:
+        start = time.time()
+        func()
+        times.append((time.time() - start) * 1000000)
+
+    times.sort()
+    return {"calls": len(times),
+            "mean": sum(times) / len(times),
+            "p50": times[len(times) // 2],
+            "p95": times[int(len(times) * .95)]}
+
+
+def bench_download(params, workdir):
+    package = fake_node.stage(workdir)
+    page = importlib.import_module("%s.hosted_engine_page" % package.__name__)
+    download = importlib.import_module("%s.hosted_engine_download" %
+                                       package.__name__)
+
+    # Every write of a chunk goes through ImageWriter, count them
+    chunks = [0]
+    write = download.ImageWriter.write
+
+    def counting_write(self, view):
+        chunks[0] += 1
+        return write(self, view)
+    download.ImageWriter.write = counting_write
+    page.time = NoDelay()
+
+    server, served = start_server(params)
+    rss_before = peak_rss_mib()
+    try:
+        began, cpu_began = time.time(), cpu_time()
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            plugin = fake_node.DownloadPlugin()
+            thread = page.DownloadThread(plugin, served["url"],
+                                         package.config.
+                                         HOSTED_ENGINE_SETUP_DIR)
+            thread.start()
+            thread.join()
+            if plugin.completed:
+                break
+        elapsed, cpu = time.time() - began, cpu_time() - cpu_began
+    finally:
+        server.kill()
+        server.wait()
+
+    path = os.path.join(package.config.HOSTED_ENGINE_SETUP_DIR,
+                        served["url"].split("/")[-1])
+    complete = plugin.completed and os.path.exists(path) and \
+        os.path.getsize(path) == served["size"]
+
+    return {"bytes": served["size"],
+            "complete": complete,
+            "error": plugin.error(),
+            "attempts": attempt,
+            "wall_s": elapsed,
+            "throughput_mib_s": served["size"] / elapsed / MiB,
+            "cpu_s": cpu,
+            "cpu_per_mib_ms": cpu * 1000 / (served["size"] / float(MiB)),
+            "chunks": chunks[0],
+            "bytes_per_chunk": served["size"] / max(chunks[0], 1),
+            "cpu_per_chunk_us": cpu * 1000000 / max(chunks[0], 1),
+            "ui_updates": plugin.ticks,
+            "rss_before_mib": rss_before,
+            "peak_rss_mib": peak_rss_mib()}
+
+
+def bench_stream(params, workdir):
+    """Hash an image whose bytes arrive out of order, in blocks which the
+    connections take in turn, with some of their chunks retried. Half way
+    the digest is saved and picked up again, as a resumed download does.
+    The digest has to come out the same as a plain read of the image
+    """
+    package = fake_node.stage(workdir)
+    download = importlib.import_module("%s.hosted_engine_download" %
+                                       package.__name__)
+
+    path = os.path.join(workdir, "image.part")
+    with open(path, "wb") as f:
+        for i in range(0, params["size"], MiB):
+            f.write(os.urandom(min(MiB, params["size"] - i)))
+    with open(path, "rb") as f:
+        expected = hashlib.sha256(f.read()).hexdigest()
+
+    size = download.CHUNK_SIZE * 4
+
+    def never():
+        return False
+
+    def start(saved=None):
+        feeder = download.SinkFeeder()
+        digests = download.ImageDigests(["sha256"], saved)
+        stream = download.OrderedStream([digests], digests.offset,
+                                        feeder.put)
+        blocks = download.BlockQueue([(digests.offset, params["size"] - 1)],
+                                     size * 8)
+        feeder.start()
+        return feeder, digests, stream, \
+            [blocks.take(never) for i in range(params["connections"])], \
+            blocks
+
+    feeder, digests, stream, workers, blocks = start()
+    held = resumed = 0
+    began, cpu_began = time.time(), cpu_time()
+    with open(path, "rb") as f:
+        while any(workers):
+            for i, block in enumerate(workers):
+                if not block:
+                    continue
+                offset, end = block
+                length = min(size, end - offset + 1)
+                f.seek(offset)
+                data = f.read(length)
+                stream.update(offset, memoryview(data))
+                # A retried chunk, already passed on or held
+                stream.update(offset, data[:length // 3])
+                held = max(held, stream.held())
+                workers[i] = (offset + length, end) \
+                    if offset + length <= end else blocks.take(never)
+
+            if not resumed and digests.resumable and \
+                    stream.offset >= params["size"] // 2:
+                # What was held is lost, the digest is saved with the
+                # sidecar
+                feeder.finish()
+                saved = json.loads(json.dumps(digests.state()))
+                resumed = saved["offset"]
+                feeder, digests, stream, workers, blocks = start(saved)
+    feeder.finish()
+    elapsed, cpu = time.time() - began, cpu_time() - cpu_began
+
+    return {"bytes": params["size"],
+            "complete": digests.offset == params["size"] and
+            digests.hexdigest("sha256") == expected,
+            "resumed_at": resumed,
+            "peak_held_mib": held / float(MiB),
+            "wall_s": elapsed,
+            "throughput_mib_s": params["size"] / elapsed / MiB,
+            "cpu_s": cpu,
+            "cpu_per_mib_ms": cpu * 1000 / (params["size"] / float(MiB)),
+            "peak_rss_mib": peak_rss_mib()}
+
+
+def bench_status(params, workdir):
+    package = fake_node.stage(workdir)
+    page = importlib.import_module("%s.hosted_engine_page" % package.__name__)
+    status = importlib.import_module("%s.hosted_engine_status" %
+                                     package.__name__)
+
+    fake_node.HAClient.hosts = params["hosts"]
+    fake_node.HAClient.latency = params.get("latency", 0)
+
+    plugin = page.Plugin(fake_node.Application())
+    began = time.time()
+    plugin.model()
+    poller = plugin._status_poller()
+    while poller.status().value is None and time.time() - began < 30:
+        time.sleep(.01)
+    first_status = time.time() - began
+
+    calls = fake_node.HAClient.calls
+    model = measure(plugin.model)
+    ui_content = measure(plugin.ui_content)
+    broker_calls = fake_node.HAClient.calls - calls
+
+    source = status.HAStatusSource()
+    fetch = measure(source)
+    snapshot = source()
+    text = measure(lambda: status.render_status(snapshot))
+    as_json = measure(lambda: status.render_status(snapshot, "json"))
+    table = measure(lambda: status.render_table(snapshot, "score"))
+
+    # A poll in which nothing changed, as happens between host updates
+    stats = dict(snapshot.hosts)
+    stats[0] = snapshot.global_stats
+    update = measure(lambda: status.HAStatusSnapshot(stats, 1, snapshot))
+
+    return {"hosts": params["hosts"],
+            "first_status_s": first_status,
+            "model_us": model["mean"],
+            "model": model,
+            "ui_content_us": ui_content["mean"],
+            "ui_content": ui_content,
+            "broker_calls_while_rendering": broker_calls,
+            "fetch_us": fetch["mean"],
+            "fetch": fetch,
+            "render_text_us": text["mean"],
+            "render_json_us": as_json["mean"],
+            "render_table_us": table["mean"],
+            "table_update_us": update["mean"],
+            "peak_rss_mib": peak_rss_mib()}
+
+
+def run_case(name, kind, params):
+    """Run a case in this process
+
+    Returns
+    The metrics of the case as a dict
+    """
+    workdir = tempfile.mkdtemp(prefix="he-benchmark-")
+    try:
+        bench = {"download": bench_download,
+                 "stream": bench_stream,
+                 "status": bench_status}[kind]
+        return bench(params, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_isolated(name, kind, params):
+    """Run a case in a process of its own
+    """
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              "--child", json.dumps([name, kind, params])],
+                             stdout=subprocess.PIPE)
+    out = child.communicate()[0]
+    if child.returncode:
+        return {"failed": "exited with %s" % child.returncode}
+    return json.loads(out.splitlines()[-1])
+
+
+def metadata():
+    try:
+        revision = subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=HERE,
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {"revision": revision,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count()}
+
+
+def compare(results, baseline, threshold):
+    """
+    Print how results changed against baseline
+
+    Returns
+    The number of metrics which got worse by more than threshold
+    """
+    regressions = 0
+    for name, metrics in sorted(results["cases"].items()):
+        old = baseline["cases"].get(name)
+        if not old:
+            continue
+        for metric, higher_is_better in sorted(COMPARED.items()):
+            if not old.get(metric) or metric not in metrics:
+                continue
+            change = (metrics[metric] - old[metric]) / float(old[metric])
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print "%-22s %-18s %12.2f -> %12.2f  %+7.1f%%%s" % (
+                name, metric, old[metric], metrics[metric], change * 100,
+                flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark image downloads"
+                                     " and the HA status")
+    parser.add_argument("--output", "-o", help="Write the results here")
+    parser.add_argument("--compare", "-c", help="Results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=.2,
+                        help="Relative change counted as a regression")
+    parser.add_argument("--case", "-k", action="append",
+                        help="Only run cases whose name contains this")
+    parser.add_argument("--scale", type=float, default=1,
+                        help="Multiply the image sizes by this")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print json.dumps(run_case(*json.loads(args.child)))
+        return 0
+
+    results = {"metadata": metadata(), "cases": {}}
+    for name, kind, params in CASES:
+        if args.case and not any(k in name for k in args.case):
+            continue
+        params = dict(params)
+        if "size" in params:
+            params["size"] = int(params["size"] * args.scale)
+
+        sys.stderr.write("%s ... " % name)
+        results["cases"][name] = dict(run_isolated(name, kind, params),
+                                      params=params)
+        sys.stderr.write("done\n")
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print output
+
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    # A fast image which came out wrong is a failure, not a result
+    broken = sorted(name for name, metrics in results["cases"].items()
+                    if "failed" in metrics or
+                    metrics.get("complete") is False)
+    if broken:
+        sys.stderr.write("Incomplete or wrong: %s\n" % ", ".join(broken))
+    return 1 if regressions or broken else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
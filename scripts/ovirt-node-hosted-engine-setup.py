@@ -18,7 +18,9 @@
 # MA  02110-1301, USA.  A copy of the GNU General Public License is
 # also available at http://www.gnu.org/copyleft/gpl.html.
 
+import os
 import sys
+import time
 from ovirt.node.utils import process
 
 
@@ -45,14 +47,135 @@ def run(args):
     # real value on it in the future
 
     rc = process.call(["ovirt-hosted-engine-setup"] + args)
-    if rc != 0:
+    if rc != 0 and sys.stdin.isatty():
         print("Something went wrong setting up hosted engine, or the "
               "setup process was cancelled.\n\nPress any key to continue...")
         getch()
     sys.exit(rc)
 
+
+def vm_status(args):
+    """
+    Print the hosted engine status, --json makes it machine-readable.
+    --table prints one line per host instead, sorted by --sort=COLUMN and
+    turned around by --reverse
+    """
+    from ovirt.node.setup.hostedengine import hosted_engine_status as status
+
+    sort = ([a[7:] for a in args if a.startswith("--sort=")] or
+            ["host_id"])[-1]
+    try:
+        snapshot = status.fetch_ha_status()
+        if "--table" in args:
+            print(status.render_table(snapshot, sort, "--reverse" in args))
+        else:
+            print(status.render_status(snapshot, "json" if "--json" in args
+                                       else "text"))
+    except Exception as e:
+        sys.stderr.write("Failed to collect hosted engine vm status, check "
+                         "ovirt-ha-broker logs: %s\n" % e)
+        sys.exit(1)
+    sys.exit(0)
+
+
+def seed(args):
+    """
+    Serve the cached images to the other hosts until interrupted
+    """
+    from ovirt.node.setup.hostedengine import hosted_engine_seed
+
+    server = hosted_engine_seed.SeedServer().start()
+    print("Serving cached hosted engine images on port %d, press Ctrl-C to "
+          "stop" % server.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+
+def bandwidth(args):
+    """
+    Limit the bandwidth of image downloads, the running ones included:
+    --bandwidth [RATE] [--adaptive|--fixed]. RATE is like 10M, 0 for
+    unlimited
+    """
+    from ovirt.node.setup.hostedengine import hosted_engine_bandwidth as bw
+
+    adaptive = True if "--adaptive" in args else \
+        False if "--fixed" in args else None
+    rates = [a for a in args if not a.startswith("--")]
+    try:
+        cap = bw.parse_rate(rates[0]) if rates else None
+        limit = bw.write_limit(cap, adaptive)
+    except (ValueError, IOError, OSError) as e:
+        sys.stderr.write("Couldn't set the download bandwidth: %s\n" % e)
+        sys.exit(1)
+
+    print("Image downloads: %s%s" % (
+        "%s/s" % bw.format_rate(limit["cap"]) if limit.get("cap")
+        else "unlimited", ", adaptive" if limit.get("adaptive") else ""))
+    sys.exit(0)
+
+
+class StubApplication(object):
+    """
+    Enough of an application to create the plugin with, outside of the TUI
+    """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def profile_startup(args):
+    """
+    Show how long loading and creating the plugin adds to the start of the
+    TUI, and which modules it takes
+    """
+    # The TUI has these loaded before it gets to the plugins
+    for name in ("ovirt.node.plugins", "ovirt.node.ui", "ovirt.node.utils",
+                 "ovirt.node.valid", "ovirt.node.utils.network"):
+        __import__(name)
+
+    os.environ["OVIRT_NODE_HOSTED_ENGINE_PROFILE"] = "1"
+    from ovirt.node.setup import hostedengine
+    from ovirt.node.setup.hostedengine import hosted_engine_metrics
+
+    hostedengine.createPlugins(StubApplication())
+
+    for name, duration, profile in hosted_engine_metrics.STARTUP:
+        print("%s: %.1f ms\n\n%s\n" % (name, duration * 1000,
+                                       profile.report()))
+    sys.exit(0)
+
+
+def batch(args):
+    """
+    Deploy without a console, see --batch --help
+    """
+    from ovirt.node.setup.hostedengine import hosted_engine_batch
+
+    sys.exit(hosted_engine_batch.main(args))
+
 if __name__ == "__main__":
     # Just a wrapper. Strip off the name of this script and pass everything
-    # else to ovirt-hosted-engine-setup
+    # else to ovirt-hosted-engine-setup, unless we're asked for the status,
+    # to seed images, to limit downloads, to profile the startup or to deploy
+    # in batch mode
+
+    if sys.argv[1:2] == ["--vm-status"]:
+        vm_status(sys.argv[2:])
+
+    if sys.argv[1:2] == ["--seed"]:
+        seed(sys.argv[2:])
+
+    if sys.argv[1:2] == ["--bandwidth"]:
+        bandwidth(sys.argv[2:])
+
+    if sys.argv[1:2] == ["--profile-startup"]:
+        profile_startup(sys.argv[2:])
+
+    if sys.argv[1:2] == ["--batch"]:
+        batch(sys.argv[2:])
 
     run(sys.argv[1:])
@@ -18,12 +18,19 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301, USA.  A copy of the GNU General Public License is
 # also available at http://www.gnu.org/copyleft/gpl.html.
-import hosted_engine_page
+from hosted_engine_metrics import profile_startup
+
+with profile_startup("plugin.import"):
+    import hosted_engine_page
 
 """
 Hosted Engine Plugin
+
+What loading and starting it adds to the start of the TUI is recorded as
+spans, see STARTUP_PROFILE
 """
 
 
 def createPlugins(application):
-    hosted_engine_page.Plugin(application)
+    with profile_startup("plugin.init"):
+        hosted_engine_page.Plugin(application)
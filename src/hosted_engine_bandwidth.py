@@ -0,0 +1,314 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_bandwidth.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from . import config
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+"""
+Bandwidth shaping
+
+Image downloads share the management network with the HA agent and broker
+of the hosts, and with their storage traffic. They are held to a cap, and
+can back off on their own while the broker gets slow to answer, which is
+the first sign of its traffic suffering
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+RATE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def parse_rate(value):
+    """
+    Parse a rate in bytes per second, like 512K, 10M or 1.5G. 0 or nothing
+    means unlimited
+
+    Raises ValueError if value can't be understood
+    """
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?(?:/s)?\s*$",
+                 str(value or 0), re.IGNORECASE)
+    if not m:
+        raise ValueError("Invalid rate: %s" % value)
+    return int(float(m.group(1)) * RATE_UNITS[m.group(2).lower()])
+
+
+def format_rate(rate):
+    """
+    Returns
+    rate the way parse_rate reads it, like 10M
+    """
+    if not rate:
+        return "0"
+    for unit in ("G", "M", "K"):
+        scale = RATE_UNITS[unit.lower()]
+        if rate >= scale:
+            return ("%d%s" if rate % scale == 0 else "%.1f%s") % \
+                (rate / float(scale), unit)
+    return str(int(rate))
+
+
+class TokenBucket(object):
+    """Allows rate bytes per second on average, and bursts of up to
+    burst bytes. Shared by every connection it limits
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.consumed = 0
+        self._tokens = self.burst
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate, whoever waits is held to the new one from their
+        next call on
+        """
+        with self._lock:
+            self.rate = rate
+            self.burst = burst or rate
+            self._tokens = min(self._tokens, self.burst)
+
+    def consume(self, amount):
+        """Wait until amount bytes may be sent
+        """
+        with self._lock:
+            self.consumed += amount
+            if not self.rate:
+                return
+
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= amount
+            wait = -self._tokens / float(self.rate)
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class DownloadLimit(object):
+    """The bandwidth of every image download of the process, however many
+    connections each one uses.
+
+    The cap is what the user allows, 0 is unlimited. With adaptive, the rate
+    is halved whenever the broker, polled for the page every
+    BANDWIDTH_PROBE_INTERVAL seconds while bytes flow, answers
+    BANDWIDTH_LATENCY_RATIO times slower than it does at best or stops
+    answering, and grows back step by step while it doesn't.
+
+    Limits written to path, by write_limit(), are picked up within a second
+    by whatever is downloading
+
+    probe -- Returns how long the broker takes to answer, or raises
+    """
+    def __init__(self, cap=None, adaptive=None, path=None, probe=None):
+        self.cap = config.DOWNLOAD_BANDWIDTH if cap is None else cap
+        self.adaptive = config.DOWNLOAD_BANDWIDTH_ADAPTIVE \
+            if adaptive is None else adaptive
+        self.path = path or config.DOWNLOAD_BANDWIDTH_FILE
+        self.probe = probe or self.__broker_latency
+
+        self.bucket = TokenBucket(self.cap)
+        self.baseline = None
+
+        self._loaded = None
+        self._checked = 0
+        self._controller = None
+        self._lock = threading.Lock()
+
+    def set(self, cap=None, adaptive=None):
+        """Change the cap, the adaptive mode, or both. The rate starts over
+        from the cap
+        """
+        with self._lock:
+            if cap is not None:
+                self.cap = cap
+            if adaptive is not None:
+                self.adaptive = adaptive
+            self.bucket.set_rate(self.cap)
+            # Whatever path holds until now is overridden
+            self._loaded = self.__mtime()
+        LOGGER.info("Download bandwidth: %s" % self)
+
+    def rate(self):
+        return self.bucket.rate
+
+    def consume(self, amount):
+        """Wait until amount bytes may be downloaded
+        """
+        now = time.time()
+        if now - self._checked >= 1:
+            self._checked = now
+            self.reload()
+
+        if self.adaptive and not self._controller:
+            with self._lock:
+                if self.adaptive and not self._controller:
+                    self._controller = threading.Thread(
+                        target=self.__control, name="bandwidth-control")
+                    self._controller.daemon = True
+                    self._controller.start()
+
+        self.bucket.consume(amount)
+
+    def reload(self):
+        """Apply what was written to path since it was last read
+        """
+        mtime = self.__mtime()
+        if mtime is None or mtime == self._loaded:
+            return
+        self._loaded = mtime
+
+        try:
+            with open(self.path) as f:
+                limit = json.load(f)
+            self.set(limit.get("cap"), limit.get("adaptive"))
+        except (IOError, ValueError, AttributeError) as e:
+            LOGGER.warning("Ignoring the bandwidth limit in %s: %s" %
+                           (self.path, e))
+
+    def adapt(self, latency, throughput):
+        """
+        Take one step: back off if the broker took latency seconds to
+        answer, None if it didn't, much longer than its best, and grow back
+        otherwise
+
+        throughput -- What the downloads achieved since the last step
+        """
+        if latency is not None:
+            self.baseline = latency if self.baseline is None else \
+                min(self.baseline, latency)
+        if self.baseline is None:
+            # No broker to protect, such as before the first deploy
+            return
+
+        degraded = latency is None or \
+            (latency > self.baseline * config.BANDWIDTH_LATENCY_RATIO and
+             latency > config.BANDWIDTH_LATENCY_MIN)
+
+        rate = self.bucket.rate
+        if degraded:
+            rate = max((rate or throughput) / 2, config.BANDWIDTH_MIN)
+        elif rate:
+            rate += max(rate // 10, config.BANDWIDTH_MIN)
+            if not self.cap and rate > throughput * 2:
+                # The network holds the downloads back by now, not us
+                rate = 0
+        if self.cap:
+            rate = min(rate or self.cap, self.cap)
+
+        if rate != self.bucket.rate:
+            LOGGER.info("%s, download bandwidth %s -> %s" % (
+                "Broker answered in %.3fs" % latency if latency is not None
+                else "Broker didn't answer", format_rate(self.bucket.rate),
+                format_rate(rate)))
+            self.bucket.set_rate(int(rate))
+
+    def __mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def __broker_latency(self):
+        """How long the broker took to hand out the status of the cluster,
+        the last time the poller shared with the page asked. It is asked
+        again for the next probe
+
+        Raises the error of the last poll, or RuntimeError if the broker
+        took more than two probes to answer
+        """
+        # Only adaptive downloads need the HA client
+        from .hosted_engine_status import shared_poller
+
+        poller = shared_poller()
+        status = poller.status()
+        poller.refresh()
+        if status.error:
+            raise status.error
+        if status.stale(config.BANDWIDTH_PROBE_INTERVAL * 2):
+            raise RuntimeError("No HA status for %s" % (
+                "%.1fs" % status.age() if status.updated else "now"))
+        return status.latency
+
+    def __control(self):
+        consumed, stamp = self.bucket.consumed, time.time()
+        while self.adaptive:
+            time.sleep(config.BANDWIDTH_PROBE_INTERVAL)
+            if self.bucket.consumed == consumed:
+                # Nothing is downloading, started again when it is
+                break
+
+            now = time.time()
+            throughput = (self.bucket.consumed - consumed) / (now - stamp)
+            consumed, stamp = self.bucket.consumed, now
+
+            try:
+                latency = self.probe()
+            except Exception as e:
+                LOGGER.debug("The broker didn't answer: %s" % e)
+                latency = None
+            self.adapt(latency, throughput)
+
+        with self._lock:
+            self._controller = None
+
+    def __str__(self):
+        text = "unlimited" if not self.cap else \
+            "%s/s" % format_rate(self.cap)
+        if self.adaptive:
+            text += ", adaptive"
+            if self.bucket.rate != self.cap:
+                text += ", now %s/s" % format_rate(self.bucket.rate)
+        return text
+
+
+def write_limit(cap=None, adaptive=None, path=None):
+    """Have every download, running or not, use cap and adaptive. Either
+    one left out stays as it is
+    """
+    path = path or config.DOWNLOAD_BANDWIDTH_FILE
+    try:
+        with open(path) as f:
+            limit = json.load(f)
+    except (IOError, ValueError):
+        limit = {}
+    if cap is not None:
+        limit["cap"] = cap
+    if adaptive is not None:
+        limit["adaptive"] = adaptive
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = "%s.tmp" % path
+    with open(tmp, "w") as f:
+        json.dump(limit, f)
+    os.rename(tmp, path)
+    return limit
+
+
+DOWNLOAD_LIMIT = DownloadLimit()
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_batch.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from urlparse import urlparse
+from ovirt.node.utils import process
+from . import config
+from .hosted_engine_bandwidth import DOWNLOAD_LIMIT, parse_rate
+from .hosted_engine_download import DownloadError, TRANSFER_ERRORS
+from .hosted_engine_metrics import time_transaction
+from .hosted_engine_model import HostedEngine, make_tempfile, \
+    persist_configs
+from .hosted_engine_retrieval import ImageRetrieval
+
+import argparse
+import json
+import logging
+import os
+import requests
+import signal
+import sys
+import threading
+import time
+
+"""
+Deploy Hosted Engine without anyone at the console
+
+Does what the page does on "Deploy": retrieves and validates the image,
+writes the configuration and runs ovirt-hosted-engine-setup, with the
+answer files it is given. Nothing is ever read from the terminal. Progress
+is written to stdout, one JSON object per line, and the exit code tells
+how far it got
+"""
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_IMAGE = 3
+EXIT_CONFIG = 4
+EXIT_SETUP = 5
+EXIT_INTERRUPTED = 130
+
+# Download progress is reported when the percentage changes, or at least
+# this often, in seconds
+REPORT_INTERVAL = 5
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Reporter(object):
+    """Writes events to out, as JSON lines or as text
+    """
+    def __init__(self, fmt="json", out=None):
+        self.fmt = fmt
+        self.out = out or sys.stdout
+        self._last = (None, 0)
+
+    def event(self, event, **fields):
+        if self.fmt == "json":
+            fields.update({"event": event, "time": time.time()})
+            line = json.dumps(fields, sort_keys=True)
+        else:
+            line = "%s: %s" % (event, ", ".join(
+                "%s=%s" % kv for kv in sorted(fields.items())))
+        self.out.write(line + "\n")
+        self.out.flush()
+
+    def progress(self, progress):
+        percent = progress.percent()
+        if percent == self._last[0] and \
+                time.time() - self._last[1] < REPORT_INTERVAL:
+            return
+        self._last = (percent, time.time())
+
+        transfer = progress.transfer
+        self.event("progress", stage="image", percent=percent,
+                   downloaded=transfer.downloaded, size=transfer.size,
+                   speed=int(progress.speed or 0), eta=progress.eta(),
+                   limit=DOWNLOAD_LIMIT.rate())
+
+
+def rate(value):
+    try:
+        return parse_rate(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="ovirt-node-hosted-engine-setup --batch",
+        description="Deploy Hosted Engine non-interactively")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--image", help="URL of the engine ISO or OVA, "
+                        "http://, https:// or file://")
+    source.add_argument("--pxe", action="store_true",
+                        help="PXE boot the engine VM")
+    parser.add_argument("--checksum", help="Image checksum or checksum URL")
+    parser.add_argument("--mirrors", help="Additional mirror URLs of the "
+                        "image, separated by spaces or commas")
+    parser.add_argument("--answers", action="append", default=[],
+                        help="Answer file for ovirt-hosted-engine-setup, "
+                        "may be given more than once")
+    parser.add_argument("--prepare-only", action="store_true",
+                        help="Retrieve the image and write the "
+                        "configuration, but don't run the setup")
+    parser.add_argument("--bandwidth", type=rate,
+                        help="Download at most this many bytes per second, "
+                        "like 10M, 0 for unlimited. It can be changed "
+                        "while downloading with "
+                        "ovirt-node-hosted-engine-setup --bandwidth")
+    parser.add_argument("--adaptive-bandwidth", action="store_true",
+                        default=None, help="Back off while the HA broker "
+                        "is slow to answer")
+    parser.add_argument("--progress", choices=("json", "text"),
+                        default="json", help="How progress is reported")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="Log to stderr")
+    args = parser.parse_args(argv)
+
+    if args.image and urlparse(args.image).scheme not in ("http", "https",
+                                                          "file"):
+        parser.error("--image has to be an http://, https:// or file:// "
+                     "URL")
+    for answers in args.answers:
+        if not os.path.isfile(answers):
+            parser.error("Answer file %s doesn't exist" % answers)
+    return args
+
+
+def retrieve(args, reporter, stop):
+    """
+    Have the image ready in HOSTED_ENGINE_SETUP_DIR
+
+    Returns
+    None once it is, or the exit code
+    """
+    if args.pxe:
+        return None
+
+    if urlparse(args.image).scheme == "file":
+        if not os.path.isfile(args.image[7:]):
+            reporter.event("failed", stage="image",
+                           error="%s doesn't exist" % args.image[7:])
+            return EXIT_IMAGE
+        return None
+
+    def tick(progress):
+        reporter.progress(progress)
+        return not stop.is_set()
+
+    retrieval = ImageRetrieval(args.image, config.HOSTED_ENGINE_SETUP_DIR,
+                               args.checksum, args.mirrors)
+    try:
+        if not retrieval.run(tick):
+            reporter.event("interrupted", stage="image",
+                           downloaded=retrieval.downloaded())
+            return EXIT_INTERRUPTED
+    except DownloadError as e:
+        reporter.event("failed", stage="image", error=str(e))
+        return EXIT_IMAGE
+    except requests.exceptions.ConnectionError as e:
+        reporter.event("failed", stage="image",
+                       error="Connection Error: %s" % e)
+        return EXIT_IMAGE
+    except TRANSFER_ERRORS as e:
+        reporter.event("failed", stage="image",
+                       error="Download Error: %s" % e)
+        return EXIT_IMAGE
+    except EnvironmentError as e:
+        reporter.event("failed", stage="image",
+                       error="Couldn't store the image: %s" % e)
+        return EXIT_IMAGE
+
+    reporter.event("image", path=retrieval.path)
+    return None
+
+
+def deploy(args, reporter, stop):
+    """
+    Returns
+    The exit code
+    """
+    reporter.event("started", image=args.image, pxe=args.pxe)
+
+    try:
+        HostedEngine().update(args.image or "", args.pxe, None,
+                              args.checksum, args.mirrors)
+    except Exception as e:
+        reporter.event("failed", stage="configure", error=str(e))
+        return EXIT_USAGE
+
+    reporter.event("stage", stage="image")
+    rc = retrieve(args, reporter, stop)
+    if rc is not None:
+        return rc
+
+    reporter.event("stage", stage="config")
+    cfg_file = make_tempfile()
+    try:
+        for element in time_transaction(HostedEngine().transaction(cfg_file)):
+            element.commit()
+    except Exception as e:
+        LOGGER.debug("Couldn't write the configuration", exc_info=True)
+        os.unlink(cfg_file)
+        reporter.event("failed", stage="config", error=str(e))
+        return EXIT_CONFIG
+    reporter.event("config", path=cfg_file)
+
+    if args.prepare_only:
+        reporter.event("done", config=cfg_file)
+        return EXIT_OK
+
+    reporter.event("stage", stage="setup")
+    argv = ["ovirt-hosted-engine-setup", "--config-append=%s" % cfg_file] + \
+        ["--config-append=%s" % a for a in args.answers]
+
+    # Whatever the setup prints goes to stderr, stdout is ours. Without a
+    # terminal to read from, a question the answers don't cover makes it
+    # fail instead of waiting forever
+    with open(os.devnull) as devnull:
+        rc = process.call(argv, stdin=devnull, stdout=sys.stderr)
+    if rc != 0:
+        reporter.event("failed", stage="setup", rc=rc)
+        return EXIT_SETUP
+
+    persist_configs()
+    reporter.event("done", config=cfg_file)
+    return EXIT_OK
+
+
+def main(argv):
+    args = parse_args(argv)
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if
+                        args.verbose else logging.WARNING)
+    reporter = Reporter(args.progress)
+    if args.bandwidth is not None or args.adaptive_bandwidth:
+        DOWNLOAD_LIMIT.set(args.bandwidth, args.adaptive_bandwidth)
+
+    # A download stops at the next tick and is resumed by the next run
+    stop = threading.Event()
+
+    def interrupt(signum, frame):
+        stop.set()
+    signal.signal(signal.SIGTERM, interrupt)
+    signal.signal(signal.SIGINT, interrupt)
+
+    try:
+        return deploy(args, reporter, stop)
+    except Exception as e:
+        LOGGER.exception("Deploy failed")
+        reporter.event("failed", error=str(e))
+        return EXIT_ERROR
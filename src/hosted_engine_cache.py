@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_cache.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from contextlib import contextmanager
+from . import config
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+"""
+Local cache of Hosted Engine images
+
+Every image is stored once under its sha256 digest in IMAGE_CACHE_DIR and
+hardlinked to the name ovirt-hosted-engine-setup expects in
+HOSTED_ENGINE_SETUP_DIR. The index remembers which URL and validators
+(ETag/Last-Modified) produced which object, so a repeated request can be
+answered with a conditional GET, and when each object was last used, so the
+least recently used ones can be evicted once the cache grows over
+IMAGE_CACHE_MAX_SIZE
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+
+def file_digest(path, algorithm="sha256"):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ImageCache(object):
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir or config.IMAGE_CACHE_DIR
+        self.max_size = config.IMAGE_CACHE_MAX_SIZE if max_size is None \
+            else max_size
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+
+    def lookup(self, url):
+        """
+        Find the cached copy of url
+
+        Returns
+        A dict with the digest and validators of the cached image, or None
+        if there is no usable copy
+        """
+        with self._locked() as index:
+            entry = index["urls"].get(url)
+            if entry and not os.path.exists(self.object_path(
+                    entry["digest"])):
+                self.__forget(index, entry["digest"])
+                entry = None
+
+        return entry
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_dir, digest)
+
+    def checkout(self, url, path):
+        """
+        Make the cached copy of url available at path and mark it as used
+
+        Returns
+        True if path now holds the cached image
+        """
+        with self._locked() as index:
+            entry = index["urls"].get(url)
+            if not entry:
+                return False
+
+            obj = self.object_path(entry["digest"])
+            if not os.path.exists(obj):
+                self.__forget(index, entry["digest"])
+                return False
+
+            self.__link(obj, path)
+            self.__touch(index, entry["digest"], path)
+
+        return True
+
+    def store(self, url, path, etag=None, last_modified=None, digest=None,
+              origin=None):
+        """
+        Add a completely downloaded image to the cache and evict the least
+        recently used images if the cache went over its size limit
+
+        url -- Where the image came from
+        path -- The downloaded image, it stays in place as a hardlink
+        etag, last_modified -- The validators the server sent
+        digest -- The sha256 of the image, computed here if not given
+        origin -- The mirror which sent the validators, if not url
+
+        Returns
+        The digest of the image
+        """
+        digest = digest or file_digest(path)
+        obj = self.object_path(digest)
+
+        with self._locked() as index:
+            if os.path.exists(obj):
+                # Same bytes from another URL, keep a single copy
+                self.__link(obj, path)
+            else:
+                os.link(path, obj)
+
+            index["urls"][url] = {"digest": digest,
+                                  "etag": etag,
+                                  "last_modified": last_modified,
+                                  "origin": origin or url}
+            self.__touch(index, digest, path)
+            self.__evict(index, keep=[digest])
+
+        return digest
+
+    def evict(self, reserve=0, keep=()):
+        """
+        Remove the least recently used images until the cache plus reserve
+        bytes fits in the size limit
+
+        keep -- Digests which must not be evicted
+        """
+        with self._locked() as index:
+            self.__evict(index, reserve, keep)
+
+    def make_room(self, amount, keep=()):
+        """
+        Remove the least recently used images until they add up to amount
+        bytes, or there is nothing left to remove
+
+        keep -- Digests which must not be evicted
+
+        Returns
+        The bytes removed
+        """
+        with self._locked() as index:
+            before = sum(o["size"] for o in index["objects"].values())
+            self.__evict(index, keep=keep, limit=max(before - amount, 0))
+            removed = before - sum(o["size"] for o in
+                                   index["objects"].values())
+        return removed
+
+    def objects(self):
+        """
+        Returns
+        A dict of the digest of every cached image to its size and the URLs
+        it was retrieved from
+        """
+        with self._locked() as index:
+            objects = dict((d, {"size": o["size"], "urls": []})
+                           for d, o in index["objects"].items()
+                           if os.path.exists(self.object_path(d)))
+            for url, entry in index["urls"].items():
+                if entry["digest"] in objects:
+                    objects[entry["digest"]]["urls"].append(url)
+        return objects
+
+    def size(self):
+        with self._locked() as index:
+            return sum(o["size"] for o in index["objects"].values())
+
+    @contextmanager
+    def _locked(self):
+        """Load the index under an exclusive lock and save it back
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        with open("%s.lock" % self.index_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.index_path) as f:
+                    index = json.load(f)
+            except (IOError, ValueError):
+                index = {}
+            index.setdefault("urls", {})
+            index.setdefault("objects", {})
+
+            yield index
+
+            tmp = "%s.tmp" % self.index_path
+            with open(tmp, "w") as f:
+                json.dump(index, f, indent=2)
+            os.rename(tmp, self.index_path)
+
+    def __link(self, obj, path):
+        if os.path.exists(path):
+            if os.path.samefile(obj, path):
+                return
+            os.unlink(path)
+        os.link(obj, path)
+
+    def __touch(self, index, digest, path):
+        entry = index["objects"].setdefault(digest, {"names": []})
+        entry["size"] = os.path.getsize(self.object_path(digest))
+        entry["atime"] = time.time()
+        if path not in entry["names"]:
+            entry["names"].append(path)
+
+    def __forget(self, index, digest):
+        obj = self.object_path(digest)
+        entry = index["objects"].pop(digest, {"names": []})
+
+        for name in entry["names"]:
+            # Only remove links which still point to the cached object, the
+            # name may have been reused for something else since
+            if os.path.exists(name) and (not os.path.exists(obj) or
+                                         os.path.samefile(name, obj)):
+                os.unlink(name)
+
+        if os.path.exists(obj):
+            os.unlink(obj)
+
+        for url in [u for u, e in index["urls"].items()
+                    if e["digest"] == digest]:
+            del index["urls"][url]
+
+    def __evict(self, index, reserve=0, keep=(), limit=None):
+        objects = index["objects"]
+        total = sum(o["size"] for o in objects.values()) + reserve
+        limit = self.max_size if limit is None else limit
+
+        for digest in sorted(objects, key=lambda d: objects[d]["atime"]):
+            if total <= limit:
+                break
+            if digest in keep:
+                continue
+
+            LOGGER.info("Evicting cached image %s (%s)" %
+                        (digest, ", ".join(objects[digest]["names"])))
+            total -= objects[digest]["size"]
+            self.__forget(index, digest)
@@ -0,0 +1,1346 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_download.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from urlparse import urlparse
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+from . import config
+from .hosted_engine_bandwidth import DOWNLOAD_LIMIT
+from .hosted_engine_cache import file_digest
+from .hosted_engine_metrics import format_duration
+from .hosted_engine_mirrors import MirrorSet, new_session
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import Queue
+import os
+import re
+import requests
+import socket
+import threading
+import time
+
+"""
+Retrieve Hosted Engine images over HTTP
+"""
+
+CHUNK_SIZE = 1024 * 256
+
+# Reads start at CHUNK_SIZE and grow or shrink between these bounds, so that
+# a single read takes about CHUNK_TIME seconds
+MIN_CHUNK_SIZE = 1024 * 64
+MAX_CHUNK_SIZE = 1024 * 1024 * 8
+CHUNK_TIME = .05
+
+POSIX_FADV_DONTNEED = 4
+
+try:
+    LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+    LIBC = None
+
+try:
+    LIBCRYPTO = ctypes.CDLL(ctypes.util.find_library("crypto") or
+                            "libcrypto.so")
+except OSError:
+    LIBCRYPTO = None
+
+# The digests libcrypto can save and restore the state of, by the prefix of
+# its functions. HASH_STATE_SIZE holds any of their contexts
+RESUMABLE_DIGESTS = {"sha256": "SHA256", "sha512": "SHA512"}
+HASH_STATE_SIZE = 256
+
+# What a mirror failing fails with. Reading a response raises urllib3's own
+# errors, such as on a reset or a stall in the middle of it
+TRANSFER_ERRORS = (requests.exceptions.RequestException, socket.error,
+                   urllib3_exceptions.HTTPError)
+
+# How many blocks of the frontier may wait to be hashed and validated
+# before the workers wait for them
+FEED_DEPTH = 8
+
+# Supported checksums, by the length of their hex digest
+DIGEST_ALGORITHMS = {64: "sha256", 128: "sha512"}
+
+
+class DownloadError(Exception):
+    """Raised when the server refuses to hand out the image. The message
+    is meant to be shown to the user
+    """
+    pass
+
+
+class InvalidImageError(DownloadError):
+    """Raised when the bytes of an image show it can't be used. The partial
+    download is discarded, there's no point in resuming it
+    """
+    pass
+
+
+class ChecksumError(InvalidImageError):
+    """Raised when a downloaded image doesn't match its expected checksum
+    """
+    pass
+
+
+class InsufficientSpaceError(DownloadError):
+    """Raised when the image doesn't fit on the disk it is downloaded to
+    """
+    pass
+
+
+def parse_checksum(value, url=None):
+    """
+    Work out the checksum an image is expected to have
+
+    value -- "sha256:<hex>", "sha512:<hex>", a bare hex digest, or the URL
+             of a sha256sum/sha512sum style file listing the image
+    url -- The URL of the image, picks its line out of a checksum file
+
+    Returns
+    An (algorithm, hexdigest) tuple, or None if value is empty
+
+    Raises DownloadError if value can't be understood
+    """
+    value = (value or "").strip()
+    if not value:
+        return None
+
+    if urlparse(value).scheme in ("http", "https"):
+        r = new_session().get(value)
+        if r.status_code != 200:
+            raise DownloadError("Cannot download the checksum file: HTTP "
+                                "error code %s" % str(r.status_code))
+        value = _checksum_from_file(r.text, url)
+
+    algorithm, digest = value.split(":", 1) if ":" in value else \
+        (None, value)
+    digest = digest.strip().lower()
+    algorithm = (algorithm or DIGEST_ALGORITHMS.get(len(digest), "")).lower()
+
+    if DIGEST_ALGORITHMS.get(len(digest)) != algorithm or \
+            not re.match(r"^[0-9a-f]+$", digest):
+        raise DownloadError("Invalid checksum: %s" % value)
+
+    return algorithm, digest
+
+
+def _checksum_from_file(text, url):
+    """Pick the digest of url out of GNU or BSD style checksum lines
+    """
+    name = os.path.basename(urlparse(url or "").path)
+    found = []
+
+    for line in text.splitlines():
+        gnu = re.match(r"^([0-9a-fA-F]+)\s+\*?(.+)$", line.strip())
+        bsd = re.match(r"^SHA\d+ \((.+)\) = ([0-9a-fA-F]+)$", line.strip())
+        if gnu:
+            digest, filename = gnu.groups()
+        elif bsd:
+            filename, digest = bsd.groups()
+        else:
+            continue
+        found.append((os.path.basename(filename.strip()), digest))
+
+    matching = [d for f, d in found if f == name]
+    if matching:
+        return matching[0]
+    if len(found) == 1:
+        return found[0][1]
+
+    raise DownloadError("The checksum file doesn't list %s" % name)
+
+
+def verify_file(path, expected, known=None):
+    """
+    Check an image which was not downloaded now, such as a cached copy
+
+    path -- The image
+    expected -- An (algorithm, hexdigest) tuple as from parse_checksum
+    known -- A dict of digests already computed for the image, by algorithm
+
+    Raises ChecksumError if the image doesn't match
+    """
+    algorithm, digest = expected
+    actual = (known or {}).get(algorithm) or file_digest(path, algorithm)
+
+    if actual != digest:
+        raise ChecksumError("Checksum mismatch for %s: expected %s:%s, got "
+                            "%s" % (os.path.basename(path), algorithm,
+                                    digest, actual))
+
+
+def _digest_functions(algorithm):
+    """
+    Returns
+    The Init, Update and Final functions of libcrypto for algorithm
+
+    Raises KeyError or AttributeError if libcrypto doesn't have them
+    """
+    prefix = RESUMABLE_DIGESTS[algorithm]
+    init, update, final = [getattr(LIBCRYPTO, prefix + name)
+                           for name in ("_Init", "_Update", "_Final")]
+    init.argtypes = [ctypes.c_void_p]
+    update.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+    final.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    return init, update, final
+
+
+class ResumableDigest(object):
+    """A digest like hashlib's, whose state can be saved with state() and
+    picked up again, by another process, by passing it back. Only there
+    where libcrypto has the functions, see resumable()
+    """
+    def __init__(self, algorithm, state=None):
+        self.algorithm = algorithm
+        self.digest_size = hashlib.new(algorithm).digest_size
+
+        init, self._update, self._final = _digest_functions(algorithm)
+        self._ctx = ctypes.create_string_buffer(HASH_STATE_SIZE)
+        if state:
+            raw = state.decode("hex")
+            if len(raw) != HASH_STATE_SIZE:
+                raise ValueError("Invalid %s state" % algorithm)
+            self._ctx.raw = raw
+        else:
+            init(self._ctx)
+
+    @staticmethod
+    def resumable(algorithm):
+        try:
+            _digest_functions(algorithm)
+        except (KeyError, AttributeError):
+            return False
+        return True
+
+    def update(self, data):
+        self._update(self._ctx, data, len(data))
+
+    def state(self):
+        return self._ctx.raw.encode("hex")
+
+    def hexdigest(self):
+        # Final wipes the context it is given, hashing may go on after this
+        ctx = ctypes.create_string_buffer(self._ctx.raw, HASH_STATE_SIZE)
+        md = ctypes.create_string_buffer(self.digest_size)
+        self._final(md, ctx)
+        return md.raw.encode("hex")
+
+
+class ImageDigests(object):
+    """The digests of an image, as one sink which knows how many bytes it
+    hashed. If every digest is resumable, their state can be saved with the
+    partial download, and a resumed download hashes on from there instead
+    of reading the image back
+
+    algorithms -- The digests to compute
+    saved -- What state() returned for the same algorithms, if anything
+    """
+    def __init__(self, algorithms, saved=None):
+        self.algorithms = sorted(algorithms)
+        self.resumable = all(ResumableDigest.resumable(a)
+                             for a in self.algorithms)
+        self.offset = 0
+
+        self._digests = None
+        self._lock = threading.Lock()
+
+        states = (saved or {}).get("states") or {}
+        if self.resumable and sorted(states) == self.algorithms:
+            try:
+                self._digests = dict((a, ResumableDigest(a, states[a]))
+                                     for a in self.algorithms)
+                self.offset = int(saved["offset"])
+            except (KeyError, TypeError, ValueError):
+                self._digests = None
+                self.offset = 0
+        if not self._digests:
+            self._digests = dict((a, ResumableDigest(a) if self.resumable
+                                  else hashlib.new(a))
+                                 for a in self.algorithms)
+
+    def update(self, data):
+        with self._lock:
+            [d.update(data) for d in self._digests.values()]
+            self.offset += len(data)
+
+    def state(self):
+        """
+        Returns
+        The number of bytes hashed and the state of every digest, for
+        ImageDigests to pick up, or None if they can't be saved
+        """
+        if not self.resumable:
+            return None
+        with self._lock:
+            return {"offset": self.offset,
+                    "states": dict((a, d.state()) for a, d in
+                                   self._digests.items())}
+
+    def hexdigest(self, algorithm):
+        with self._lock:
+            return self._digests[algorithm].hexdigest()
+
+
+class OrderedStream(object):
+    """Feeds the bytes of a file to sinks in order while the file is being
+    written, even if its bytes arrive out of order. Bytes written at the
+    frontier, the first byte the sinks didn't get yet, are passed on right
+    away. Bytes written further ahead are held in memory until the frontier
+    reaches them, whoever writes them keeps that bounded with wait().
+
+    Sinks need an update(data) method, like hashlib objects have
+
+    offset -- Where the frontier starts, the sinks already got what's before
+    feed -- Called with a sink and the bytes for it, in order, instead of
+            updating it right away, such as SinkFeeder.put
+    """
+    def __init__(self, sinks, offset=0, feed=None):
+        self.sinks = sinks
+        self.feed = feed or (lambda sink, data: sink.update(data))
+        self.offset = offset
+
+        self._pending = {}
+        self._advanced = threading.Condition()
+
+    def update(self, offset, data):
+        """Called after data was written at offset
+        """
+        with self._advanced:
+            if offset + len(data) <= self.offset:
+                return
+            if isinstance(data, memoryview):
+                # The buffer behind it is reused by the next read
+                data = data.tobytes()
+
+            if offset > self.offset:
+                if len(data) > len(self._pending.get(offset, "")):
+                    self._pending[offset] = data
+                return
+
+            self.__pass(data[self.offset - offset:])
+            ready = True
+            while ready:
+                ready = sorted(o for o in self._pending if o <= self.offset)
+                for start in ready:
+                    data = self._pending.pop(start)
+                    if start + len(data) > self.offset:
+                        self.__pass(data[self.offset - start:])
+            self._advanced.notify_all()
+
+    def held(self):
+        """
+        Returns
+        The number of bytes waiting for the frontier
+        """
+        with self._advanced:
+            return sum(len(d) for d in self._pending.values())
+
+    def wait(self, offset, timeout=None):
+        """
+        Wait, at most timeout seconds, for the frontier to reach offset
+
+        Returns
+        True if it did
+        """
+        with self._advanced:
+            if self.offset < offset:
+                self._advanced.wait(timeout)
+            return self.offset >= offset
+
+    def __pass(self, data):
+        [self.feed(sink, data) for sink in self.sinks]
+        self.offset += len(data)
+
+
+class BlockQueue(object):
+    """Hands out the bytes still missing from an image as blocks, in order,
+    to the workers retrieving them. With a stream, a block is only handed
+    out once it starts less than window bytes past the frontier of the
+    stream, which bounds what the stream holds in memory
+
+    ranges -- The inclusive (start, end) ranges to retrieve, a single range
+              may end with None when the size isn't known
+    block_size -- Split the ranges into blocks of at most this many bytes,
+                  they are handed out whole if None
+    """
+    def __init__(self, ranges, block_size=None, stream=None, window=None):
+        self.blocks = [(first, min(first + block_size - 1, end))
+                       for start, end in ranges
+                       for first in xrange(start, end + 1, block_size)] \
+            if block_size else list(ranges)
+        self.stream = stream
+        self.window = window
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def take(self, stopped):
+        """
+        stopped -- Checked while waiting, nothing is handed out once it
+                   returns True
+
+        Returns
+        The next inclusive (start, end) block, or None if there are none
+        left or the transfer stopped
+        """
+        while not stopped():
+            with self._lock:
+                if not self.blocks:
+                    return None
+                start = self.blocks[0][0]
+                if not self.stream or start - self.stream.offset < \
+                        self.window:
+                    return self.blocks.pop(0)
+
+            self.stream.wait(start - self.window + 1,
+                             config.PROGRESS_INTERVAL)
+        return None
+
+
+class SinkFeeder(threading.Thread):
+    """Updates the sinks of an OrderedStream on a thread of its own, in the
+    order their bytes were handed over, so hashing and validating never
+    hold up the threads doing I/O. A worker running more than FEED_DEPTH
+    blocks ahead waits for it.
+
+    What a sink raises is raised by the next put() and by finish()
+    """
+    def __init__(self, depth=None):
+        super(SinkFeeder, self).__init__(name="download-digest")
+        self.daemon = True
+        self.error = None
+
+        self._queue = Queue.Queue(depth or FEED_DEPTH)
+
+    def put(self, sink, data):
+        if self.error:
+            raise self.error
+        self._queue.put((sink, data))
+
+    def finish(self):
+        """Wait until every sink got its bytes
+        """
+        self.stop()
+        if self.error:
+            raise self.error
+
+    def stop(self):
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+
+    def run(self):
+        for sink, data in iter(self._queue.get, None):
+            if self.error:
+                # Keep draining, so no worker blocks on a full queue
+                continue
+            try:
+                sink.update(data)
+            except Exception as e:
+                self.error = e
+
+
+def preallocate(path, size):
+    """
+    Allocate size bytes for path up front, so a large image doesn't end up
+    fragmented all over the disk. Falls back to a sparse file where
+    fallocate isn't supported
+
+    Raises OSError if the space can't be allocated, such as ENOSPC
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        if LIBC and LIBC.fallocate(fd, 0, ctypes.c_int64(0),
+                                   ctypes.c_int64(size)) == 0:
+            return
+
+        err = ctypes.get_errno() if LIBC else 0
+        if err not in (0, errno.EOPNOTSUPP, errno.ENOSYS):
+            raise OSError(err, os.strerror(err), path)
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def free_space(path):
+    """
+    Returns
+    The bytes which can still be allocated on the filesystem of path
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def allocated_size(path):
+    """
+    Returns
+    The bytes allocated to path on disk, which is less than its size if it
+    is sparse
+    """
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+
+def format_size(size):
+    """Format a number of bytes as B, KB, MB or GB
+    """
+    size = float(size)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return "%0.2f %s" % (size, unit)
+
+
+class Progress(object):
+    """What the user is told about a running Transfer. The speed is an
+    exponentially weighted moving average of the throughput between
+    samples, so it follows changes without jumping around on every one
+    """
+    speed = None
+
+    def __init__(self, transfer, smoothing=None):
+        self.transfer = transfer
+        self.smoothing = smoothing or config.PROGRESS_SMOOTHING
+        self._last = (time.time(), transfer.downloaded)
+
+    def sample(self):
+        now, downloaded = time.time(), self.transfer.downloaded
+        elapsed = now - self._last[0]
+        if elapsed <= 0:
+            return
+
+        rate = (downloaded - self._last[1]) / elapsed
+        self.speed = rate if self.speed is None else \
+            self.smoothing * rate + (1 - self.smoothing) * self.speed
+        self._last = (now, downloaded)
+
+    def percent(self):
+        # Without a size (chunked transfers) there's no way to tell
+        if not self.transfer.size:
+            return 0
+        return int(100.0 * self.transfer.downloaded / self.transfer.size)
+
+    def eta(self):
+        """
+        Returns
+        The estimated number of seconds left, or None if it's unknown
+        """
+        if not self.transfer.size or not self.speed:
+            return None
+        return (self.transfer.size - self.transfer.downloaded) / self.speed
+
+    def __str__(self):
+        status = "%s/s" % format_size(self.speed or 0)
+        if self.eta() is not None:
+            status += ", %s left" % format_duration(self.eta())
+        return status
+
+
+class PartialState(object):
+    """The sidecar of a partial download. It records where the image came
+    from, the validators the server sent for it and which byte ranges
+    already made it to disk, so an interrupted download can continue
+    where it stopped. origin is the mirror the validators came from, and
+    digests the saved state of ImageDigests
+    """
+    def __init__(self, path, url, size=None, etag=None, last_modified=None,
+                 done=None, origin=None, digests=None):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.done = [tuple(r) for r in done or []]
+        self.origin = origin or url
+        self.digests = digests
+
+    @classmethod
+    def load(cls, path, url):
+        """
+        Read the sidecar at path
+
+        Returns
+        A PartialState, or None if there is no usable sidecar for url
+        """
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if state.get("url") != url:
+            return None
+
+        return cls(path, url, state.get("size"), state.get("etag"),
+                   state.get("last_modified"), state.get("done"),
+                   state.get("origin"), state.get("digests"))
+
+    def validator(self):
+        """The value to send as If-Range, weak ETags aren't allowed there
+        """
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+    def resumable(self):
+        return bool(self.size and self.validator())
+
+    def add(self, start, end):
+        """Mark the inclusive range start-end as written
+        """
+        merged = []
+        for first, last in sorted(self.done + [(start, end)]):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+            else:
+                merged.append((first, last))
+        self.done = merged
+
+    def truncate(self, offset):
+        """Forget what was written from offset on
+        """
+        self.done = [(start, min(end, offset - 1))
+                     for start, end in self.done if start < offset]
+
+    def prefix(self):
+        """
+        Returns
+        The number of bytes written from the start of the image on, without
+        a gap
+        """
+        return self.done[0][1] + 1 if self.done and self.done[0][0] == 0 \
+            else 0
+
+    def completed(self):
+        return sum(end - start + 1 for start, end in self.done)
+
+    def missing(self):
+        """
+        Returns
+        A list of inclusive (start, end) ranges which still have to be
+        retrieved
+        """
+        missing = []
+        offset = 0
+        for start, end in self.done:
+            if start > offset:
+                missing.append((offset, start - 1))
+            offset = end + 1
+        if offset < self.size:
+            missing.append((offset, self.size - 1))
+        return missing
+
+    def save(self):
+        tmp = "%s.tmp" % self.path
+        with open(tmp, "w") as f:
+            json.dump({"url": self.url,
+                       "size": self.size,
+                       "etag": self.etag,
+                       "last_modified": self.last_modified,
+                       "done": self.done,
+                       "origin": self.origin,
+                       "digests": self.digests}, f)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class Transfer(object):
+    """A single image download. If the server advertises range support,
+    the image is split into blocks which are retrieved over parallel
+    connections, each one writing into its own offset of the target file.
+    Otherwise it is streamed over a single connection.
+
+    Bytes land in a partial file next to the target, and the state of the
+    download is kept in a sidecar so a later Transfer of the same URL
+    continues from where this one stopped, unless the remote image changed.
+
+    The sha256 of the image, and the expected checksum if one was given,
+    are computed while the bytes stream in, from memory. Their state is
+    saved in the sidecar, the bytes written past what they hashed are
+    retrieved again on resume. If a validator is given, it is fed the bytes
+    in order with update(), is told the image is complete with finish(),
+    and can reject the image at any point by raising an InvalidImageError.
+    An image which is rejected or doesn't match the expected checksum is
+    discarded, and the validator's discard() is called. What the validator
+    made of the bytes before a resume can't be saved, so resumed downloads
+    aren't validated and validator is None then.
+
+    If mirrors are given, the initial request goes to the fastest mirror,
+    and every block is retrieved from whichever mirror has capacity. A block
+    moves to another mirror when its mirror fails or falls far behind
+
+    Every connection takes its bytes out of limit, DOWNLOAD_LIMIT unless
+    given, so the transfer as a whole stays within its bandwidth
+    """
+    size = None
+    encoding = None
+    ranged = False
+    not_modified = False
+
+    def __init__(self, url, path, connections=None, cached=None,
+                 checksum=None, validator=None, mirrors=None, limit=None):
+        self.url = url
+        self.mirrors = mirrors or MirrorSet([url])
+        self.cached = cached
+        self.checksum = checksum
+        self.validator = validator
+        self.path = path
+        self.partial = "%s.part" % path
+        self.connections = connections or config.DOWNLOAD_CONNECTIONS
+        self.limit = limit or DOWNLOAD_LIMIT
+
+        # Bytes on disk, and how many of them were there before we started
+        self.downloaded = 0
+        self.initial = 0
+
+        self._algorithms = set(["sha256", (checksum or ["sha256"])[0]])
+        self._feeder = SinkFeeder()
+        self._digests = None
+        self._stream = None
+
+        self.state = None
+        self._reserved = False
+        self._offset = 0
+        self._response = None
+        self._mirror = None
+        self._saved = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._errors = []
+
+    def open(self):
+        """
+        Send the initial request and find out how the image can be
+        retrieved. If a cached copy exists, make the request conditional on
+        it, and set not_modified if the server says it's still current.
+        Otherwise, if a partial download of the same image exists, ask the
+        server for the rest of it only
+
+        Raises DownloadError if the server doesn't return the image
+        """
+        state = PartialState.load("%s.json" % self.partial, self.url)
+        if not os.path.exists(self.partial) or \
+                (state and not state.resumable()):
+            state = None
+
+        digests = ImageDigests(self._algorithms, state and state.digests)
+        if state:
+            # What was written past the saved digests is retrieved again,
+            # that's cheaper than reading it back. Without them, only what
+            # can be read back in one go is kept
+            state.truncate(digests.offset if digests.resumable else
+                           state.prefix())
+
+        headers = {}
+        origin = None
+        if self.cached:
+            state = None
+            origin = self.cached.get("origin")
+            headers = dict((k, v) for k, v in
+                           (("If-None-Match", self.cached.get("etag")),
+                            ("If-Modified-Since",
+                             self.cached.get("last_modified"))) if v)
+        elif state and state.missing():
+            origin = state.origin
+            headers = {"Range": "bytes=%d-" % state.missing()[0][0],
+                       "If-Range": state.validator()}
+
+        if len(self.mirrors) > 1 and not self.cached:
+            self.mirrors.probe()
+
+        mirror, r = self.__request_any(headers, self.mirrors.find(origin))
+        if state and mirror.url != state.origin:
+            # Validators are only good for the mirror which sent them, the
+            # image is started over from the one which answered
+            state = None
+            if r.status_code == 206:
+                r.close()
+                r = new_session().get(mirror.url, stream=True,
+                                      timeout=self.__timeout())
+
+        if self.cached and r.status_code == 304:
+            r.close()
+            self.not_modified = True
+            return
+
+        if state and r.status_code == 206 and \
+                self.__total_size(r) != state.size:
+            # Same validators but a different size, don't trust either
+            r.close()
+            r = new_session().get(mirror.url, stream=True,
+                                  timeout=self.__timeout())
+
+        if state and r.status_code == 206:
+            self.state = state
+            self.size = state.size
+            self.ranged = self.connections > 1
+            self._offset = state.missing()[0][0]
+            if digests.offset:
+                self.validator = None
+
+        elif r.status_code == 200:
+            # Either nothing was there, or the image changed on the server
+            # since the partial download was written. Start over
+            self.__discard()
+
+            size = r.headers.get('content-length')
+            self.size = int(size) if size else None
+
+            # Size isn't specified if it's chunked
+            self.encoding = r.headers.get('transfer-encoding') if not size \
+                else None
+
+            self.ranged = bool(self.size and self.connections > 1 and
+                               r.headers.get('accept-ranges', '').lower() ==
+                               'bytes')
+            self.state = PartialState("%s.json" % self.partial, self.url,
+                                      self.size, r.headers.get('etag'),
+                                      r.headers.get('last-modified'),
+                                      origin=mirror.url)
+
+        else:
+            r.close()
+            raise DownloadError("Cannot download the file: HTTP error "
+                                "code %s" % str(r.status_code))
+
+        if self.state is not state:
+            digests = ImageDigests(self._algorithms)
+        self._digests = digests
+        self._stream = OrderedStream([digests] + ([self.validator] if
+                                                  self.validator else []),
+                                     digests.offset, self._feeder.put)
+
+        self.downloaded = self.initial = self.state.completed()
+        self._response = r
+        self._mirror = mirror
+        mirror.validator = self.state.validator()
+
+    def reserve(self, make_room=None):
+        """
+        Make sure the rest of the image, and DOWNLOAD_HEADROOM bytes on top
+        of it, fit on the disk, and allocate the image up front. Called by
+        run() unless it was already, open() must be called first
+
+        make_room -- Called with the number of bytes missing, if any, to
+                     free what it can before the image is given up on
+
+        Raises InsufficientSpaceError if the image doesn't fit
+        """
+        directory = os.path.dirname(os.path.abspath(self.partial))
+        size = self.size or self.mirrors.size
+        needed = max((size or 0) - allocated_size(self.partial), 0) + \
+            config.DOWNLOAD_HEADROOM
+
+        free = free_space(directory)
+        if needed > free and make_room:
+            make_room(needed - free)
+            free = free_space(directory)
+        if needed > free:
+            if self._response:
+                self._response.close()
+            raise InsufficientSpaceError(
+                "Not enough disk space for the image: %s are needed in %s, "
+                "%s are free" % (format_size(needed), directory,
+                                 format_size(free)))
+
+        if not os.path.exists(self.partial):
+            open(self.partial, 'wb').close()
+        if self.size:
+            # Every range is written at its offset of the preallocated file
+            try:
+                preallocate(self.partial, self.size)
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                if self._response:
+                    self._response.close()
+                if not self.initial:
+                    self.__discard()
+                raise InsufficientSpaceError(
+                    "Not enough disk space for the image in %s" % directory)
+        self._reserved = True
+
+    def run(self, tick):
+        """
+        Retrieve the image into self.path. open() must be called first
+
+        The bytes are copied by worker threads which do nothing but I/O.
+        They hand them to an OrderedStream, which passes them on in order
+        to a SinkFeeder thread which hashes and validates them, while the
+        calling thread wakes up every PROGRESS_INTERVAL seconds to save the
+        sidecar and report.
+
+        Raises InvalidImageError as soon as the checksum or the validator
+        rejects the image, and discards it. Raises InsufficientSpaceError
+        if the image doesn't fit, and discards it if the disk filled up
+        while it was being written
+
+        tick -- Called with a Progress on every wakeup. If it returns False
+                the download is aborted
+
+        Returns
+        True if the image was completely retrieved, False if aborted. The
+        partial download is kept in both cases unless it completed
+        """
+        try:
+            if not self.__supervise(self.__workers(), tick):
+                self._checkpoint(force=True)
+                return False
+
+            self._feeder.finish()
+            if self.size and self._digests.offset != self.size:
+                raise DownloadError("Cannot download the file: %d of its "
+                                    "%d bytes were hashed" %
+                                    (self._digests.offset, self.size))
+            self.__verify()
+        except InvalidImageError:
+            # Resuming this would only produce the same broken image
+            self._stopped.set()
+            self.__discard()
+            raise
+        except InsufficientSpaceError:
+            # From reserve(), before anything was transferred
+            raise
+        except EnvironmentError as e:
+            if e.errno != errno.ENOSPC:
+                self._checkpoint(force=True)
+                raise
+            # Left behind, the partial image would keep the node short of
+            # space, and resuming it needs space which isn't there
+            self._stopped.set()
+            self.__discard()
+            raise InsufficientSpaceError("The disk filled up while the "
+                                         "image was being downloaded")
+        except:
+            self._checkpoint(force=True)
+            raise
+        finally:
+            self._feeder.stop()
+
+        os.rename(self.partial, self.path)
+        self.state.remove()
+
+        return True
+
+    def digest(self, algorithm):
+        return self._digests.hexdigest(algorithm)
+
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def _advance(self, offset, data):
+        """Account for data which was just written at offset
+        """
+        with self._lock:
+            self.downloaded += len(data)
+            self.state.add(offset, offset + len(data) - 1)
+
+        self._stream.update(offset, data)
+
+    def _initial(self, start):
+        """
+        Returns
+        The response to the initial request and its mirror, if it streams
+        from start and no block took it yet, or (None, None)
+        """
+        with self._lock:
+            if start != self._offset or not self._response:
+                return None, None
+            r, mirror = self._response, self._mirror
+            self._response = self._mirror = None
+            return r, mirror
+
+    def _fail(self, e):
+        self._errors.append(e)
+        self._stopped.set()
+
+    def _checkpoint(self, force=False):
+        """Save the sidecar, at most once a second unless forced. Forcing
+        it waits for the bytes handed to the SinkFeeder to be hashed
+        """
+        if not self.state or not self.state.resumable():
+            return
+
+        now = time.time()
+        if force or now - self._saved >= 1:
+            if force:
+                self._feeder.stop()
+            with self._lock:
+                self.state.digests = self._digests.state()
+                self.state.save()
+            self._saved = now
+
+    def __workers(self):
+        missing = self.state.missing() if self.size else []
+        block_size = config.DOWNLOAD_BLOCK_SIZE
+        blocks = BlockQueue(missing, block_size, self._stream,
+                            block_size * config.DOWNLOAD_WINDOW *
+                            self.connections) \
+            if self.ranged and missing else []
+
+        if not self._reserved:
+            self.reserve()
+        self._feeder.start()
+        if self._stream.offset < self._offset:
+            self.__read_back(self._stream.offset, self._offset)
+
+        if len(blocks) > 1:
+            # The initial response already streams from the first missing
+            # byte, so whichever worker takes the first block takes it over
+            # instead of opening a new connection
+            return [RangeWorker(self, blocks, i)
+                    for i in range(min(self.connections, len(blocks)))]
+
+        return [RangeWorker(self, BlockQueue(
+            [(self._offset, self.size - 1 if self.size else None)]), 0)]
+
+    def __read_back(self, start, end):
+        """Hash what an earlier download wrote from start to end, when the
+        state of its digests couldn't be saved
+        """
+        with open(self.partial, 'rb') as f:
+            f.seek(start)
+            while start < end:
+                data = f.read(min(MAX_CHUNK_SIZE, end - start))
+                if not data:
+                    raise DownloadError("The partial image is shorter than "
+                                        "its sidecar says")
+                self._stream.update(start, data)
+                start += len(data)
+
+    def __supervise(self, workers, tick):
+        [w.start() for w in workers]
+        progress = Progress(self)
+
+        alive = workers
+        while alive:
+            alive[0].join(config.PROGRESS_INTERVAL)
+
+            if self._feeder.error:
+                self._fail(self._feeder.error)
+            self._checkpoint()
+            progress.sample()
+            if not self.stopped() and not tick(progress):
+                self._stopped.set()
+
+            alive = [w for w in workers if w.is_alive()]
+
+        if self._errors:
+            raise self._errors[0]
+
+        return not self.stopped()
+
+    def __request_any(self, headers, preferred=None):
+        """
+        Send the initial request to preferred, or the best mirror, and to
+        the next best ones if it fails
+
+        Returns
+        The mirror which answered, and its response
+        """
+        tried = []
+        error = DownloadError("None of the mirrors of the image can be "
+                              "reached")
+        while True:
+            mirror = preferred if preferred and preferred.usable() and \
+                preferred not in tried else self.mirrors.best(tried)
+            if not mirror:
+                raise error
+            tried.append(mirror)
+
+            try:
+                r = new_session().get(mirror.url, stream=True,
+                                      headers=headers,
+                                      timeout=self.__timeout())
+            except requests.exceptions.RequestException as e:
+                self.mirrors.failed(mirror, e)
+                error = e
+                continue
+
+            if r.status_code in (200, 206, 304) or len(self.mirrors) == 1:
+                return mirror, r
+
+            r.close()
+            error = DownloadError("Cannot download the file: HTTP error code"
+                                  " %s" % str(r.status_code))
+            self.mirrors.failed(mirror, error)
+
+    def __timeout(self):
+        # Without anywhere else to go, a slow server is still waited for
+        return config.MIRROR_TIMEOUT if len(self.mirrors) > 1 else None
+
+    def __total_size(self, r):
+        m = re.match(r"bytes \d+-\d+/(\d+)", r.headers.get('content-range',
+                                                           ''))
+        return int(m.group(1)) if m else None
+
+    def __verify(self):
+        if self.validator:
+            self.validator.finish()
+
+        if self.checksum:
+            algorithm = self.checksum[0]
+            verify_file(self.path, self.checksum,
+                        {algorithm: self.digest(algorithm)})
+
+    def __discard(self):
+        if self.validator:
+            self.validator.discard()
+        [os.unlink(p) for p in (self.partial, "%s.json" % self.partial)
+         if os.path.exists(p)]
+
+
+class ImageWriter(object):
+    """Writes a stream of buffers at an offset of the partial image,
+    without going through a Python file buffer.
+
+    With drop_cache, written data is flushed and dropped from the page cache
+    every DROP_CACHE_SIZE bytes, so a large image doesn't push the working
+    set of the node out of memory
+    """
+    def __init__(self, path, offset, drop_cache=None):
+        self.path = path
+        self.offset = offset
+        self.drop_cache = config.DOWNLOAD_DROP_CACHE if drop_cache is None \
+            else drop_cache
+
+        self._dropped = offset
+        self._fd = os.open(path, os.O_WRONLY)
+        os.lseek(self._fd, offset, os.SEEK_SET)
+
+    def write(self, view):
+        written = 0
+        while written < len(view):
+            written += os.write(self._fd, view[written:])
+        self.offset += written
+
+        if self.drop_cache and \
+                self.offset - self._dropped >= config.DROP_CACHE_SIZE:
+            self.__drop()
+
+    def close(self):
+        if self.drop_cache:
+            self.__drop()
+        os.close(self._fd)
+
+    def __drop(self):
+        os.fdatasync(self._fd)
+        if LIBC:
+            LIBC.posix_fadvise(self._fd, ctypes.c_int64(self._dropped),
+                               ctypes.c_int64(self.offset - self._dropped),
+                               POSIX_FADV_DONTNEED)
+        self._dropped = self.offset
+
+
+def read_into(raw, view):
+    """Read from a response into a buffer, without allocating a new string
+    where the HTTP library can avoid it
+    """
+    readinto = getattr(raw, "readinto", None)
+    if readinto:
+        return readinto(view)
+
+    data = raw.read(len(view))
+    view[:len(data)] = data
+    return len(data)
+
+
+class RangeWorker(threading.Thread):
+    """Retrieves the blocks of a Transfer it takes from a BlockQueue into
+    their offset of the target file, one after the other, until none are
+    left. If a block ends with None, everything the response returns is
+    written.
+
+    With more than one mirror, the rest of a block is requested from
+    another mirror when the current one fails or is degraded
+    """
+    def __init__(self, transfer, blocks, index):
+        super(RangeWorker, self).__init__(name="download-%d" % index)
+        self.daemon = True
+        self.transfer = transfer
+        self.blocks = blocks
+        self.start_byte = None
+        self.end_byte = None
+
+    def run(self):
+        try:
+            while True:
+                block = self.blocks.take(self.transfer.stopped)
+                if not block:
+                    return
+                self.start_byte, self.end_byte = block
+                self.__run(*self.transfer._initial(self.start_byte))
+        except Exception as e:
+            self.transfer._fail(e)
+
+    def __request(self, mirror, offset):
+        byte_range = "%d-%d" % (offset, self.end_byte)
+        headers = {"Range": "bytes=%s" % byte_range}
+
+        validator = mirror.validator
+        if validator:
+            headers["If-Range"] = validator
+
+        r = new_session().get(mirror.url, stream=True, headers=headers,
+                              timeout=self.__timeout())
+        content_range = r.headers.get('content-range', '')
+
+        if r.status_code == 200 and validator:
+            r.close()
+            raise DownloadError("The image changed on the server while it "
+                                "was being downloaded, please try again")
+
+        if r.status_code != 206 or \
+                not content_range.startswith("bytes %s/" % byte_range):
+            r.close()
+            raise DownloadError("Cannot download the file: the server "
+                                "didn't honour the range request (HTTP "
+                                "code %s)" % str(r.status_code))
+
+        if self.transfer.size and \
+                content_range != "bytes %s/%d" % (byte_range,
+                                                  self.transfer.size):
+            r.close()
+            raise DownloadError("Cannot download the file: %s serves an "
+                                "image of another size" % mirror.url)
+        return r
+
+    def __run(self, r, mirror):
+        mirrors = self.transfer.mirrors
+        if mirror:
+            mirrors.hold(mirror)
+
+        offset = self.start_byte
+        avoid = []
+        while True:
+            if not mirror:
+                mirror = mirrors.acquire(avoid) or mirrors.acquire()
+                if not mirror:
+                    raise DownloadError("None of the mirrors of the image "
+                                        "can be reached")
+            try:
+                if not r:
+                    r = self.__request(mirror, offset)
+
+                offset = self.__copy(r, mirror, offset)
+                if self.end_byte is None or offset > self.end_byte or \
+                        self.transfer.stopped():
+                    mirrors.succeeded(mirror)
+                    return
+
+                # Degraded, the rest comes from elsewhere
+                avoid = [mirror]
+
+            except TRANSFER_ERRORS + (DownloadError,) as e:
+                if self.end_byte is None or len(mirrors) == 1 or \
+                        isinstance(e, InvalidImageError):
+                    raise
+                mirrors.failed(mirror, e)
+                avoid = [mirror]
+
+            finally:
+                if r:
+                    r.close()
+                if mirror:
+                    mirrors.release(mirror)
+                r, mirror = None, None
+
+    def __copy(self, r, mirror, offset):
+        """
+        Write what r returns at offset
+
+        Returns
+        The offset reached, when the block is complete, the transfer was
+        stopped or mirror is degraded
+        """
+        mirrors = self.transfer.mirrors
+
+        # One buffer is reused for every read of this block
+        buf = bytearray(MAX_CHUNK_SIZE)
+        size = CHUNK_SIZE
+        measured, measured_since = 0, time.time()
+
+        writer = ImageWriter(self.transfer.partial, offset)
+        try:
+            while (self.end_byte is None or offset <= self.end_byte) \
+                    and not self.transfer.stopped():
+                if self.end_byte is not None:
+                    size = min(size, self.end_byte - offset + 1)
+                view = memoryview(buf)[:size]
+
+                # Waiting for the bandwidth counts as reading, so reads
+                # shrink and stop requests stay responsive when limited
+                started = time.time()
+                length = read_into(r.raw, view)
+                self.transfer.limit.consume(length)
+                elapsed = time.time() - started
+
+                if not length and self.end_byte is None:
+                    break
+                elif not length:
+                    raise DownloadError("Connection closed while "
+                                        "downloading bytes %d-%d" %
+                                        (self.start_byte, self.end_byte))
+
+                writer.write(view[:length])
+                self.transfer._advance(offset, view[:length])
+                offset += length
+
+                size = self.__next_size(size, length, elapsed)
+
+                measured += length
+                if len(mirrors) > 1 and self.end_byte is not None and \
+                        time.time() - measured_since >= \
+                        config.MIRROR_CHECK_INTERVAL:
+                    mirrors.report(mirror, measured,
+                                   time.time() - measured_since)
+                    measured, measured_since = 0, time.time()
+                    if self.end_byte - offset >= config.DOWNLOAD_BLOCK_SIZE \
+                            and mirrors.degraded(mirror):
+                        return offset
+        finally:
+            writer.close()
+
+        return offset
+
+    def __timeout(self):
+        return config.MIRROR_TIMEOUT if len(self.transfer.mirrors) > 1 \
+            else None
+
+    def __next_size(self, size, length, elapsed):
+        """Grow reads while they fill the buffer quickly and shrink them
+        when they take long, which keeps stop requests responsive
+        """
+        if length == size and elapsed < CHUNK_TIME / 2:
+            return min(size * 2, MAX_CHUNK_SIZE)
+        elif elapsed > CHUNK_TIME * 2:
+            return max(size // 2, MIN_CHUNK_SIZE)
+        return size
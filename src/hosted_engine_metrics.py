@@ -0,0 +1,297 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_metrics.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from contextlib import contextmanager
+from functools import wraps
+from . import config
+
+import __builtin__
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+"""
+Timing of the deploy flow
+
+Every span is logged as a structured record, and aggregated per name and
+labels into a Prometheus textfile, which node_exporter's textfile collector
+picks up from METRICS_TEXTFILE
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+PREFIX = "ovirt_node_hosted_engine_span"
+
+# Profiles the startup of the plugin like STARTUP_PROFILE, without changing
+# the configuration
+PROFILE_ENV = "OVIRT_NODE_HOSTED_ENGINE_PROFILE"
+
+
+class Registry(object):
+    """Counts, total and latest duration, and errors of every span seen by
+    this process. The textfile is rewritten at most every
+    METRICS_WRITE_INTERVAL seconds
+    """
+    def __init__(self, path=None):
+        self.path = path or config.METRICS_TEXTFILE
+        self.spans = {}
+
+        self._lock = threading.Lock()
+        self._written = 0
+        self._timer = None
+
+    def record(self, name, labels, duration, error=False):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            span = self.spans.setdefault(key, {"count": 0, "sum": 0.0,
+                                               "last": 0.0, "errors": 0})
+            span["count"] += 1
+            span["sum"] += duration
+            span["last"] = duration
+            span["errors"] += 1 if error else 0
+
+            if self._timer:
+                return
+            wait = self._written + config.METRICS_WRITE_INTERVAL - time.time()
+            if wait > 0:
+                # Written once the interval is over, with whatever else
+                # was recorded until then
+                self._timer = threading.Timer(wait, self.write)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+
+        self.write()
+
+    def render(self):
+        """
+        Returns
+        The spans in the Prometheus text exposition format
+        """
+        families = (("seconds", "summary", "Time spent in a span"),
+                    ("last_seconds", "gauge", "Duration of the latest span"),
+                    ("errors_total", "counter", "Spans which raised"))
+        with self._lock:
+            spans = sorted(self.spans.items())
+
+        lines = []
+        for suffix, kind, text in families:
+            metric = "%s_%s" % (PREFIX, suffix)
+            lines.extend(["# HELP %s %s" % (metric, text),
+                          "# TYPE %s %s" % (metric, kind)])
+            for (name, labels), span in spans:
+                selector = _labels((("span", name),) + labels)
+                if suffix == "seconds":
+                    lines.append("%s_sum%s %f" % (metric, selector,
+                                                  span["sum"]))
+                    lines.append("%s_count%s %d" % (metric, selector,
+                                                    span["count"]))
+                elif suffix == "last_seconds":
+                    lines.append("%s%s %f" % (metric, selector,
+                                              span["last"]))
+                else:
+                    lines.append("%s%s %d" % (metric, selector,
+                                              span["errors"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Replace the textfile at once, node_exporter must never see half
+        of it
+        """
+        self._written = time.time()
+        self._timer = None
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp, "w") as f:
+                f.write(self.render())
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            LOGGER.debug("Couldn't write metrics to %s" % self.path,
+                         exc_info=True)
+
+
+def _labels(pairs):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+            .replace("\n", "\\n")
+
+    return "{%s}" % ",".join('%s="%s"' % (k, escape(v)) for k, v in pairs)
+
+
+REGISTRY = Registry()
+
+
+@atexit.register
+def _flush():
+    # A pending write would otherwise fire while the interpreter is torn
+    # down, or never
+    timer = REGISTRY._timer
+    if timer:
+        timer.cancel()
+    if REGISTRY.spans:
+        REGISTRY.write()
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    Time the block it wraps
+
+    name -- What is timed, like "download.transfer"
+    labels -- Further details to aggregate by, keep their values few
+    """
+    began = time.time()
+    error = False
+    try:
+        yield
+    except:
+        error = True
+        raise
+    finally:
+        duration = time.time() - began
+        LOGGER.info("span %s" % json.dumps({"span": name,
+                                            "labels": labels,
+                                            "start": began,
+                                            "duration": duration,
+                                            "error": error},
+                                           sort_keys=True))
+        REGISTRY.record(name, labels, duration, error)
+
+
+def timed(name, **labels):
+    """Decorator which times every call of a function as a span
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def time_transaction(txs):
+    """Time the commit of every element of a utils.Transaction, each as a
+    span named after the element
+    """
+    for element in txs:
+        element.commit = timed("transaction.commit",
+                               element=type(element).__name__)(
+            element.commit)
+    return txs
+
+
+def format_duration(seconds):
+    """Format a number of seconds as 59s, 4m 05s or 1h 02m. Kept here,
+    without dependencies, so the page can show durations without loading
+    the download code
+    """
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh %02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm %02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+class ImportProfile(object):
+    """Times every module imported while it is active, and what it imported
+    in turn, like python -X importtime does on later Pythons
+    """
+    def __init__(self):
+        # (depth, name, seconds including the modules it imported, seconds
+        # of its own), every module after the ones it imported
+        self.modules = []
+        self._stack = []
+        self._import = None
+
+    def __enter__(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self.__timed
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self._import
+
+    def __timed(self, name, globals=None, locals=None, fromlist=None,
+                level=-1):
+        loaded = len(sys.modules)
+        self._stack.append(0.0)
+        began = time.time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - began
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if len(sys.modules) > loaded:
+                # from . import config is named like .config
+                self.modules.append((len(self._stack), name or "." +
+                                     ",".join(fromlist or ()), elapsed,
+                                     elapsed - nested))
+
+    def report(self, threshold=.0005):
+        """
+        Returns
+        A line per module which took at least threshold seconds, indented
+        under the module which imported it
+        """
+        lines = ["%9s %9s  module" % ("total ms", "own ms")]
+        lines.extend("%9.1f %9.1f  %s%s" % (total * 1000, own * 1000,
+                                            "  " * depth, name)
+                     for depth, name, total, own in self.modules
+                     if total >= threshold)
+        return "\n".join(lines)
+
+
+# The steps of the startup profiled so far, as (name, seconds, profile)
+STARTUP = []
+
+
+@contextmanager
+def profile_startup(name):
+    """
+    Time a step of the TUI startup as a span, and every module imported in
+    it, and log them. Only with STARTUP_PROFILE, or PROFILE_ENV in the
+    environment, otherwise the step runs as it is
+    """
+    if not config.STARTUP_PROFILE and not os.environ.get(PROFILE_ENV):
+        yield
+        return
+
+    profile = ImportProfile()
+    began = time.time()
+    with span(name):
+        with profile:
+            yield
+    duration = time.time() - began
+    STARTUP.append((name, duration, profile))
+
+    LOGGER.info("%s took %.1f ms:\n%s" % (name, duration * 1000,
+                                          profile.report()))
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_mirrors.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from urlparse import urlparse
+from xml.etree import ElementTree
+from . import config
+
+import logging
+import re
+import requests
+import threading
+import time
+
+"""
+The servers an image can be retrieved from, and how well they do
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+METALINK_SUFFIXES = (".meta4", ".metalink")
+
+# Metalink hash types, as named by hashlib
+METALINK_HASHES = {"sha-256": "sha256", "sha256": "sha256",
+                   "sha-512": "sha512", "sha512": "sha512"}
+
+
+def new_session():
+    s = requests.Session()
+
+    # Don't let apache transparently deflate gzips
+    del s.headers["Accept-Encoding"]
+
+    return s
+
+
+def is_metalink(url):
+    return urlparse(url or "").path.endswith(METALINK_SUFFIXES)
+
+
+def image_name(url):
+    """
+    Returns
+    The name an image from url is saved as, a metalink document describing
+    appliance.ova is expected to be called appliance.ova.meta4
+    """
+    name = url.split("/")[-1]
+    for suffix in METALINK_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def split_urls(value):
+    """
+    Returns
+    The URLs in a whitespace or comma separated list, in order
+    """
+    return [u for u in re.split(r"[\s,]+", (value or "").strip()) if u]
+
+
+class Mirror(object):
+    """A server of the image. Its throughput is per connection, averaged
+    over what the probe and the download saw
+    """
+    def __init__(self, url, priority=0):
+        self.url = url
+        self.priority = priority
+        self.latency = None
+        self.throughput = None
+        self.size = None
+        self.validator = None
+        self.failures = 0
+        self.active = 0
+
+    def usable(self):
+        return self.failures < config.MIRROR_MAX_FAILURES
+
+    def __repr__(self):
+        return "<Mirror %s>" % self.url
+
+
+class MirrorSet(object):
+    """The mirrors of one image, in order of preference. Connections are
+    handed out to the fastest mirrors, and mirrors which fail repeatedly
+    aren't used anymore
+
+    name -- What the image is saved as
+    size, checksum -- What the image is expected to be, if known
+    """
+    def __init__(self, urls, name=None, size=None, checksum=None):
+        self.mirrors = [Mirror(url, i) for i, url in enumerate(urls)]
+        self.name = name or image_name(urls[0])
+        self.size = size
+        self.checksum = checksum
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    @classmethod
+    def from_sources(cls, url, mirrors=None):
+        """
+        Build the mirror set of an image
+
+        url -- The image, or a metalink document listing its mirrors
+        mirrors -- More URLs of the image, tried after the ones of url
+
+        Raises DownloadError if a metalink document can't be used
+        """
+        extra = split_urls(mirrors)
+        if is_metalink(url):
+            metalink = load_metalink(url)
+            metalink.mirrors.extend(Mirror(u, len(metalink) + i)
+                                    for i, u in enumerate(extra))
+            return metalink
+        return cls([url] + extra, image_name(url))
+
+    def prefer(self, urls):
+        """Add mirrors which are tried before all the others, until they
+        are measured
+        """
+        first = min([m.priority for m in self.mirrors] + [0])
+        self.mirrors[:0] = [Mirror(url, first - len(urls) + i)
+                            for i, url in enumerate(urls)
+                            if not self.find(url)]
+
+    def find(self, url):
+        return ([m for m in self.mirrors if m.url == url] or [None])[0]
+
+    def best(self, exclude=()):
+        """
+        Returns
+        The usable mirror with the highest throughput, the most preferred
+        one until they were measured, or None
+        """
+        usable = [m for m in self.mirrors if m.usable() and
+                  m not in exclude]
+        if not usable:
+            return None
+        return min(usable, key=lambda m: (m.throughput is None,
+                                          -(m.throughput or 0), m.priority))
+
+    def acquire(self, exclude=()):
+        """
+        Pick the mirror for a new connection. Connections are spread over
+        the mirrors in proportion to their throughput
+
+        Returns
+        A mirror which has to be given back with release(), or None
+        """
+        with self._lock:
+            usable = [m for m in self.mirrors if m.usable() and
+                      m not in exclude]
+            if not usable:
+                return None
+
+            fallback = max([m.throughput for m in usable] + [1])
+            mirror = min(usable, key=lambda m: (
+                (m.active + 1) / float(m.throughput or fallback),
+                m.priority))
+            mirror.active += 1
+        return mirror
+
+    def hold(self, mirror):
+        with self._lock:
+            mirror.active += 1
+
+    def release(self, mirror):
+        with self._lock:
+            mirror.active -= 1
+
+    def report(self, mirror, length, elapsed):
+        """Account for length bytes which took elapsed seconds to arrive
+        from mirror
+        """
+        rate = length / max(elapsed, .001)
+        weight = config.PROGRESS_SMOOTHING
+        with self._lock:
+            mirror.throughput = rate if mirror.throughput is None else \
+                weight * rate + (1 - weight) * mirror.throughput
+
+    def failed(self, mirror, error=None):
+        with self._lock:
+            mirror.failures += 1
+        LOGGER.info("Mirror %s failed: %s" % (mirror.url, error))
+
+    def succeeded(self, mirror):
+        with self._lock:
+            mirror.failures = 0
+
+    def degraded(self, mirror):
+        """
+        Returns
+        True if another usable mirror is clearly faster than mirror
+        """
+        others = [m.throughput for m in self.mirrors
+                  if m is not mirror and m.usable() and m.throughput]
+        return bool(others and mirror.throughput and mirror.throughput <
+                    max(others) * config.MIRROR_DEGRADED_RATIO)
+
+    def probe(self, timeout=None):
+        """Measure the latency and throughput of every mirror at once, by
+        retrieving the first MIRROR_PROBE_SIZE bytes of the image. Mirrors
+        which fail or serve an image of another size are left out
+        """
+        timeout = timeout or config.MIRROR_PROBE_TIMEOUT
+        threads = [threading.Thread(target=self.__probe,
+                                    args=(m, timeout),
+                                    name="probe-%s" % m.url)
+                   for m in self.mirrors]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        sizes = [m.size for m in self.mirrors if m.usable() and m.size]
+        expected = self.size or (max(set(sizes), key=sizes.count)
+                                 if sizes else None)
+        for mirror in self.mirrors:
+            if mirror.usable() and expected and mirror.size != expected:
+                LOGGER.info("Mirror %s serves %s bytes instead of %s, "
+                            "leaving it out" % (mirror.url, mirror.size,
+                                                expected))
+                mirror.failures = config.MIRROR_MAX_FAILURES
+
+        LOGGER.info("Probed mirrors: %s" % ", ".join(
+            "%s (%s)" % (m.url, "%.0f B/s, %.3fs" % (m.throughput,
+                                                     m.latency)
+                         if m.usable() else "unusable")
+            for m in self.mirrors))
+
+    def __probe(self, mirror, timeout):
+        headers = {"Range": "bytes=0-%d" % (config.MIRROR_PROBE_SIZE - 1)}
+        began = time.time()
+        r = None
+        try:
+            r = new_session().get(mirror.url, stream=True, headers=headers,
+                                  timeout=timeout)
+            latency = time.time() - began
+            if r.status_code not in (200, 206):
+                raise requests.exceptions.HTTPError("HTTP error code %s" %
+                                                    r.status_code)
+
+            data = r.raw.read(config.MIRROR_PROBE_SIZE)
+            elapsed = time.time() - began - latency
+
+            m = re.match(r"bytes \d+-\d+/(\d+)",
+                         r.headers.get("content-range", ""))
+            length = r.headers.get("content-length")
+            mirror.size = int(m.group(1)) if m else \
+                int(length) if r.status_code == 200 and length else None
+
+            etag = r.headers.get("etag")
+            mirror.validator = etag if etag and not etag.startswith("W/") \
+                else r.headers.get("last-modified")
+
+            mirror.latency = latency
+            mirror.throughput = len(data) / max(elapsed, .001)
+        except Exception as e:
+            mirror.failures = config.MIRROR_MAX_FAILURES
+            LOGGER.info("Mirror %s can't be used: %s" % (mirror.url, e))
+        finally:
+            if r is not None:
+                r.close()
+
+
+def load_metalink(url):
+    """
+    Read a metalink document, version 4 (RFC 5854) or 3
+
+    Returns
+    A MirrorSet of the first file it describes, named after url
+
+    Raises DownloadError if it can't be retrieved or lists no mirrors
+    """
+    # Imported here, the download module builds on this one
+    from .hosted_engine_download import DownloadError
+
+    r = new_session().get(url)
+    if r.status_code != 200:
+        raise DownloadError("Cannot download the metalink: HTTP error code "
+                            "%s" % str(r.status_code))
+
+    def local(tag):
+        return tag.rsplit("}", 1)[-1]
+
+    try:
+        root = ElementTree.fromstring(r.content)
+    except ElementTree.ParseError as e:
+        raise DownloadError("The metalink can't be parsed: %s" % e)
+
+    files = [el for el in root.iter() if local(el.tag) == "file"]
+    if not files:
+        raise DownloadError("The metalink doesn't describe any file")
+    entry = files[0]
+
+    urls, size, checksum = [], None, None
+    for element in entry.iter():
+        tag = local(element.tag)
+        text = (element.text or "").strip()
+        if tag == "url" and urlparse(text).scheme in ("http", "https"):
+            try:
+                if "priority" in element.attrib:
+                    priority = int(element.get("priority"))
+                else:
+                    # Version 3 prefers higher preferences
+                    priority = 101 - int(element.get("preference", 1))
+            except ValueError:
+                priority = 1000000
+            urls.append((priority, len(urls), text))
+        elif tag == "size" and text.isdigit():
+            size = int(text)
+        elif tag == "hash" and not checksum and \
+                element.get("type", "").lower() in METALINK_HASHES:
+            checksum = (METALINK_HASHES[element.get("type").lower()],
+                        text.lower())
+
+    if not urls:
+        raise DownloadError("The metalink doesn't list any HTTP mirror")
+
+    return MirrorSet([u for _, _, u in sorted(urls)], image_name(url), size,
+                     checksum)
@@ -21,28 +21,257 @@
 
 from ovirt.node import utils
 from ovirt.node.config.defaults import NodeConfigFileSection
-from ovirt.node.utils.fs import File
 from ovirt.node import valid
 from . import config
+from collections import OrderedDict
 import os
+import tempfile
+
+
+def make_tempfile():
+    """
+    Returns
+    The path of a new, empty file for the setup configuration
+    """
+    if not os.path.exists(config.HOSTED_ENGINE_SETUP_DIR):
+        os.makedirs(config.HOSTED_ENGINE_SETUP_DIR)
+
+    if not os.path.exists(config.HOSTED_ENGINE_TEMPDIR):
+        os.makedirs(config.HOSTED_ENGINE_TEMPDIR)
+
+    temp_fd, temp_cfg_file = tempfile.mkstemp()
+    os.close(temp_fd)
+    return temp_cfg_file
+
+
+def persist_configs(changed=None):
+    """Keep what ovirt-hosted-engine-setup wrote across reboots. Only what
+    changed since the last time is persisted again
+
+    changed -- Paths the watcher saw change. Nothing is done unless some
+               of them are in the persisted trees, and those were persisted
+               before, by a deploy
+
+    Returns
+    What was done, as recorded in the manifest, or None
+    """
+    from .hosted_engine_persist import PersistManifest
+
+    manifest = PersistManifest()
+    if changed is not None and not manifest.tracks(changed):
+        return None
+    return manifest.sync()
+
+
+class AnswerFile(object):
+    """The environment ovirt-hosted-engine-setup is started with, in the
+    otopi format. Values are checked against SCHEMA as they are set, so a
+    file which is rendered can be used as it is
+
+    values -- (key, value) pairs to start with
+    """
+    section = "environment:default"
+
+    # The type of every key, and the values it may have if they are few.
+    # Any key may be None
+    SCHEMA = {"OVEHOSTED_CORE/tempDir": (str, None),
+              "OVEHOSTED_VM/vmBoot": (str, ("cdrom", "disk", "pxe")),
+              "OVEHOSTED_VM/vmCDRom": (str, None),
+              "OVEHOSTED_VM/ovfArchive": (str, None)}
+
+    def __init__(self, values=()):
+        self.values = OrderedDict()
+        for key, value in values:
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        if key not in self.SCHEMA:
+            raise KeyError("Unknown answer {key}".format(key=key))
+
+        kind, choices = self.SCHEMA[key]
+        if value is not None:
+            if kind is str and not isinstance(value, basestring) or \
+                    kind is bool and not isinstance(value, bool):
+                raise ValueError("{key} has to be a {kind}, not {value!r}"
+                                 .format(key=key, kind=kind.__name__,
+                                         value=value))
+            if choices and value not in choices:
+                raise ValueError("{key} has to be one of {choices}, not "
+                                 "{value!r}".format(key=key, value=value,
+                                                    choices=choices))
+            if kind is str and "\n" in value:
+                raise ValueError("{key} can't span lines".format(key=key))
+        self.values[key] = value
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def render(self):
+        lines = ["[{section}]".format(section=self.section)]
+        for key, value in self.values.items():
+            if value is None:
+                encoded = "none:None"
+            elif isinstance(value, bool):
+                encoded = "bool:{value}".format(value=value)
+            else:
+                encoded = "str:{value}".format(value=value)
+            lines.append("{key}={encoded}".format(key=key, encoded=encoded))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Replace path with the rendered file at once, through a
+        temporary file in the same directory which is synced first
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        fd, tmp = tempfile.mkstemp(dir=directory,
+                                   prefix=".{name}.".format(
+                                       name=os.path.basename(path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.render())
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+        dirfd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an answer file, keys which aren't in SCHEMA included
+
+        Returns
+        An AnswerFile, or None if path can't be read
+        """
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except IOError:
+            return None
+
+        decoders = {"none": lambda v: None,
+                    "bool": lambda v: v == "True",
+                    "int": int}
+        answers = cls()
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(("#", "[")) or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            kind, _, raw = value.partition(":")
+            try:
+                value = decoders.get(kind, lambda v: v)(raw)
+            except ValueError:
+                value = raw
+            answers.values[key.strip()] = value
+        return answers
+
+    def diff(self, other):
+        """
+        Returns
+        (key, other's value, this value) for every key which differs,
+        other may be None
+        """
+        theirs = other.values if other else {}
+        keys = list(self.values) + [k for k in theirs
+                                    if k not in self.values]
+        return [(k, theirs.get(k), self.values.get(k)) for k in keys
+                if k not in theirs or k not in self.values or
+                theirs[k] != self.values[k]]
+
+
+class HostedEngineConf(object):
+    """A key=value file such as hosted-engine.conf. It is parsed once and
+    the result is kept until the file changes on disk, so it can be looked
+    at on every page render.
+
+    What was read while watcher, a thread which calls invalidate() on
+    every change, was already watching the directory of the file, is kept
+    without even looking at the file until then
+    """
+    _cache = {}
+    watcher = None
+
+    def __init__(self, path=None):
+        self.path = path or config.VM_CONF_PATH
+
+    @classmethod
+    def invalidate(cls):
+        cls._cache.clear()
+
+    def values(self):
+        """
+        Returns
+        A dict of all the keys in the file, empty if it doesn't exist
+        """
+        # Looked at before the file is, a change after that is an event
+        watched = bool(self.watcher and
+                       self.watcher.watching(os.path.dirname(self.path)))
+        cached = self._cache.get(self.path)
+        if cached and watched and cached[2]:
+            return cached[1]
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._cache[self.path] = (None, {}, watched)
+            return {}
+
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        if cached and cached[0] == key:
+            self._cache[self.path] = (key, cached[1], watched)
+            return cached[1]
+
+        values = {}
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                k, v = line.split("=", 1)
+                values[k.strip()] = v.strip()
+
+        self._cache[self.path] = (key, values, watched)
+        return values
+
+    def get(self, key, default=None):
+        return self.values().get(key, default)
 
 
 class HostedEngine(NodeConfigFileSection):
     keys = ("OVIRT_HOSTED_ENGINE_IMAGE_PATH",
             "OVIRT_HOSTED_ENGINE_PXE",
             "OVIRT_HOSTED_ENGINE_FORCE_ENABLE",
+            "OVIRT_HOSTED_ENGINE_IMAGE_CHECKSUM",
+            "OVIRT_HOSTED_ENGINE_IMAGE_MIRRORS",
             )
 
     @NodeConfigFileSection.map_and_update_defaults_decorator
-    def update(self, imagepath, pxe, force_enable=None):
+    def update(self, imagepath, pxe, force_enable=None, checksum=None,
+               mirrors=None):
         if not isinstance(pxe, bool):
             pxe = True if pxe.lower() == 'true' else False
         (valid.Empty() | valid.Text())(imagepath)
         (valid.Boolean()(pxe))
+        (valid.Empty(or_none=True) | valid.Text())(checksum)
+        (valid.Empty(or_none=True) | valid.Text())(mirrors)
         return {"OVIRT_HOSTED_ENGINE_IMAGE_PATH": imagepath,
                 "OVIRT_HOSTED_ENGINE_PXE": "yes" if pxe else None,
                 "OVIRT_HOSTED_ENGINE_FORCE_ENABLE": "yes" if force_enable
-                else None}
+                else None,
+                "OVIRT_HOSTED_ENGINE_IMAGE_CHECKSUM": checksum or None,
+                "OVIRT_HOSTED_ENGINE_IMAGE_MIRRORS": mirrors or None}
 
     def retrieve(self):
         cfg = dict(NodeConfigFileSection.retrieve(self))
@@ -59,6 +288,9 @@ class HostedEngine(NodeConfigFileSection):
             title = "Writing Hosted Engine Config File"
 
             def commit(self):
+                from .hosted_engine_mirrors import image_name
+                from .hosted_engine_ova import load_metadata
+
                 cfg = HostedEngine().retrieve()
 
                 def magic_type(mtype="gzip"):
@@ -71,16 +303,11 @@ class HostedEngine(NodeConfigFileSection):
 
                     return True if magic == magic_headers[mtype] else False
 
-                def write(line):
-                    f.write("{line}\n".format(line=line), "a")
-
-                f = File(temp_cfg_file)
-
                 self.logger.info("Saving Hosted Engine Config")
 
+                answers = AnswerFile()
                 ova_path = None
                 boot = None
-                write("[environment:default]")
 
                 if cfg["pxe"]:
                     boot = "pxe"
@@ -91,39 +318,59 @@ class HostedEngine(NodeConfigFileSection):
                     else:
                         imagepath = os.path.join(
                             config.HOSTED_ENGINE_SETUP_DIR,
-                            os.path.basename(cfg["imagepath"]).lstrip("/"))
+                            image_name(cfg["imagepath"]))
                     if imagepath.endswith(".iso"):
                         boot = "cdrom"
-                        write("OVEHOSTED_VM/vmCDRom=str:{imagepath}".format(
-                            imagepath=imagepath))
+                        answers["OVEHOSTED_VM/vmCDRom"] = imagepath
                     else:
-                        imagetype = "gzip" if magic_type() else "Unknown"
+                        # An OVA validated while it was downloaded doesn't
+                        # have to be read again. The setup only opens gzip
+                        # compressed ones
+                        metadata = load_metadata(imagepath)
+                        if metadata:
+                            imagetype = metadata["format"]
+                        elif magic_type():
+                            imagetype = "gzip"
+                        else:
+                            imagetype = "Unknown"
 
                         if imagetype == "gzip":
                             boot = "disk"
                             ova_path = imagepath
+                        elif imagetype != "Unknown":
+                            raise RuntimeError("Downloaded OVA is %s "
+                                               "compressed, the setup only "
+                                               "takes gzip" % imagetype)
                         else:
-                            os.unlink(temp_cfg_file)
                             raise RuntimeError("Downloaded image is neither an"
                                                " OVA nor an ISO, can't use it")
 
-                bootstr = "str:{boot}".format(
-                    boot=boot
-                ) if boot else "none:None"
-                write("OVEHOSTED_VM/vmBoot={bootstr}".format(bootstr=bootstr))
+                answers["OVEHOSTED_VM/vmBoot"] = boot
+                answers["OVEHOSTED_VM/ovfArchive"] = ova_path
+                answers["OVEHOSTED_CORE/tempDir"] = \
+                    config.HOSTED_ENGINE_TEMPDIR
 
-                ovastr = "str:{ova_path}".format(ova_path=ova_path) if \
-                    ova_path else "none:None"
-                write("OVEHOSTED_VM/ovfArchive={ovastr}".format(ovastr=ovastr))
+                for key, old, new in answers.diff(
+                        AnswerFile.load(config.LAST_ANSWER_FILE)):
+                    self.logger.info("{key} changed from {old!r} to {new!r} "
+                                     "since the last deploy".format(
+                                         key=key, old=old, new=new))
 
-                write("OVEHOSTED_CORE/tempDir=str:{tmpdirHE}".format(
-                      tmpdirHE=config.HOSTED_ENGINE_TEMPDIR))
+                # Nothing is written unless all of it can be
+                answers.write(temp_cfg_file)
+                try:
+                    answers.write(config.LAST_ANSWER_FILE)
+                except (IOError, OSError):
+                    self.logger.debug("Couldn't keep the configuration as "
+                                      "{last}".format(
+                                          last=config.LAST_ANSWER_FILE),
+                                      exc_info=True)
 
                 self.logger.info("Wrote hosted engine install configuration to"
                                  " {cfg}".format(cfg=temp_cfg_file))
                 self.logger.debug("Wrote config as:")
-                for line in f:
-                    self.logger.debug("{line}".format(line=line.strip()))
+                for line in answers.render().splitlines():
+                    self.logger.debug("{line}".format(line=line))
 
         txs.append(WriteConfig())
         return txs
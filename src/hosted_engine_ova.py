@@ -0,0 +1,594 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_ova.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from distutils.spawn import find_executable
+from xml.etree import ElementTree
+from .hosted_engine_download import CHUNK_SIZE, InvalidImageError
+
+import Queue
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+Inspect compressed OVA archives while they are being downloaded
+"""
+
+BLOCK_SIZE = 512
+
+# Don't inflate more than this at once, qcow2 images full of zeroes
+# compress extremely well
+INFLATE_SIZE = 1024 * 1024
+
+# How many compressed chunks may be waiting for the decompression thread
+# before the download has to wait for it
+PIPELINE_DEPTH = 16
+
+# The compression formats appliances are shipped in, by their magic numbers
+FORMATS = (("gzip", "\x1f\x8b\x08"),
+           ("xz", "\xfd7zXZ\x00"),
+           ("zstd", "\x28\xb5\x2f\xfd"))
+
+# Decompressors which keep more than one core busy, preferred when
+# decompressing in parallel with the download
+PARALLEL_DECOMPRESSORS = {"gzip": ["pigz", "-dc"],
+                          "xz": ["xz", "-dc", "-T0"],
+                          "zstd": ["zstd", "-dcq", "-T0"]}
+
+# Used when the format can't be decompressed in-process
+DECOMPRESSORS = {"gzip": ["gzip", "-dc"],
+                 "xz": ["xz", "-dc"],
+                 "zstd": ["zstd", "-dcq"]}
+
+# An OVF descriptor larger than this is not taken seriously
+MAX_OVF_SIZE = 1024 * 1024 * 4
+
+
+class OvaError(InvalidImageError):
+    pass
+
+
+def metadata_path(image):
+    """Where the OVF metadata recorded for an image is kept
+    """
+    return "%s.ovf.json" % image
+
+
+def load_metadata(image):
+    """
+    Returns
+    The OVF metadata recorded while image was downloaded, or None
+    """
+    try:
+        with open(metadata_path(image)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def detect_format(head):
+    """
+    Returns
+    The compression format of a file starting with head, or None
+    """
+    for name, magic in FORMATS:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+class InflateStream(object):
+    """Decompresses in-process and hands the result to sink in pieces of at
+    most INFLATE_SIZE bytes, where the format allows bounding them
+    """
+    def __init__(self, fmt, sink):
+        self.sink = sink
+
+        if fmt == "gzip":
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif fmt == "xz":
+            self._obj = lzma.LZMADecompressor()
+        else:
+            self._obj = zstandard.ZstdDecompressor().decompressobj()
+        self._bounded = fmt == "gzip"
+        # The bytes after a gzip member, until they tell whether another
+        # one follows, and whether what follows is only garbage
+        self._rest = None
+        self._trailing = False
+
+    @staticmethod
+    def supports(fmt):
+        return fmt == "gzip" or (fmt == "xz" and lzma is not None) or \
+            (fmt == "zstd" and zstandard is not None)
+
+    def write(self, data):
+        if self._trailing:
+            return
+        if self._rest is not None:
+            data, self._rest = self._rest + data, None
+            if not self.__next_member(data):
+                return
+
+        self.sink(self.__decompress(data))
+        while self._bounded and self._obj.unconsumed_tail:
+            self.sink(self.__decompress(self._obj.unconsumed_tail))
+
+        if self._bounded and self._obj.unused_data:
+            # The member ended, a gzip file can hold several one after the
+            # other, such as concatenated or bgzip compressed ones
+            rest = self._obj.unused_data
+            self._rest = ""
+            self.write(rest)
+
+    def close(self):
+        pass
+
+    def __next_member(self, data):
+        """
+        Returns
+        True if data starts another gzip member, which it is then
+        decompressed with. Anything else is ignored, like gzip does
+        """
+        magic = FORMATS[0][1]
+        if len(data) < len(magic) and magic.startswith(data):
+            self._rest = data
+            return False
+        if not data.startswith(magic):
+            self._trailing = True
+            return False
+        self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return True
+
+    def __decompress(self, data):
+        try:
+            if self._bounded:
+                return self._obj.decompress(data, INFLATE_SIZE)
+            return self._obj.decompress(data)
+        except Exception as e:
+            # zlib.error, LZMAError and ZstdError don't share a base class
+            raise OvaError("The image can't be decompressed: %s" % e)
+
+
+class PipelineStream(object):
+    """Runs another stream on its own thread, so decompressing and validating
+    overlap with the download instead of holding it up. zlib and lzma
+    release the GIL while they work, so this keeps a second core busy
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+        self._queue = Queue.Queue(PIPELINE_DEPTH)
+        self._error = None
+        self._thread = threading.Thread(target=self.__run,
+                                        name="ova-decompress")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        if self._error:
+            raise self._error
+        self._queue.put(data)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error:
+            raise self._error
+        self.stream.close()
+
+    def __run(self):
+        for data in iter(self._queue.get, None):
+            if self._error:
+                # Keep draining, so the writer never blocks on a full queue
+                continue
+            try:
+                self.stream.write(data)
+            except Exception as e:
+                self._error = e
+
+
+class PipeStream(object):
+    """Decompresses with an external program, like pigz or a multithreaded
+    xz, reading its output on a separate thread
+    """
+    def __init__(self, argv, sink):
+        self.argv = argv
+        self.sink = sink
+
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=self._stderr,
+                                         close_fds=True)
+        self._error = None
+        self._thread = threading.Thread(target=self.__read,
+                                        name="ova-%s" % argv[0])
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        if self._error:
+            raise self._error
+        try:
+            self._process.stdin.write(data)
+        except IOError:
+            # The program gave up, close() says why
+            self.close()
+
+    def close(self):
+        if not self._process.stdin.closed:
+            self._process.stdin.close()
+        self._thread.join()
+        self._process.wait()
+
+        if self._error:
+            raise self._error
+        if self._process.returncode:
+            self._stderr.seek(0)
+            raise OvaError("The image can't be decompressed: %s" %
+                           (self._stderr.read().strip() or
+                            "%s failed" % self.argv[0]))
+
+    def __read(self):
+        fd = self._process.stdout.fileno()
+        for data in iter(lambda: os.read(fd, CHUNK_SIZE), ""):
+            if self._error:
+                # Keep reading, a program blocked on its output would never
+                # take more input
+                continue
+            try:
+                self.sink(data)
+            except Exception as e:
+                self._error = e
+
+
+def open_stream(fmt, sink, parallel=False):
+    """
+    Pick the fastest way to decompress fmt here
+
+    sink -- Called with the decompressed bytes, in order
+    parallel -- Decompress on other threads or processes than the caller's
+
+    Returns
+    A stream, which takes the compressed bytes with write() and is finished
+    with close()
+    """
+    if parallel:
+        argv = PARALLEL_DECOMPRESSORS[fmt]
+        if find_executable(argv[0]):
+            return PipeStream(argv, sink)
+
+    if InflateStream.supports(fmt):
+        stream = InflateStream(fmt, sink)
+        return PipelineStream(stream) if parallel else stream
+
+    argv = DECOMPRESSORS[fmt]
+    if find_executable(argv[0]):
+        return PipeStream(argv, sink)
+
+    raise OvaError("The image is %s compressed, but neither a Python module "
+                   "nor %s is available to decompress it" % (fmt, argv[0]))
+
+
+class TarWalker(object):
+    """Walks the members of a tar stream fed to it in arbitrary pieces,
+    handing their names, sizes and contents to the callbacks of a
+    subclass. GNU long names and pax path/size records are understood
+    """
+    def __init__(self):
+        self.finished = False
+        self.member = None
+
+        self._header = ""
+        self._remaining = 0
+        self._padding = 0
+        self._long_name = None
+        self._pax = {}
+        self._content = []
+
+    def feed(self, data):
+        # Member contents are passed on as views, without copying them
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data) and not self.finished:
+            if self._remaining:
+                piece = data[pos:pos + self._remaining]
+                self._remaining -= len(piece)
+                pos += len(piece)
+                self._data(piece)
+                if not self._remaining:
+                    self._end()
+
+            elif self._padding:
+                skipped = min(self._padding, len(data) - pos)
+                self._padding -= skipped
+                pos += skipped
+
+            else:
+                piece = data[pos:pos + BLOCK_SIZE - len(self._header)]
+                self._header += piece.tobytes()
+                pos += len(piece)
+                if len(self._header) == BLOCK_SIZE:
+                    header, self._header = self._header, ""
+                    self.__parse(header)
+
+    def in_member(self):
+        """True while the stream stopped in the middle of a member
+        """
+        return bool(self._remaining or self._header)
+
+    def member_start(self, name, size):
+        pass
+
+    def member_data(self, data):
+        pass
+
+    def member_end(self):
+        pass
+
+    def __parse(self, header):
+        if header == "\0" * BLOCK_SIZE:
+            # The end of the archive is marked by zeroed blocks
+            self.finished = True
+            return
+
+        stored = header[148:156].strip(" \0")
+        computed = sum(ord(c) for c in header[:148] + " " * 8 +
+                       header[156:])
+        if not stored or int(stored, 8) != computed:
+            raise OvaError("The image is not a valid OVA: corrupted tar "
+                           "header")
+
+        typeflag = header[156]
+        name = header[:100].rstrip("\0")
+        if header[257:262] == "ustar" and header[345:500].strip("\0"):
+            name = "%s/%s" % (header[345:500].rstrip("\0"), name)
+        size = self.__size(header[124:136])
+
+        name = self._pax.pop("path", None) or self._long_name or name
+        size = int(self._pax.pop("size", size))
+        self._long_name = None
+
+        self.member = (typeflag, name, size)
+        self._remaining = size
+        self._padding = -size % BLOCK_SIZE
+        self._content = []
+
+        if typeflag not in ("L", "x", "g"):
+            self.member_start(name, size)
+        if not size:
+            self._end()
+
+    def __size(self, field):
+        if ord(field[0]) & 0x80:
+            # GNU base-256 encoding for large members
+            return reduce(lambda acc, c: acc << 8 | ord(c), field[1:], 0)
+        return int(field.strip(" \0") or "0", 8)
+
+    def _data(self, data):
+        typeflag = self.member[0]
+        if typeflag in ("L", "x", "g"):
+            self._content.append(data.tobytes())
+        else:
+            self.member_data(data)
+
+    def _end(self):
+        typeflag = self.member[0]
+        content = "".join(self._content)
+
+        if typeflag == "L":
+            self._long_name = content.rstrip("\0")
+        elif typeflag == "x":
+            for record in content.split("\n"):
+                key, _, value = record.partition(" ")[2].partition("=")
+                if key in ("path", "size"):
+                    self._pax[key] = value
+        elif typeflag != "g":
+            self.member_end()
+
+
+class OvaValidator(TarWalker):
+    """Validates a gzip, xz or zstd compressed OVA from its bytes, fed in
+    order while it is being downloaded. Raises OvaError as soon as the
+    archive is clearly not a usable OVA, instead of after the whole
+    transfer.
+
+    The OVF descriptor is parsed on the way, and the size of every file it
+    references is checked against the archive. The result is kept in
+    metadata.
+
+    With parallel, decompressing happens on another thread or process, and
+    errors are raised by a later update() or by finish()
+    """
+    def __init__(self, parallel=False):
+        super(OvaValidator, self).__init__()
+        self.parallel = parallel
+        self.format = None
+        self.metadata = None
+        self.members = {}
+
+        self._head = ""
+        self._stream = None
+        self._ovf = None
+        self._error = None
+
+    def update(self, data):
+        if self._error:
+            raise self._error
+
+        try:
+            if not self._stream:
+                # Wait for enough bytes to tell the format
+                self._head += data
+                if len(self._head) < max(len(m) for _, m in FORMATS):
+                    return
+                data, self._head = self._head, ""
+                self.__open(data)
+
+            self._stream.write(data)
+        except OvaError as e:
+            self._error = e
+            raise
+
+    def finish(self):
+        """
+        Called once the whole image was fed
+
+        Raises OvaError if the archive is truncated or no OVF was found
+        """
+        if self._error:
+            raise self._error
+        if self._head and not self._stream:
+            self.__open(self._head)
+            self._stream.write(self._head)
+        if self._stream:
+            self._stream.close()
+        if self.in_member():
+            raise OvaError("The image is truncated")
+        if not self.metadata:
+            raise OvaError("The image is not a valid OVA: no OVF descriptor "
+                           "found")
+
+        for ref in self.metadata["files"]:
+            if self.__member_for(ref["href"]) is None:
+                raise OvaError("The image is not a valid OVA: %s is "
+                               "missing" % ref["href"])
+
+    def discard(self):
+        """Called when the image was rejected
+        """
+        pass
+
+    def save(self, image):
+        """Record the OVF metadata next to image
+        """
+        self.metadata["format"] = self.format
+
+        tmp = "%s.tmp" % metadata_path(image)
+        with open(tmp, "w") as f:
+            json.dump(self.metadata, f, indent=2)
+        os.rename(tmp, metadata_path(image))
+
+    def __open(self, head):
+        self.format = detect_format(head)
+        if not self.format:
+            raise OvaError("The image is not a gzip, xz or zstd compressed "
+                           "OVA")
+        self._stream = open_stream(self.format, self.__walk, self.parallel)
+
+    def __walk(self, data):
+        if not self.finished:
+            self.feed(data)
+
+    def member_start(self, name, size):
+        self.members[name] = size
+        if name.lower().endswith(".ovf"):
+            if size > MAX_OVF_SIZE:
+                raise OvaError("The image is not a valid OVA: %s is too "
+                               "large for an OVF descriptor" % name)
+            self._ovf = []
+        elif self.metadata:
+            self.__check(name, size)
+
+    def member_data(self, data):
+        if self._ovf is not None:
+            self._ovf.append(data.tobytes())
+
+    def member_end(self):
+        if self._ovf is not None:
+            self.metadata = self.__parse_ovf(self.member[1],
+                                             "".join(self._ovf))
+            self._ovf = None
+
+            # Disks which came before the descriptor
+            [self.__check(name, size) for name, size in self.members.items()
+             if not name.lower().endswith(".ovf")]
+
+    def __member_for(self, href):
+        for name in self.members:
+            if name == href or name.endswith("/%s" % href.lstrip("./")):
+                return name
+        return None
+
+    def __check(self, name, size):
+        for ref in self.metadata["files"]:
+            if self.__member_for(ref["href"]) == name and \
+                    ref["size"] is not None and ref["size"] != size:
+                raise OvaError("The image is not a valid OVA: %s is %s "
+                               "bytes, the OVF says %s" %
+                               (name, size, ref["size"]))
+
+    def __parse_ovf(self, name, content):
+        def local(tag):
+            return tag.rsplit("}", 1)[-1]
+
+        def attrs(element):
+            return dict((local(k), v) for k, v in element.attrib.items())
+
+        try:
+            root = ElementTree.fromstring(content)
+        except ElementTree.ParseError as e:
+            raise OvaError("The image is not a valid OVA: %s can't be "
+                           "parsed: %s" % (name, e))
+
+        metadata = {"ovf": name, "files": [], "disks": [], "cpus": None,
+                    "memory_mb": None}
+
+        for element in root.iter():
+            tag = local(element.tag)
+            a = attrs(element)
+            if tag == "File" and "href" in a:
+                metadata["files"].append({
+                    "href": a["href"],
+                    "size": int(a["size"]) if a.get("size") else None})
+            elif tag == "Disk":
+                metadata["disks"].append({
+                    "id": a.get("diskId"),
+                    "file": a.get("fileRef"),
+                    "capacity": a.get("capacity"),
+                    "format": a.get("format")})
+            elif tag == "Item":
+                item = dict((local(c.tag), c.text) for c in element)
+                if item.get("ResourceType") == "3":
+                    metadata["cpus"] = item.get("VirtualQuantity")
+                elif item.get("ResourceType") == "4":
+                    metadata["memory_mb"] = item.get("VirtualQuantity")
+
+        if not metadata["disks"] and not metadata["files"]:
+            raise OvaError("The image is not a valid OVA: %s doesn't "
+                           "describe any disk" % name)
+
+        return metadata
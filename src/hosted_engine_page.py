@@ -19,38 +19,77 @@
 # MA  02110-1301, USA.  A copy of the GNU General Public License is
 # also available at http://www.gnu.org/copyleft/gpl.html.
 
-from urlparse import urlparse
 from ovirt.node import plugins, ui, utils, valid
 from ovirt.node.plugins import Changeset
 from ovirt.node.utils import console
-from ovirt.node.utils.fs import Config, File
 from ovirt.node.utils.network import NodeNetwork
-from ovirt_hosted_engine_ha.client import client
 from . import config
-from .hosted_engine_model import HostedEngine
+from .hosted_engine_metrics import span, time_transaction, timed
 
-import json
 import os
-import requests
+import socket
 import sys
-import tempfile
 import threading
 import time
 
 """
 Configure Hosted Engine
+
+The TUI imports this on every start. What only the deploy flow, the
+download or the HA status need, requests and the HA client among it, is
+imported when they first run
 """
 
 
 class Plugin(plugins.NodePlugin):
+    # The changes on_merge acts on, in the order it looks for them
+    merge_handlers = ("button.dialog", "button.status", "button.hosts",
+                      "button.maintenance",
+                      "maintenance.confirm", "deploy.additional",
+                      "deploy.confirm", "button.bandwidth")
+
     _server = None
     _show_progressbar = False
     _model = {}
     _install_ready = False
+    _dialog = None
+    _downloaded = None
+    _poller = None
+    _watcher = None
+    _seeder = None
+    _prefetcher = None
+    _hosts_sort = ("host_id", False)
+
+    # What the page shows of the state of Hosted Engine, pushed to it when
+    # it changes
+    pushed_keys = ["hosted_engine.enabled", "hosted_engine.vm",
+                   "hosted_engine.status"]
+
+    # The fields of the deploy dialog a prefetch depends on
+    prefetch_keys = ["hosted_engine.diskpath", "hosted_engine.checksum",
+                     "hosted_engine.mirrors"]
 
     def __init__(self, application):
         super(Plugin, self).__init__(application)
 
+        if config.SEED_ENABLED and not Plugin._seeder:
+            from .hosted_engine_seed import SeedServer
+            try:
+                Plugin._seeder = SeedServer().start()
+            except socket.error:
+                self.logger.exception("Couldn't serve cached images")
+
+        if config.DOWNLOAD_PREFETCH and not Plugin._prefetcher:
+            from .hosted_engine_model import HostedEngine
+            from .hosted_engine_retrieval import Prefetcher
+
+            Plugin._prefetcher = Prefetcher(config.HOSTED_ENGINE_SETUP_DIR)
+            if not self._configured():
+                # Most likely what will be deployed
+                cfg = HostedEngine().retrieve()
+                Plugin._prefetcher.want(cfg["imagepath"], cfg["checksum"],
+                                        cfg["mirrors"])
+
     def name(self):
         return "Hosted Engine"
 
@@ -62,22 +101,30 @@ class Plugin(plugins.NodePlugin):
         return {"OVIRT_HOSTED_ENGINE_IMAGE_PATH": imagepath}
 
     def model(self):
+        from .hosted_engine_bandwidth import DOWNLOAD_LIMIT, format_rate
+        from .hosted_engine_model import HostedEngine, HostedEngineConf
+
         cfg = HostedEngine().retrieve()
 
-        conf_status = "Configured" if self._configured() else "Not configured"
+        configured = self._configured()
+        conf_status = "Configured" if configured else "Not configured"
         vm_status = self.__get_vm_status()
         vm = None
 
-        if self._configured():
-            vm = self._read_attr_config(config.VM_CONF_PATH, "fqdn")
+        if configured:
+            vm = HostedEngineConf().get("fqdn")
 
         model = {
             "hosted_engine.enabled": str(conf_status),
             "hosted_engine.vm": vm,
             "hosted_engine.status": vm_status,
             "hosted_engine.diskpath": cfg["imagepath"] or "",
+            "hosted_engine.checksum": cfg["checksum"] or "",
+            "hosted_engine.mirrors": cfg["mirrors"] or "",
             "hosted_engine.display_message": "",
-            "hosted_engine.pxe": cfg["pxe"]}
+            "hosted_engine.pxe": cfg["pxe"],
+            "download.bandwidth": format_rate(DOWNLOAD_LIMIT.cap),
+            "download.adaptive": DOWNLOAD_LIMIT.adaptive}
 
         self._model.update(model)
 
@@ -85,11 +132,19 @@ class Plugin(plugins.NodePlugin):
 
     def validators(self):
         return {"hosted_engine.diskpath": valid.Empty() |
-                valid.URL() | valid.FileURL()}
+                valid.URL() | valid.FileURL(),
+                "hosted_engine.checksum": valid.Empty() | valid.URL() |
+                valid.Text(),
+                "hosted_engine.mirrors": valid.Empty() | valid.Text(),
+                "download.bandwidth": valid.Empty() | valid.Text()}
 
     def ui_content(self):
-        # Update the status on a page refresh
+        # Show the latest status we have, and ask for a fresh one on a page
+        # refresh
         self._model["hosted_engine.status"] = self.__get_vm_status()
+        if self._poller:
+            self._poller.refresh()
+        self._config_watcher()
 
         network_up = NodeNetwork().is_configured()
 
@@ -110,6 +165,7 @@ class Plugin(plugins.NodePlugin):
                        ui.KeywordLabel("hosted_engine.status",
                                        ("Engine Status: ")),
                        ui.Button("button.status", "Hosted Engine VM status"),
+                       ui.Button("button.hosts", "Hosted Engine hosts"),
                        ui.Button("button.maintenance",
                                  "Set Hosted Engine maintenance")])
 
@@ -126,21 +182,60 @@ class Plugin(plugins.NodePlugin):
 
             ws.append(ui.KeywordLabel("download.status", ""))
 
+            # Takes effect on the running download
+            ws.extend([ui.Entry("download.bandwidth",
+                                "Bandwidth limit (like 10M, 0 for none):"),
+                       ui.Checkbox("download.adaptive",
+                                   "Back off while the HA broker is slow"),
+                       ui.Button("button.bandwidth", "Apply bandwidth limit")])
+
         page = ui.Page("page", ws)
         page.buttons = []
         self.widgets.add(page)
         return page
 
     def on_change(self, changes):
-        pass
+        if Changeset(changes).contains_any(["hosts.sort", "hosts.reverse"]):
+            key, reverse = self._hosts_sort
+            self._hosts_sort = (changes.get("hosts.sort", key),
+                                bool(changes.get("hosts.reverse", reverse)))
+            self.widgets["hosts.table"].text(self._hosts_table())
+
+        if self._prefetcher and \
+                Changeset(changes).contains_any(self.prefetch_keys):
+            # Changes come one field at a time, the others are what the
+            # dialog holds
+            values = dict(self._model)
+            values.update(self.pending_changes(False))
+            values.update(changes)
+            self._prefetcher.want(*[values.get(k) or None
+                                    for k in self.prefetch_keys])
 
     def on_merge(self, effective_changes):
+        handler = ([k for k in self.merge_handlers
+                    if k in effective_changes] or ["other"])[0]
+        with span("plugin.on_merge", handler=handler):
+            return self.__merge(effective_changes)
+
+    def __merge(self, effective_changes):
+        from urlparse import urlparse
+        from .hosted_engine_metrics import format_duration
+        from .hosted_engine_mirrors import image_name
+        from .hosted_engine_model import HostedEngine, make_tempfile
+        from .hosted_engine_status import render_status
+
         def close_dialog():
             if self._dialog:
                 self._dialog.close()
                 self._dialog = None
+
+        if "button.bandwidth" in effective_changes:
+            # Leaves the download, and the deploy waiting for it, alone
+            return self.__set_bandwidth(effective_changes)
+
         self._install_ready = False
         self._invalid_download = False
+        downloaded, self._downloaded = self._downloaded, None
         self.temp_cfg_file = False
 
         effective_changes = Changeset(effective_changes)
@@ -152,44 +247,51 @@ class Plugin(plugins.NodePlugin):
         self.logger.debug("Effective Model: %s" % effective_model)
 
         if "button.dialog" in effective_changes:
-            self._dialog = DeployDialog("Deploy Hosted Engine", self)
-            self.widgets.add(self._dialog)
-            return self._dialog
+            return self._open_dialog(DeployDialog("Deploy Hosted Engine",
+                                                  self))
 
         if "button.status" in effective_changes:
-            try:
-                contents = utils.process.check_output(
-                    ["hosted-engine",
-                     "--vm-status"],
-                    stderr=utils.process.STDOUT
-                )
-            except utils.process.CalledProcessError:
+            # Rendered from the status the poller already has, instead of
+            # running hosted-engine --vm-status
+            status = self._status_poller().status()
+            if status.value is None:
                 contents = "\nFailed to collect hosted engine vm status, " \
                            "check ovirt-ha-broker logs."
+            else:
+                contents = render_status(status.value)
+                if status.stale():
+                    contents = "\nThis status is {age} old, the HA " \
+                               "broker is not answering.\n{contents}".format(
+                                   age=format_duration(status.age()),
+                                   contents=contents)
 
             self.application.show(self.ui_content())
             return ui.TextViewDialog("output.dialog", "Hosted Engine VM "
                                      "Status", contents)
 
+        if "button.hosts" in effective_changes:
+            return self._open_dialog(HostsDialog("Hosted Engine Hosts", self))
+
         if "button.maintenance" in effective_changes:
-            self._dialog = MaintenanceDialog("Hosted Engine Maintenance", self)
-            self.widgets.add(self._dialog)
-            return self._dialog
+            return self._open_dialog(MaintenanceDialog(
+                "Hosted Engine Maintenance", self))
 
         if "maintenance.confirm" in effective_changes:
             close_dialog()
             if "maintenance.level" in effective_changes:
                 level = effective_changes["maintenance.level"]
                 try:
-                    utils.process.check_call(["hosted-engine",
-                                              "--set-maintenance",
-                                              "--mode=%s" % level])
+                    with span("ha.set_maintenance", level=level):
+                        utils.process.check_call(["hosted-engine",
+                                                  "--set-maintenance",
+                                                  "--mode=%s" % level])
                 except:
                     self.logger.exception("Couldn't set maintenance level "
                                           "to %s" % level, exc_info=True)
                     return ui.InfoDialog("dialog.error", "An error occurred",
                                          "Couldn't set maintenance level to "
                                          "%s. Check the logs" % level)
+                self._status_poller().refresh()
 
         if "deploy.additional" in effective_changes:
             close_dialog()
@@ -221,17 +323,6 @@ class Plugin(plugins.NodePlugin):
         if effective_changes.contains_any(["deploy.confirm"]):
             close_dialog()
 
-            def make_tempfile():
-                if not os.path.exists(config.HOSTED_ENGINE_SETUP_DIR):
-                    os.makedirs(config.HOSTED_ENGINE_SETUP_DIR)
-
-                if not os.path.exists(config.HOSTED_ENGINE_TEMPDIR):
-                    os.makedirs(config.HOSTED_ENGINE_TEMPDIR)
-
-                temp_fd, temp_cfg_file = tempfile.mkstemp()
-                os.close(temp_fd)
-                return temp_cfg_file
-
             imagepath = effective_model["hosted_engine.diskpath"]
             pxe = effective_model["hosted_engine.pxe"]
             localpath = None
@@ -254,6 +345,8 @@ class Plugin(plugins.NodePlugin):
             self.temp_cfg_file = make_tempfile()
 
             engine_keys = ["hosted_engine.diskpath", "hosted_engine.pxe"]
+            checksum = effective_model["hosted_engine.checksum"]
+            mirrors = effective_model["hosted_engine.mirrors"]
 
             txs = utils.Transaction("Setting up hosted engine")
 
@@ -261,23 +354,29 @@ class Plugin(plugins.NodePlugin):
             # Why are we setting force_enable? It clutters the code. We should
             # move force enabling it to checking for --dry instead
             model = HostedEngine()
-            args = tuple(effective_model.values_for(engine_keys)) + (None,)
+            args = tuple(effective_model.values_for(engine_keys)) + \
+                (None, checksum, mirrors)
             model.update(*args)
 
             if "file://" in imagepath:
                 localpath = imagepath[7:]
             elif imagepath:
                 localpath = os.path.join(config.HOSTED_ENGINE_SETUP_DIR,
-                                         os.path.basename(imagepath))
-
-            # Check whether we have enough conditions to run it right now
-            if pxe or os.path.exists(localpath):
+                                         image_name(imagepath))
+
+            # Check whether we have enough conditions to run it right now.
+            # Images from HTTP are always revalidated through the cache
+            # first, since a file with the same name may be stale
+            remote = urlparse(imagepath).scheme in ("http", "https")
+            if pxe or (os.path.exists(localpath) and
+                       (not remote or downloaded == imagepath)):
                 def console_wait(event):
                     event.wait()
                     self._install_ready = True
                     self.show_dialog()
 
-                txs += model.transaction(self.temp_cfg_file)
+                txs += time_transaction(
+                    model.transaction(self.temp_cfg_file))
                 progress_dialog = ui.TransactionProgressDialog("dialog.txs",
                                                                txs, self)
 
@@ -306,13 +405,31 @@ class Plugin(plugins.NodePlugin):
                     self._show_progressbar = True
                     self.application.show(self.ui_content())
                     self._image_retrieve(imagepath,
-                                         config.HOSTED_ENGINE_SETUP_DIR)
+                                         config.HOSTED_ENGINE_SETUP_DIR,
+                                         checksum, mirrors)
 
         return self.ui_content()
 
+    def _open_dialog(self, dialog):
+        """Keep track of the dialog the page shows until it is dismissed,
+        however that happens, so nothing is pushed to it once it is gone
+        """
+        def dismissed(*args):
+            if self._dialog is dialog:
+                self._dialog = None
+
+        dialog.on_close.connect(dismissed)
+        for button in dialog.buttons:
+            if isinstance(button, ui.CloseButton):
+                button.on_activate.connect(dismissed)
+
+        self._dialog = dialog
+        self.widgets.add(dialog)
+        return dialog
+
     def show_dialog(self):
         def open_console():
-            if self.temp_cfg_file and os.path.isfile(self.temp_cfg_file):
+            if self._config_written():
                 try:
                     utils.process.call("reset; screen " +
                                        "ovirt-node-hosted-engine-setup" +
@@ -349,12 +466,16 @@ class Plugin(plugins.NodePlugin):
                     self._model["download.progress"] = 0
                     self._model["download.status"] = ""
 
-                # if the temp config file is empty, we removed it in the model
-                # because there was an exception, so don't do anything
-                if self.temp_cfg_file and not os.path.isfile(
-                        self.temp_cfg_file):
-                    self.logger.debug("The temporary config file %s does not"
-                                      "exist. Not running screen")
+                # if the temp config file is still empty, the model couldn't
+                # write it because there was an exception, so don't do
+                # anything
+                if self._install_ready and self.temp_cfg_file and \
+                        not self._config_written():
+                    self.logger.debug("The temporary config file %s was not "
+                                      "written. Not running screen" %
+                                      self.temp_cfg_file)
+                    if os.path.isfile(self.temp_cfg_file):
+                        os.unlink(self.temp_cfg_file)
                     return
 
                 if self._install_ready:
@@ -392,24 +513,27 @@ class Plugin(plugins.NodePlugin):
 
         self.application.show(self.ui_content())
 
-    def _read_attr_config(self, config_file, attr):
-        """
-        Read Attribute value from a config file
-
-        config_file -- A .conf file
-        attr -- The attribute for reading the value assigned
+    def __set_bandwidth(self, effective_changes):
+        from .hosted_engine_bandwidth import DOWNLOAD_LIMIT, parse_rate
 
-        Returns
-        The value for attribute or None (No attribute found)
-        """
-        value = None
+        values = Changeset(self.model())
+        values.update(effective_changes)
+        try:
+            cap = parse_rate(values["download.bandwidth"])
+        except ValueError as e:
+            return ui.InfoDialog("dialog.error", "Invalid bandwidth limit",
+                                 "%s, use a number of bytes per second "
+                                 "like 512K or 10M" % e)
 
-        f = File(config_file)
-        if attr in f.read():
-            value = [line.strip().split("=")[1] for line in f
-                     if attr in line][0]
+        DOWNLOAD_LIMIT.set(cap, bool(values["download.adaptive"]))
+        return self.ui_content()
 
-        return value
+    def _config_written(self):
+        """The model writes the whole config file at once, or nothing
+        """
+        return bool(self.temp_cfg_file and
+                    os.path.isfile(self.temp_cfg_file) and
+                    os.path.getsize(self.temp_cfg_file))
 
     def _configured(self):
         """
@@ -419,42 +543,148 @@ class Plugin(plugins.NodePlugin):
 
         Return True or False
         """
-        return bool(os.path.exists(config.VM_CONF_PATH) and
-                    self._read_attr_config(config.VM_CONF_PATH, "vm_disk_id"))
+        from .hosted_engine_model import HostedEngineConf
 
+        return bool(HostedEngineConf().get("vm_disk_id"))
+
+    @timed("persist_configs")
     def __persist_configs(self):
-        dirs = ["/etc/ovirt-hosted-engine", "/etc/ovirt-hosted-engine-ha",
-                "/etc/ovirt-hosted-engine-setup.env.d"]
-        [Config().persist(d) for d in dirs]
+        from .hosted_engine_model import persist_configs
+
+        persist_configs()
 
-    def _image_retrieve(self, imagepath, setup_dir):
-        _downloader = DownloadThread(self, imagepath, setup_dir)
+    def _image_retrieve(self, imagepath, setup_dir, checksum=None,
+                        mirrors=None):
+        _downloader = DownloadThread(self, imagepath, setup_dir, checksum,
+                                     mirrors)
         _downloader.start()
 
+    def _status_poller(self):
+        """The HA status is polled in the background once the page is
+        first used, so rendering never waits on the broker
+        """
+        if not Plugin._poller:
+            from .hosted_engine_status import shared_poller
+
+            # Possibly started already, by an adaptive download
+            poller = shared_poller()
+            poller.active = self._shown
+            poller.listener = self._push_model
+            Plugin._poller = poller
+        return Plugin._poller
+
+    def _config_watcher(self):
+        """Changes of the configuration and HA state on disk are watched
+        for once the page is first used, instead of being looked for on
+        every render. Without inotify, they are looked for as before
+        """
+        if Plugin._watcher is not None or not config.WATCH_ENABLED:
+            return
+
+        from .hosted_engine_model import HostedEngineConf
+        from .hosted_engine_watch import ConfigWatcher
+        try:
+            Plugin._watcher = ConfigWatcher(self.__changed)
+        except OSError as e:
+            self.logger.info("Not watching the configuration: %s" % e)
+            Plugin._watcher = False
+            return
+        Plugin._watcher.start()
+        HostedEngineConf.watcher = Plugin._watcher
+
+    def __changed(self, paths):
+        from .hosted_engine_model import HostedEngineConf, persist_configs
+
+        HostedEngineConf.invalidate()
+        if self._poller:
+            # The HA state may have changed with them, shown once polled
+            self._poller.refresh()
+        self._push_model()
+
+        # Such as what the HA services add after the deploy
+        try:
+            persist_configs(paths)
+        except Exception:
+            self.logger.exception("Couldn't persist %s" % ", ".join(paths))
+
+    def _shown(self):
+        return self.application.current_plugin() is self
+
+    def _push_model(self):
+        """Show what changed of the state of Hosted Engine, if anything and
+        if the page is shown. Called from the watcher and poller threads,
+        all of it is done on the UI thread, which owns the model and the
+        widgets
+        """
+        if not self._shown():
+            # Such as while an adaptive download has the status polled
+            return
+
+        def push():
+            if not self._shown():
+                return
+
+            before = dict((k, self._model.get(k)) for k in self.pushed_keys)
+            after = self.model()
+            changed = [k for k in self.pushed_keys
+                       if before[k] != after.get(k)]
+            if isinstance(self._dialog, HostsDialog):
+                self.widgets["hosts.table"].text(self._hosts_table())
+            if "hosted_engine.enabled" in changed:
+                # Deployed or removed, the page looks different. Left for
+                # later while a dialog is open
+                if not self._dialog:
+                    self.application.show(self.ui_content())
+            else:
+                for key in changed:
+                    self.widgets[key].text(after[key])
+
+        self.application.ui.thread_connection().call(push)
+
+    def _hosts_table(self):
+        from .hosted_engine_metrics import format_duration
+        from .hosted_engine_status import render_table
+
+        status = self._status_poller().status()
+        if status.value is None:
+            return "Retrieving status..." if status.error is None else \
+                "Cannot connect to HA daemon, please check the logs"
+
+        table = render_table(status.value, *self._hosts_sort)
+        if status.stale():
+            table = "As of {age} ago, the HA broker is not answering.\n\n" \
+                "{table}".format(age=format_duration(status.age()),
+                                 table=table)
+        return table
+
     def __get_ha_status(self):
-        def dict_from_string(string):
-            return json.loads(string)
+        from .hosted_engine_metrics import format_duration
 
         host = None
 
-        ha_cli = client.HAClient()
-        try:
-            vm_status = ha_cli.get_all_host_stats()
-        except:
-            vm_status = "Cannot connect to HA daemon, please check the logs"
-            return vm_status
+        status = self._status_poller().status()
+        if status.value is None:
+            if status.error is None:
+                return "Retrieving status..."
+            return "Cannot connect to HA daemon, please check the logs"
         else:
-            for v in vm_status.values():
-                if dict_from_string(v['engine-status'])['health'] == "good":
-                    host = "Here" if v['host-id'] == \
-                           ha_cli.get_local_host_id() else v['hostname']
-                    host = v['hostname']
+            snapshot = status.value
+            running = snapshot.table.engine_host
+            if running:
+                host = "Here" if running.host_id == \
+                    snapshot.local_host_id else running.hostname
 
         if not host:
             vm_status = "Engine is down or not deployed."
+        elif host == "Here":
+            vm_status = "Engine is running here"
         else:
             vm_status = "Engine is running on {host}".format(host=host)
 
+        if status.stale():
+            vm_status += " (as of {age} ago)".format(
+                age=format_duration(status.age()))
+
         return vm_status
 
     def __get_vm_status(self):
@@ -468,13 +698,18 @@ class DeployDialog(ui.Dialog):
     """A dialog to input deployment information
     """
     def __init__(self, title, plugin):
-        self.keys = ["hosted_engine.diskpath", "hosted_engine.pxe"]
+        self.keys = ["hosted_engine.diskpath", "hosted_engine.checksum",
+                     "hosted_engine.mirrors", "hosted_engine.pxe"]
 
         def clear_invalid(dialog, changes):
             [plugin.stash_change(prefix) for prefix in self.keys]
 
         entries = [ui.Entry("hosted_engine.diskpath",
                             "Engine ISO/OVA URL for download:"),
+                   ui.Entry("hosted_engine.checksum",
+                            "Image checksum or checksum URL (optional):"),
+                   ui.Entry("hosted_engine.mirrors",
+                            "Additional mirror URLs (optional):"),
                    ui.Checkbox("hosted_engine.pxe", "PXE Boot Engine VM"),
                    ui.Divider("divider[1]"),
                    ui.SaveButton("deploy.additional",
@@ -526,35 +761,44 @@ class MaintenanceDialog(ui.Dialog):
         b["maintenance.close"].on_activate.connect(clear_invalid)
 
     def __vm_status(self):
-        ha_cli = client.HAClient()
-        level = None
+        # The same snapshot the page shows, no need to ask the broker again
+        snapshot = self.plugin._status_poller().status().value
+        return snapshot.maintenance_level() if snapshot else None
 
-        try:
-            level = "global" if ha_cli.get_all_stats(
-                client.HAClient.StatModes.GLOBAL)[0]["maintenance"] else None
-        except KeyError:
-            # Stats returned but no global section
-            pass
 
-        if level is None:
-            try:
-                level = "local" if ha_cli.get_all_stats()[1]["maintenance"] \
-                        else "none"
-            except:
-                self.plugin.logger.debug("Couldn't get HA stats!",
-                                         exc_info=True)
+class HostsDialog(ui.Dialog):
+    """A dialog showing every host of the cluster, one per line. It follows
+    the polled status while it is open
+    """
+    def __init__(self, title, plugin):
+        from .hosted_engine_status import TABLE_COLUMNS
 
-        return level
+        key, reverse = plugin._hosts_sort
+
+        children = [ui.Options("hosts.sort", "Sort by",
+                               [(k, label) for k, label, width
+                                in TABLE_COLUMNS], selected=key),
+                    ui.Checkbox("hosts.reverse", "Reverse order", reverse),
+                    ui.Divider("divider[0]"),
+                    ui.Label("hosts.table", plugin._hosts_table())]
+        super(HostsDialog, self).__init__("hosts.dialog", title, children)
+        self.buttons = [ui.CloseButton("hosts.close", "Close")]
+
+        b = plugins.UIElements(self.buttons)
+        b["hosts.close"].on_activate.clear()
+        b["hosts.close"].on_activate.connect(ui.CloseAction())
 
 
 class DownloadThread(threading.Thread):
     ui_thread = None
 
-    def __init__(self, plugin, url, setup_dir):
+    def __init__(self, plugin, url, setup_dir, checksum=None, mirrors=None):
         super(DownloadThread, self).__init__()
         self.he_plugin = plugin
         self.url = url
         self.setup_dir = setup_dir
+        self.checksum = checksum
+        self.mirrors = mirrors
 
     @property
     def logger(self):
@@ -570,90 +814,83 @@ class DownloadThread(threading.Thread):
             self.logger.exception("Downloader thread failed: %s " % e)
 
     def __run(self):
+        from .hosted_engine_download import DownloadError, TRANSFER_ERRORS
+        from .hosted_engine_retrieval import ImageRetrieval
+        import requests
+
         # Wait a second before the UI refresh so we get the right widgets
         time.sleep(.5)
 
-        path = "%s/%s" % (self.setup_dir, self.url.split('/')[-1])
-
         ui_is_alive = lambda: any((t.name == "MainThread") and t.is_alive() for
                                   t in threading.enumerate())
 
-        with open(path, 'wb') as f:
-            started = time.time()
-            try:
-                s = requests.Session()
-
-                # Don't let apache transparently deflate gzips
-                del s.headers["Accept-Encoding"]
-
-                r = s.get(self.url, stream=True)
-                if r.status_code != 200:
-                    self.he_plugin._model['display_message'] = \
-                        "\n\nCannot download the file: HTTP error code %s" % \
-                        str(r.status_code)
-                    os.unlink(path)
-                    return self.he_plugin.show_dialog()
-
-                size = r.headers.get('content-length')
-
-                # Size isn't specified if it's chunked
-                encoding = r.headers.get('transfer-encoding') if not size \
-                    else None
-            except requests.exceptions.ConnectionError as e:
-                self.logger.info("Error downloading: %s" % e[0], exc_info=True)
-                self.he_plugin._model['display_message'] = \
-                    "\n\nConnection Error: %s!" % str(e[0])
-                os.unlink(path)
-                return self.he_plugin.show_dialog()
-
-            downloaded = 0
-
-            def update_ui():
-                # Get new handles every time, since switching pages means
-                # the widgets will get rebuilt and we need new handles to
-                # update
-                progressbar = self.he_plugin.widgets["download.progress"]
-                status = self.he_plugin.widgets["download.status"]
-
-                if encoding == 'chunked':
-                    current = 0
-                elif size:
-                    current = int(100.0 * (float(downloaded) / float(size)))
-
-                progressbar.current(current)
-                speed = calculate_speed()
-                status.text(speed)
-
-                # Save it in the model so the page can update immediately
-                # on switching back instead of waiting for a tick
-                self.he_plugin._model.update({"download.status": speed})
-                self.he_plugin._model.update({"download.progressbar": current})
-
-            def calculate_speed():
-                raw = downloaded // (time.time() - started)
-                i = 0
-                friendly_names = ("B", "KB", "MB", "GB")
-                if int(raw / 1024) > 0:
-                    raw = raw / 1024
-                    i += 1
-                return "%0.2f %s/s" % (raw, friendly_names[i])
-
-            chunk = None
-            while chunk != '':
-                chunk = r.raw.read(1024 * 256)
-                downloaded += len(chunk)
-                f.write(chunk)
-
-                if ui_is_alive():
-                    self.ui_thread.call(update_ui())
-                else:
-                    break
+        # A prefetch of the image is attached to instead of starting over
+        prefetch = self.he_plugin._prefetcher.take(
+            self.url, self.checksum, self.mirrors) \
+            if self.he_plugin._prefetcher else None
+        retrieval = prefetch.retrieval if prefetch else \
+            ImageRetrieval(self.url, self.setup_dir, self.checksum,
+                           self.mirrors)
+
+        def update_ui(progress):
+            # Get new handles every time, since switching pages means
+            # the widgets will get rebuilt and we need new handles to
+            # update
+            progressbar = self.he_plugin.widgets["download.progress"]
+            status = self.he_plugin.widgets["download.status"]
+
+            current = progress.percent()
+            speed = str(progress)
+
+            progressbar.current(current)
+            status.text(speed)
+
+            # Save it in the model so the page can update immediately
+            # on switching back instead of waiting for a tick
+            self.he_plugin._model.update({"download.status": speed})
+            self.he_plugin._model.update({"download.progressbar": current})
+
+        def tick(progress):
+            # Called by the transfer every config.PROGRESS_INTERVAL, the
+            # widgets are updated on the UI thread
+            if ui_is_alive():
+                self.ui_thread.call(lambda: update_ui(progress))
+                return True
+            return False
 
-        if not ui_is_alive():
-            # If they've exited, clear out the file
-            os.unlink(path)
+        try:
+            completed = prefetch.result(tick) if prefetch else \
+                retrieval.run(tick)
+        except DownloadError as e:
+            self.he_plugin._model['display_message'] = "\n\n%s" % e
+            return self.he_plugin.show_dialog()
+        except requests.exceptions.ConnectionError as e:
+            self.logger.info("Error downloading: %s" % e[0], exc_info=True)
+            self.he_plugin._model['display_message'] = \
+                "\n\nConnection Error: %s!" % str(e[0])
+            return self.he_plugin.show_dialog()
+        except TRANSFER_ERRORS as e:
+            # Timeouts and connections dropped while downloading
+            self.logger.info("Error downloading: %s" % e, exc_info=True)
+            self.he_plugin._model['display_message'] = \
+                "\n\nDownload Error: %s!" % e
+            return self.he_plugin.show_dialog()
+        except EnvironmentError as e:
+            # The image, its partial state or the cache couldn't be written
+            self.logger.info("Error storing the image: %s" % e,
+                             exc_info=True)
+            self.he_plugin._model['display_message'] = \
+                "\n\nCouldn't store the image: %s!" % e
+            return self.he_plugin.show_dialog()
+
+        if not completed or not ui_is_alive():
+            # If they've exited, the partial download stays around to be
+            # resumed next time
+            self.logger.info("Download of %s interrupted at %s bytes" %
+                             (self.url, retrieval.downloaded()))
 
         else:
+            self.he_plugin._downloaded = self.url
             self.he_plugin.on_merge({"hosted_engine.diskpath": self.url,
                                      "deploy.confirm": True})
             self.he_plugin._install_ready = True
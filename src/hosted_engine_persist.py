@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_persist.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from ovirt.node.utils.fs import Config
+from . import config
+from .hosted_engine_cache import file_digest
+
+import json
+import logging
+import os
+import time
+
+"""
+Persistence of what the setup and the HA services write
+
+On oVirt Node every persisted file is copied to /config and bind mounted
+back, which isn't free. A manifest of the size, mtime and sha256 of every
+persisted file is kept, so only files which were added, changed or removed
+since the last time are persisted or unpersisted
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PersistManifest(object):
+    """The files of trees as they were last persisted, and a history of
+    what was done to them
+
+    trees -- Directories whose files are persisted
+    """
+    def __init__(self, trees=None, path=None):
+        self.trees = config.PERSIST_TREES if trees is None else trees
+        self.path = path or config.PERSIST_MANIFEST
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            manifest = {}
+        manifest.setdefault("files", {})
+        manifest.setdefault("history", [])
+        return manifest
+
+    def tracks(self, paths):
+        """
+        Returns
+        True if the trees were synced before, and any of paths is in them
+        """
+        return os.path.exists(self.path) and any(
+            self.__in_trees(p) or p.rstrip("/") in
+            [t.rstrip("/") for t in self.trees] for p in paths)
+
+    def scan(self, known=None):
+        """
+        Returns
+        A dict of every file in the trees to its size, mtime and sha256.
+        Files whose size and mtime are the same as in known aren't read
+        """
+        known = known or {}
+        files = {}
+        for tree in self.trees:
+            if os.path.ismount(tree):
+                # Persisted whole by an earlier version, whatever is
+                # written to it goes to /config by itself
+                continue
+            for root, dirs, names in os.walk(tree):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        # Removed while we looked
+                        continue
+
+                    entry = {"size": st.st_size, "mtime": st.st_mtime}
+                    old = known.get(path)
+                    if old and (old["size"], old["mtime"]) == \
+                            (entry["size"], entry["mtime"]):
+                        entry["sha256"] = old["sha256"]
+                    else:
+                        try:
+                            entry["sha256"] = file_digest(path)
+                        except IOError:
+                            continue
+                    files[path] = entry
+        return files
+
+    def sync(self):
+        """Persist the files which were added or changed since the last
+        sync. Unpersist the files which were removed, or aren't persisted
+        anymore
+
+        Returns
+        The record of what was done, which is also added to the history
+        unless nothing was
+        """
+        manifest = self.load()
+        old = dict((p, e) for p, e in manifest["files"].items()
+                   if self.__in_trees(p))
+        new = self.scan(old)
+
+        added = sorted(set(new) - set(old))
+        changed = sorted(p for p in set(new) & set(old)
+                         if new[p]["sha256"] != old[p]["sha256"])
+        # Files which aren't persisted anymore, such as runtime state, are
+        # unpersisted along with the removed ones
+        removed = sorted(set(manifest["files"]) - set(new))
+
+        record = {"time": time.time(), "persisted": [], "unpersisted": [],
+                  "failed": [], "unchanged": len(new) - len(changed) -
+                  len(added)}
+        cfg = Config()
+        for path in removed:
+            try:
+                cfg.unpersist(path)
+                record["unpersisted"].append(path)
+            except Exception as e:
+                LOGGER.warning("Couldn't unpersist %s: %s" % (path, e))
+                record["failed"].append(path)
+                new[path] = manifest["files"][path]
+
+        for path in added + changed:
+            try:
+                cfg.persist(path)
+                record["persisted"].append(path)
+            except Exception as e:
+                LOGGER.warning("Couldn't persist %s: %s" % (path, e))
+                record["failed"].append(path)
+                # Tried again next time
+                new.pop(path)
+                if path in old:
+                    new[path] = dict(old[path], sha256=None)
+
+        LOGGER.info("Persisted %d, unpersisted %d, failed %d, left %d "
+                    "unchanged files" % (len(record["persisted"]),
+                                         len(record["unpersisted"]),
+                                         len(record["failed"]),
+                                         record["unchanged"]))
+
+        manifest["files"] = new
+        if record["persisted"] or record["unpersisted"] or record["failed"]:
+            manifest["history"] = (manifest["history"] +
+                                   [record])[-config.PERSIST_HISTORY:]
+        self.save(manifest)
+        return record
+
+    def __in_trees(self, path):
+        return any(path.startswith(tree.rstrip("/") + "/")
+                   for tree in self.trees)
+
+    def save(self, manifest):
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        tmp = "%s.tmp" % self.path
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
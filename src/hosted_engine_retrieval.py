@@ -0,0 +1,361 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_retrieval.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from urlparse import urlparse
+from . import config
+from .hosted_engine_cache import ImageCache
+from .hosted_engine_download import Transfer, parse_checksum, verify_file
+from .hosted_engine_metrics import span
+from .hosted_engine_mirrors import MirrorSet, new_session
+from .hosted_engine_ova import OvaValidator
+from .hosted_engine_seed import discover_peers
+
+import logging
+import requests
+import socket
+import threading
+
+"""
+Everything it takes to have an image ready for the setup, without a UI:
+revalidating the cached copy, or finding peers and mirrors, downloading,
+validating and caching it. Shared by the page and the batch mode
+
+An image can also be prefetched, retrieved in the background before it is
+asked for, so the download is picked up where it is when it is
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ImageRetrieval(object):
+    """Brings the image at url into setup_dir
+
+    checksum -- What the image is verified against, as parse_checksum takes
+    mirrors -- More URLs of the image, separated by whitespace or commas
+    """
+    def __init__(self, url, setup_dir, checksum=None, mirrors=None):
+        self.url = url
+        self.setup_dir = setup_dir
+        self.checksum = checksum
+        self.mirrors = mirrors
+
+        self.path = None
+        self.transfer = None
+
+    def downloaded(self):
+        return self.transfer.downloaded if self.transfer else 0
+
+    def run(self, tick):
+        """
+        Retrieve the image into self.path. Partial downloads are kept on
+        failures, so a retry continues from where this one stopped
+
+        tick -- Called with a Progress while downloading, if it returns
+                False the download is aborted
+
+        Returns
+        True if the image is ready, False if it was aborted
+
+        Raises DownloadError if the image can't be retrieved, is invalid or
+        doesn't fit on the disk, and requests' ConnectionError if no server
+        can be reached
+        """
+        cache = ImageCache()
+        cached = cache.lookup(self.url)
+
+        # A metalink names the mirrors and the checksum of the image
+        sources = MirrorSet.from_sources(self.url, self.mirrors)
+        path = self.path = "%s/%s" % (self.setup_dir, sources.name)
+        checksum = parse_checksum(self.checksum, sources.mirrors[0].url) or \
+            sources.checksum
+
+        # Peers can't vouch for what they send, they are only asked when
+        # it can be verified. Cached images are revalidated upstream
+        peers = []
+        if not cached and checksum and config.SEED_DISCOVERY:
+            with span("download.discover"):
+                peers = self.__peers(checksum)
+            sources.prefer([p["url"] for p in peers])
+            if peers:
+                sources.size = peers[0]["size"]
+
+        # Anything but an ISO has to be an OVA, find out while it is still
+        # downloading instead of when the setup is started. It is
+        # decompressed on other cores than the ones hashing and downloading
+        validator = None if path.endswith(".iso") else \
+            OvaValidator(parallel=True)
+
+        with span("download.resolve"):
+            resolve(sources.mirrors[0].url)
+
+        transfer = self.transfer = Transfer(self.url, path, cached=cached,
+                                            checksum=checksum,
+                                            validator=validator,
+                                            mirrors=sources)
+        with span("download.first_byte"):
+            transfer.open()
+        if transfer.not_modified and not cache.checkout(self.url, path):
+            # The cached copy went away since we looked it up
+            transfer = self.transfer = Transfer(self.url, path,
+                                                checksum=checksum,
+                                                validator=validator,
+                                                mirrors=sources)
+            with span("download.first_byte"):
+                transfer.open()
+
+        if transfer.not_modified:
+            if checksum:
+                with span("download.verify"):
+                    verify_file(path, checksum, {"sha256": cached["digest"]})
+            return True
+
+        # Cached images give way to the one being downloaded, the disk has
+        # to hold it before any of it is transferred
+        with span("download.reserve"):
+            transfer.reserve(cache.make_room)
+
+        with span("download.transfer", ranged=str(transfer.ranged).lower()):
+            if not transfer.run(tick):
+                return False
+
+        # A resumed download isn't validated, the setup checks what it is
+        if transfer.validator:
+            transfer.validator.save(path)
+
+        etag, last_modified, origin = transfer.state.etag, \
+            transfer.state.last_modified, transfer.state.origin
+        peer_urls = [p["url"] for p in peers]
+        if origin in peer_urls:
+            # The copy is revalidated against where the image comes from,
+            # not against the peer which happened to send it
+            origin = [m.url for m in sources.mirrors
+                      if m.url not in peer_urls][0]
+            etag, last_modified = upstream_validators(origin)
+        try:
+            with span("download.cache_store"):
+                cache.store(self.url, path, etag, last_modified,
+                            transfer.digest("sha256"), origin)
+        except (IOError, OSError):
+            LOGGER.exception("Couldn't add %s to the image cache" % path)
+
+        return True
+
+    def __peers(self, checksum):
+        """
+        Find the hosts on the LAN which hold the image
+
+        checksum -- What the image is verified against, never taken from
+                    the peers
+
+        Returns
+        The peers which hold the same image, so bytes from them and from
+        the mirrors can't be mixed up
+        """
+        sha256 = checksum[1] if checksum[0] == "sha256" else None
+        try:
+            peers = discover_peers(self.url, sha256)
+        except socket.error as e:
+            LOGGER.info("Couldn't look for peers: %s" % e)
+            return []
+
+        digests = [p["sha256"] for p in peers]
+        digest = sha256 or (max(set(digests), key=digests.count)
+                            if digests else None)
+        return [p for p in peers if p["sha256"] == digest]
+
+
+class BackgroundRetrieval(threading.Thread):
+    """Runs an ImageRetrieval in a thread of its own. It reports to
+    whoever attached to it, and keeps going without anyone until it is
+    cancelled or the application exits
+    """
+    def __init__(self, url, setup_dir, checksum=None, mirrors=None):
+        super(BackgroundRetrieval, self).__init__(name="prefetch-%s" % url)
+        self.daemon = True
+        self.retrieval = ImageRetrieval(url, setup_dir, checksum, mirrors)
+        self.key = (url, checksum or None, mirrors or None)
+
+        self.completed = False
+        self.error = None
+        self._tick = None
+        self._cancelled = threading.Event()
+
+    def run(self):
+        try:
+            self.completed = self.retrieval.run(self.__tick)
+        except Exception as e:
+            LOGGER.info("Prefetch of %s failed: %s" % (self.key[0], e),
+                        exc_info=True)
+            self.error = e
+
+    def usable(self, url, checksum=None, mirrors=None):
+        """
+        Returns
+        True if this retrieves url the way it is asked for, and didn't fail
+        or get cancelled
+        """
+        return self.key == (url, checksum or None, mirrors or None) and \
+            not self.error and not self._cancelled.is_set()
+
+    def cancel(self):
+        """Stop at the next tick, the partial download is kept
+        """
+        self._cancelled.set()
+
+    def result(self, tick):
+        """
+        Attach tick in place of whoever was attached before, and wait for
+        the retrieval to end
+
+        Returns
+        What ImageRetrieval.run returned, or raises what it raised
+        """
+        self._tick = tick
+        self.join()
+        if self.error:
+            raise self.error
+        return self.completed
+
+    def __tick(self, progress):
+        if self._cancelled.is_set():
+            return False
+        if self._tick:
+            return self._tick(progress)
+        # The partial download is checkpointed when the application exits
+        return main_thread_alive()
+
+
+class Prefetcher(object):
+    """Keeps at most one image retrieving in the background. A prefetch
+    starts once it was asked for the same image for delay seconds, asking
+    for another image cancels it
+    """
+    def __init__(self, setup_dir, delay=None):
+        self.setup_dir = setup_dir
+        self.delay = config.PREFETCH_DELAY if delay is None else delay
+
+        self._current = None
+        self._timer = None
+        self._wanted = None
+        self._stopping = None
+        self._lock = threading.Lock()
+
+    def want(self, url, checksum=None, mirrors=None):
+        """Prefetch url unless it already is. Anything but an HTTP URL
+        only cancels what is being prefetched
+        """
+        parsed = urlparse(url or "")
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if self._current and self._current.usable(url, checksum,
+                                                      mirrors):
+                return
+            if self._current:
+                self._current.cancel()
+
+            self._wanted = None
+            if parsed.scheme not in ("http", "https") or not parsed.netloc:
+                return
+            self._wanted = (url, checksum, mirrors)
+            self._timer = threading.Timer(self.delay, self.__start,
+                                          (url, checksum, mirrors))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def take(self, url, checksum=None, mirrors=None):
+        """
+        Returns
+        The BackgroundRetrieval of url, or None if it isn't being
+        prefetched. Anything else being prefetched is cancelled, and out of
+        the way once this returns
+        """
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            self._wanted = None
+            current, self._current = self._current, None
+            stopping = self._stopping
+
+        if stopping:
+            stopping.join()
+        if current and current.usable(url, checksum, mirrors):
+            return current
+        if current:
+            current.cancel()
+            current.join()
+        return None
+
+    def __start(self, url, checksum, mirrors):
+        with self._lock:
+            previous, self._current = self._current, None
+            self._stopping = previous
+        if previous:
+            # Two transfers must never write the same file
+            previous.cancel()
+            previous.join()
+
+        with self._lock:
+            if self._stopping is previous:
+                # Gone, take() has nothing to wait for anymore
+                self._stopping = None
+            if self._wanted != (url, checksum, mirrors):
+                # Something else was asked for since the timer fired
+                return
+            LOGGER.info("Prefetching %s" % url)
+            self._current = BackgroundRetrieval(url, self.setup_dir,
+                                                checksum, mirrors)
+            self._current.start()
+
+
+def upstream_validators(url):
+    """
+    Returns
+    The etag and last-modified url answers with, None if it doesn't
+    """
+    try:
+        # Not every server answers HEAD, the body is never read
+        r = new_session().get(url, stream=True,
+                              timeout=config.MIRROR_TIMEOUT)
+        r.close()
+        if r.status_code == 200:
+            return r.headers.get("etag"), r.headers.get("last-modified")
+    except requests.exceptions.RequestException as e:
+        LOGGER.info("Couldn't revalidate %s: %s" % (url, e))
+    return None, None
+
+
+def main_thread_alive():
+    return any(t.name == "MainThread" and t.is_alive() for t in
+               threading.enumerate())
+
+
+def resolve(url):
+    """Look the host of url up. Timed on its own, requests doesn't tell how
+    long DNS took. Failures are left for the download to report
+    """
+    parsed = urlparse(url)
+    try:
+        socket.getaddrinfo(parsed.hostname, parsed.port or
+                           (443 if parsed.scheme == "https" else 80))
+    except socket.error:
+        pass
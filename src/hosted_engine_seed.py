@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_seed.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from . import config
+from .hosted_engine_bandwidth import TokenBucket
+from .hosted_engine_cache import ImageCache
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import json
+import logging
+import re
+import socket
+import threading
+import time
+
+"""
+Sharing of cached images between the hosts of a LAN
+
+A host which holds images in its cache serves them read-only over HTTP,
+and answers discovery broadcasts for them. A host about to download an
+image asks its LAN first, and adds the hosts which answer as mirrors of
+the image, so it is retrieved over the WAN at most once
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+SEND_SIZE = 256 * 1024
+
+# Bumped if the discovery messages change incompatibly
+PROTOCOL = 1
+
+
+class SeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves /images, a JSON list of the cached images, and
+    /images/<sha256>[/<name>], one image, with range requests. Anything
+    but GET and HEAD is refused
+    """
+    protocol_version = "HTTP/1.1"
+    server_version = "ovirt-node-hosted-engine-seed"
+
+    def log_message(self, format, *args):
+        LOGGER.debug("%s %s" % (self.client_address[0], format % args))
+
+    def do_HEAD(self):
+        self.__serve(head=True)
+
+    def do_GET(self):
+        self.__serve(head=False)
+
+    def __serve(self, head):
+        path = self.path.split("?", 1)[0]
+        if path in ("/images", "/images/"):
+            return self.__index(head)
+
+        m = re.match(r"^/images/([0-9a-f]{64})(/[^/]*)?$", path)
+        obj = self.server.cache.object_path(m.group(1)) if m else None
+        try:
+            f = open(obj, "rb") if obj else None
+        except IOError:
+            f = None
+        if not f:
+            return self.__empty(404)
+
+        if not self.server.slots.acquire(False):
+            f.close()
+            return self.__empty(503)
+
+        try:
+            self.__image(f, m.group(1), head)
+        except socket.error:
+            # The client went away, or moved on to another mirror
+            self.close_connection = 1
+        finally:
+            self.server.slots.release()
+            f.close()
+
+    def __index(self, head):
+        images = [{"sha256": d, "size": o["size"]}
+                  for d, o in sorted(self.server.cache.objects().items())]
+        body = json.dumps({"images": images})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def __image(self, f, digest, head):
+        f.seek(0, 2)
+        size = f.tell()
+        etag = '"%s"' % digest
+
+        start, end = 0, size - 1
+        m = re.match(r"^bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+        if m and self.headers.get("If-Range", etag) == etag and \
+                any(m.groups()):
+            first, last = m.groups()
+            if not first:
+                # The last bytes of the image
+                start = max(size - int(last), 0)
+            else:
+                start = int(first)
+                end = min(int(last), end) if last else end
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                             (start, end, size))
+        elif self.headers.get("If-None-Match") == etag:
+            return self.__empty(304, etag)
+        else:
+            self.send_response(200)
+
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        # RFC 3230, lets the client check what it got
+        self.send_header("Digest", "SHA-256=%s" %
+                         base64.b64encode(digest.decode("hex")))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if head:
+            return
+
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(SEND_SIZE, remaining))
+            if not data:
+                # Truncated under us, the client sees a short response
+                self.close_connection = 1
+                return
+            self.server.bucket.consume(len(data))
+            self.wfile.write(data)
+            remaining -= len(data)
+
+    def __empty(self, code, etag=None):
+        self.send_response(code)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class SeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the image cache on port over HTTP, and answers discovery
+    requests for it on the same port over UDP
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=None, cache=None, bandwidth=None,
+                 max_clients=None):
+        self.port = config.SEED_PORT if port is None else port
+        BaseHTTPServer.HTTPServer.__init__(self, ("", self.port),
+                                           SeedHandler)
+        self.port = self.server_port
+
+        self.cache = cache or ImageCache()
+        self.bucket = TokenBucket(config.SEED_BANDWIDTH if bandwidth is None
+                                  else bandwidth)
+        self.slots = threading.Semaphore(max_clients or
+                                         config.SEED_MAX_CLIENTS)
+
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp.bind(("", self.port))
+
+    def start(self):
+        """Serve from background threads
+        """
+        for target, name in ((self.serve_forever, "seed-http"),
+                             (self.answer_forever, "seed-discovery")):
+            t = threading.Thread(target=target, name=name)
+            t.daemon = True
+            t.start()
+        LOGGER.info("Serving cached images on port %d" % self.port)
+        return self
+
+    def answer_forever(self):
+        while True:
+            try:
+                data, address = self.udp.recvfrom(4096)
+                reply = self.answer(data)
+                if reply:
+                    self.udp.sendto(reply, address)
+            except socket.error:
+                LOGGER.debug("Discovery request failed", exc_info=True)
+
+    def answer(self, data):
+        """
+        Returns
+        The reply to a discovery request, or None if nothing asked for is
+        cached here
+        """
+        try:
+            request = json.loads(data)
+            if request.get("seed") != PROTOCOL:
+                return None
+        except (ValueError, AttributeError):
+            return None
+
+        images = [{"sha256": d, "size": o["size"]}
+                  for d, o in self.cache.objects().items()
+                  if d == request.get("sha256") or
+                  request.get("url") in o["urls"]]
+        if not images:
+            return None
+        return json.dumps({"seed": PROTOCOL, "port": self.port,
+                           "images": images})
+
+
+def discover_peers(url, sha256=None, timeout=None, port=None, peers=None):
+    """
+    Ask the LAN, and SEED_PEERS, which hosts hold an image
+
+    url -- Where the image would be retrieved from otherwise
+    sha256 -- The digest of the image, if known
+    peers -- Hosts to ask directly, as "host" or "host:port"
+
+    Returns
+    A list of dicts with the URL, sha256 and size of the image on every
+    host which answered
+    """
+    timeout = config.SEED_DISCOVERY_TIMEOUT if timeout is None else timeout
+    port = port or config.SEED_PORT
+    peers = config.SEED_PEERS if peers is None else peers
+
+    request = json.dumps({"seed": PROTOCOL, "url": url, "sha256": sha256})
+    name = url.split("/")[-1]
+    found = []
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        targets = [("<broadcast>", port)]
+        for peer in peers:
+            host, _, peer_port = peer.partition(":")
+            targets.append((host, int(peer_port or port)))
+        for target in targets:
+            try:
+                s.sendto(request, target)
+            except socket.error as e:
+                LOGGER.debug("Couldn't ask %s:%s: %s" % (target + (e,)))
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            s.settimeout(max(deadline - time.time(), .001))
+            try:
+                data, address = s.recvfrom(65536)
+                reply = json.loads(data)
+                if reply.get("seed") != PROTOCOL:
+                    continue
+                for image in reply.get("images", []):
+                    found.append({"url": "http://%s:%d/images/%s/%s" %
+                                  (address[0], int(reply["port"]),
+                                   image["sha256"], name),
+                                  "sha256": image["sha256"],
+                                  "size": image["size"]})
+            except socket.timeout:
+                break
+            except (socket.error, ValueError, KeyError, TypeError) as e:
+                LOGGER.debug("Ignoring a discovery reply: %s" % e)
+    finally:
+        s.close()
+
+    # A host may be reached through more than one target
+    unique = []
+    for peer in found:
+        if peer["url"] not in [p["url"] for p in unique]:
+            unique.append(peer)
+
+    LOGGER.info("Peers holding %s: %s" % (url, ", ".join(
+        p["url"] for p in unique) or "none"))
+    return unique
@@ -0,0 +1,430 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_status.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from ovirt_hosted_engine_ha.client import client
+from . import config
+from .hosted_engine_metrics import format_duration, span
+
+import json
+import logging
+import operator
+import threading
+import time
+
+"""
+Hosted Engine HA status, retrieved in the background
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+
+# The host fields shown by render_status, in the order of
+# hosted-engine --vm-status
+HOST_FIELDS = (("live-data", "Status up-to-date"),
+               ("hostname", "Hostname"),
+               ("host-id", "Host ID"),
+               ("engine-status", "Engine status"),
+               ("score", "Score"),
+               ("stopped", "stopped"),
+               ("maintenance", "Local maintenance"),
+               ("crc32", "crc32"),
+               ("host-ts", "Host timestamp"))
+
+# The columns of render_table, the HostStatus attribute each one shows and
+# is sorted by, and its width
+TABLE_COLUMNS = (("host_id", "ID", 4),
+                 ("hostname", "Hostname", 32),
+                 ("score", "Score", 6),
+                 ("health", "Engine", 8),
+                 ("maintenance", "Maintenance", 12),
+                 ("age", "Updated", 8))
+
+# Columns which sort the best or latest first
+SORT_DESCENDING = ("score",)
+
+
+class HAStatusSource(object):
+    """Takes HAStatusSnapshots, reusing one HAClient for all of them. The
+    client is only replaced after it failed
+    """
+    _client = None
+
+    def __call__(self):
+        return self.fetch()
+
+    def fetch(self):
+        if not self._client:
+            self._client = client.HAClient()
+
+        try:
+            # A single round trip returns the global section as host 0
+            # along with every host
+            with span("ha.get_all_stats"):
+                stats = self._client.get_all_stats(
+                    client.HAClient.StatModes.ALL)
+            with span("ha.get_local_host_id"):
+                local_host_id = self._client.get_local_host_id()
+        except:
+            self._client = None
+            raise
+
+        self._last = HAStatusSnapshot(stats, local_host_id,
+                                      getattr(self, "_last", None))
+        return self._last
+
+
+def fetch_ha_status():
+    return HAStatusSource().fetch()
+
+
+def engine_status(stats):
+    """
+    Returns
+    The engine-status of a host as a dict, it is sent as a JSON string
+    """
+    value = stats.get("engine-status")
+    if isinstance(value, basestring):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return {"health": "unknown", "detail": value}
+    return value or {}
+
+
+class HostStatus(object):
+    """What a host reported, parsed. It is immutable, so a HostTable can
+    hand it on to the next one for as long as the host reports the same
+
+    updated -- When the host last reported something new, by our clock
+    """
+    __slots__ = ("host_id", "stats", "hostname", "score", "engine_status",
+                 "health", "maintenance", "live", "updated", "line")
+
+    def __init__(self, host_id, stats, previous=None, updated=None):
+        self.host_id = host_id
+        self.stats = stats
+        self.hostname = stats.get("hostname") or ""
+        self.score = stats.get("score") or 0
+        self.maintenance = bool(stats.get("maintenance"))
+        self.live = stats.get("live-data", True)
+
+        if previous and previous.stats.get("engine-status") == \
+                stats.get("engine-status"):
+            self.engine_status = previous.engine_status
+        else:
+            self.engine_status = engine_status(stats)
+        self.health = self.engine_status.get("health") or "unknown"
+
+        if previous and previous.stats.get("host-ts") == \
+                stats.get("host-ts"):
+            self.updated = previous.updated
+        else:
+            self.updated = updated or time.time()
+
+        # Every column but the age, which changes by itself
+        self.line = " ".join("%-*.*s" % (width, width, value) for
+                             value, (key, label, width) in zip(
+                                 (host_id, self.hostname, self.score,
+                                  self.health, "local" if self.maintenance
+                                  else "none"), TABLE_COLUMNS))
+
+    @property
+    def age(self):
+        return time.time() - self.updated
+
+
+class HostTable(object):
+    """The hosts of the cluster, indexed by host id and by hostname.
+
+    It is built from the table of the previous poll: hosts which reported
+    the same are carried over as they are, and the others only parse what
+    changed. The indexes and sorted orders are only built when they are
+    first asked for, and are carried over as well while no host changed
+    """
+    def __init__(self, hosts, previous=None):
+        now = time.time()
+        old = previous.rows if previous else {}
+
+        self.rows = {}
+        self.changed = set()
+        for host_id, stats in hosts.items():
+            row = old.get(host_id)
+            if row is None or row.stats != stats:
+                row = HostStatus(host_id, stats, row, now)
+                self.changed.add(host_id)
+            self.rows[host_id] = row
+        self.removed = set(old) - set(self.rows)
+
+        if previous and not self.changed and not self.removed:
+            self._by_hostname = previous._by_hostname
+            self._sorted = previous._sorted
+            self.engine_host = previous.engine_host
+        else:
+            self._by_hostname = None
+            self._sorted = {}
+            # Where the engine is up, the host with the lowest id if it
+            # looks up on more than one
+            up = [r for r in self.rows.values() if r.health == "good"]
+            self.engine_host = min(up, key=lambda r: r.host_id) \
+                if up else None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, host_id):
+        return self.rows.get(host_id)
+
+    def by_hostname(self, hostname):
+        if self._by_hostname is None:
+            self._by_hostname = dict((r.hostname, r)
+                                     for r in self.rows.values())
+        return self._by_hostname.get(hostname)
+
+    def sorted(self, key="host_id", reverse=False):
+        """
+        Returns
+        The hosts ordered by the HostStatus attribute key, and then by host
+        id. Columns in SORT_DESCENDING are ordered best first, reverse
+        turns the order around
+        """
+        if key not in [c[0] for c in TABLE_COLUMNS]:
+            raise ValueError("Can't sort hosts by %s" % key)
+        if key == "age":
+            # The order doesn't change with time, unlike the ages
+            key, reverse = "updated", not reverse
+        reverse = reverse != (key in SORT_DESCENDING)
+
+        order = self._sorted.get((key, reverse))
+        if order is None:
+            order = sorted(self.rows.values(), key=lambda r: r.host_id)
+            order.sort(key=operator.attrgetter(key), reverse=reverse)
+            self._sorted[(key, reverse)] = order
+        return order
+
+
+class HAStatusSnapshot(object):
+    """One consistent view of the HA cluster, shared by the page and its
+    dialogs so none of them has to ask the broker on its own
+
+    previous -- The snapshot of the last poll, whose HostTable this one
+                carries on
+    """
+    def __init__(self, stats, local_host_id, previous=None):
+        stats = dict(stats)
+
+        self.global_stats = stats.pop(0, None) or {}
+        self.hosts = stats
+        self.local_host_id = local_host_id
+        self.table = HostTable(stats, previous.table if previous else None)
+
+        self.global_maintenance = bool(self.global_stats.get("maintenance"))
+        local = self.table.get(local_host_id)
+        self.local_maintenance = local.maintenance if local else None
+
+        self.scores = dict((r.host_id, r.score)
+                           for r in self.table.rows.values())
+        self.engine_health = dict((r.host_id, r.health)
+                                  for r in self.table.rows.values())
+
+    def maintenance_level(self):
+        """
+        Returns
+        "global", "local" or "none", or None if this host isn't reporting
+        """
+        if self.global_maintenance:
+            return "global"
+        if self.local_maintenance is None:
+            return None
+        return "local" if self.local_maintenance else "none"
+
+
+def render_status(snapshot, output="text"):
+    """
+    Render the HA status like hosted-engine --vm-status does, without
+    starting another interpreter and broker connection
+
+    snapshot -- An HAStatusSnapshot
+    output -- "text" for people, "json" for scripts
+
+    Returns
+    A string
+    """
+    hosts = snapshot.hosts
+    rows = snapshot.table.rows
+    global_maintenance = snapshot.global_maintenance
+
+    if output == "json":
+        data = {}
+        for host_id, stats in hosts.items():
+            data[str(host_id)] = dict(stats)
+            data[str(host_id)]["engine-status"] = rows[host_id].engine_status
+        data["global_maintenance"] = global_maintenance
+        return json.dumps(data, sort_keys=True, indent=2)
+
+    lines = []
+    if global_maintenance:
+        lines.extend(["", "!! Cluster is in GLOBAL MAINTENANCE mode !!"])
+
+    for host_id in sorted(hosts):
+        stats = hosts[host_id]
+        lines.extend(["", "", "--== Host %s status ==--" % host_id, ""])
+        for key, label in HOST_FIELDS:
+            if key not in stats:
+                continue
+            value = json.dumps(rows[host_id].engine_status) \
+                if key == "engine-status" else stats[key]
+            lines.append("%-35s: %s" % (label, value))
+
+    if not hosts:
+        lines.append("\nNo hosts are reporting hosted engine status.")
+
+    return "\n".join(lines)
+
+
+def render_table(snapshot, sort="host_id", reverse=False):
+    """
+    Render the hosts one per line, the way large clusters can be looked
+    at. This host is marked with a *
+
+    sort -- The column of TABLE_COLUMNS the hosts are sorted by
+    reverse -- Whether the order is turned around
+
+    Returns
+    A string
+    """
+    lines = []
+    if snapshot.global_maintenance:
+        lines.extend(["!! Cluster is in GLOBAL MAINTENANCE mode !!", ""])
+
+    lines.append(("  " + " ".join("%-*s" % (width, label) for
+                                  key, label, width in
+                                  TABLE_COLUMNS)).rstrip())
+    for row in snapshot.table.sorted(sort, reverse):
+        lines.append("%s %s %s%s" % (
+            "*" if row.host_id == snapshot.local_host_id else " ",
+            row.line, format_duration(row.age),
+            "" if row.live else " (stale)"))
+
+    if not snapshot.table:
+        lines.append("No hosts are reporting hosted engine status.")
+
+    return "\n".join(lines)
+
+
+class PolledStatus(object):
+    """The outcome of the latest poll. value is None until the first poll
+    succeeded, error is the exception of the latest poll if it failed.
+    latency is how long the broker took to answer it
+    """
+    def __init__(self, value=None, error=None, updated=None, latency=None):
+        self.value = value
+        self.error = error
+        self.updated = updated
+        self.latency = latency
+
+    def age(self):
+        return time.time() - self.updated if self.updated else None
+
+    def stale(self, ttl=None):
+        ttl = ttl or config.HA_STATUS_TTL
+        return self.updated is None or self.age() > ttl
+
+
+class StatusPoller(threading.Thread):
+    """Calls fetch every interval seconds, or sooner when asked to, and
+    keeps the result around. Readers get the latest result right away
+    and never wait for the broker
+
+    active -- Returns False while nobody looks at the status, it is only
+              polled when asked to then
+    listener -- Called after every poll
+    """
+    def __init__(self, fetch, interval=None, active=None, listener=None):
+        super(StatusPoller, self).__init__(name="ha-status-poller")
+        self.daemon = True
+        self.fetch = fetch
+        self.interval = interval or config.HA_STATUS_INTERVAL
+        self.active = active
+        self.listener = listener
+
+        self._status = PolledStatus()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def run(self):
+        asked = True
+        while not self._stopped:
+            if asked or not self.active or self.active():
+                self.poll()
+
+            asked = self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def poll(self):
+        began = time.time()
+        try:
+            value = self.fetch()
+            self._status = PolledStatus(value, None, time.time(),
+                                        time.time() - began)
+        except Exception as e:
+            LOGGER.debug("Couldn't get HA stats!", exc_info=True)
+            # Keep the last good value around, it's shown as stale
+            self._status = PolledStatus(self._status.value, e,
+                                        self._status.updated)
+
+        if self.listener:
+            try:
+                self.listener()
+            except Exception:
+                LOGGER.exception("Couldn't handle the HA status")
+
+    def refresh(self):
+        """Poll as soon as possible, without waiting for the result. Does
+        nothing if the last poll is less than a second old
+        """
+        age = self._status.age()
+        if age is None or age >= 1:
+            self._wakeup.set()
+
+    def status(self):
+        return self._status
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+
+_shared = []
+_shared_lock = threading.Lock()
+
+
+def shared_poller():
+    """
+    Returns
+    The StatusPoller of the process, started on first use. It only polls
+    when asked to, until its active and listener are set, as the page does.
+    Everything reading the HA status shares its polls and its HAClient
+    """
+    with _shared_lock:
+        if not _shared:
+            poller = StatusPoller(HAStatusSource(), active=lambda: False)
+            poller.start()
+            _shared.append(poller)
+    return _shared[0]
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# hosted_engine_watch.py - Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+from . import config
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+
+"""
+Changes of the Hosted Engine configuration and HA state, as they happen
+
+The directories are watched with inotify, so nothing is read or polled
+until something in them changes
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+try:
+    LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+    LIBC = None
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000
+IN_CLOEXEC = 0o2000000
+
+# A file in a watched directory was written, replaced or removed
+CHANGE_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+# A watched directory which didn't exist was created
+CREATE_EVENTS = IN_CREATE | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """The little of inotify(7) the watcher needs
+
+    Raises OSError if inotify isn't available
+    """
+    def __init__(self):
+        self.fd = LIBC.inotify_init1(IN_CLOEXEC) if LIBC else -1
+        if self.fd < 0:
+            err = ctypes.get_errno() if LIBC else errno.ENOSYS
+            raise OSError(err, os.strerror(err))
+        # Watch descriptors to the directory they watch
+        self.watches = {}
+
+    def add(self, path, mask):
+        wd = LIBC.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+        return wd
+
+    def remove(self, wd):
+        self.watches.pop(wd, None)
+        LIBC.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds, forever if None, for events
+
+        Returns
+        A list of (directory, mask, name) for every event, empty if there
+        was none
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+
+            path = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                # The directory is gone, and its watch with it
+                self.watches.pop(wd, None)
+            if path:
+                events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher(threading.Thread):
+    """Calls callback with the paths which changed in directories, once
+    they stopped changing for delay seconds, so a setup rewriting a dozen
+    files is one change. Directories which don't exist yet, such as before
+    the first deploy, are watched for from their parent
+    """
+    def __init__(self, callback, directories=None, delay=None):
+        super(ConfigWatcher, self).__init__(name="config-watcher")
+        self.daemon = True
+        self.callback = callback
+        self.directories = directories or config.WATCH_DIRECTORIES
+        self.delay = config.WATCH_DELAY if delay is None else delay
+
+        # Raised here, the caller falls back to something else
+        self._inotify = Inotify()
+        self._watched = set()
+        self._masks = {}
+
+    def run(self):
+        try:
+            while True:
+                self.__watch()
+                changed = set()
+                events = self._inotify.read()
+                while events:
+                    if self.__changes(events, changed):
+                        # Whatever was written to a directory before it
+                        # was watched counts as a change of the directory
+                        changed.update(self.__watch())
+                    events = self._inotify.read(self.delay)
+
+                if changed:
+                    LOGGER.debug("Changed: %s" % ", ".join(sorted(changed)))
+                    self.callback(sorted(changed))
+        except Exception:
+            LOGGER.exception("Stopped watching %s" %
+                             ", ".join(self.directories))
+        finally:
+            self._inotify.close()
+
+    def watching(self, directory):
+        """
+        Returns
+        True if changes in directory are watched for right now, False before
+        the watch is added, if it couldn't be, or once the watcher stopped
+        """
+        return self.is_alive() and directory in self._watched
+
+    def __watch(self):
+        """Watch the directories which exist, and the closest parent of the
+        ones which don't
+
+        Returns
+        The directories which weren't watched for changes before
+        """
+        needed = {}
+        for directory in self.directories:
+            path = directory
+            while not os.path.isdir(path) and path != "/":
+                path = os.path.dirname(path)
+            if path == directory:
+                needed[path] = CHANGE_EVENTS
+            else:
+                needed.setdefault(path, CREATE_EVENTS)
+
+        for wd, path in self._inotify.watches.items():
+            if needed.get(path) != self._masks.get(path):
+                self._inotify.remove(wd)
+        watched = set(self._inotify.watches.values())
+        self._masks = {}
+        for path, mask in needed.items():
+            try:
+                if path not in watched:
+                    self._inotify.add(path, mask)
+                self._masks[path] = mask
+            except OSError as e:
+                LOGGER.info("Couldn't watch %s: %s" % (path, e))
+
+        watched = set(path for path, mask in self._masks.items()
+                      if mask == CHANGE_EVENTS)
+        added, self._watched = watched - self._watched, watched
+        return added
+
+    def __changes(self, events, changed):
+        """Add the paths events are about to changed
+
+        Returns
+        True if a watched directory, or one of its parents, was created or
+        removed
+        """
+        moved = False
+        for path, mask, name in events:
+            full = os.path.join(path, name) if name else path
+            if path in self._watched or full in self.directories:
+                changed.add(full)
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED) or \
+                    any(d == full or d.startswith(full + "/")
+                        for d in self.directories):
+                moved = True
+        return moved